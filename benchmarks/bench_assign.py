@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""
+Benchmark batched assignment of zmws to consensus primers (debarcode.assign)
+against the former per-zmw lookups with `zmw in z2c.keys()`.
+
+    python benchmarks/bench_assign.py --n_zmws 100000,1000000,20000000
+    python benchmarks/bench_assign.py --n_zmws 1000,5000 --reference_max 5000
+
+Time per zmw of the batched engine should stay flat as n_zmws grows.
+"""
+import sys
+import time
+from collections import defaultdict
+from argparse import ArgumentParser
+import numpy as np
+from debarcode.assign import ClusterCodes, ZmwClusterLinks, assign_first_cluster, assign_most_common
+from debarcode.utils import flnc_zmw_to_consensus_primer, nfl_zmw_to_consensus_primer, get_most_common_item
+
+
+def reference_flnc_zmw_to_consensus_primer(flnc_zmws, flnc_z2c, c2cp):
+    """flnc_zmw_to_consensus_primer before it was batched"""
+    flnc_zmw2cp = defaultdict(lambda: None)
+    for zmw in flnc_zmws:
+        if zmw in flnc_z2c.keys() and flnc_z2c[zmw] is not None and len(flnc_z2c[zmw]) != 0:
+            if c2cp[flnc_z2c[zmw]] is None:
+                flnc_zmw2cp[zmw] = 'cid_no_cprimer'
+            else:
+                flnc_zmw2cp[zmw] = c2cp[flnc_z2c[zmw]]
+        else:
+            flnc_zmw2cp[zmw] = 'no_cid_no_primer'
+    return flnc_zmw2cp
+
+
+def reference_nfl_zmw_to_consensus_primer(nfl_zmws, nfl_z2c, c2cp, get_consensus_func):
+    """nfl_zmw_to_consensus_primer before it was batched"""
+    nfl_zmw2cp = defaultdict(lambda: None)
+    for nfl_zmw in nfl_zmws:
+        if nfl_zmw in nfl_z2c.keys() and nfl_z2c[nfl_zmw] is not None and len(nfl_z2c[nfl_zmw]) != 0:
+            cps = [c2cp[cid] for cid in nfl_z2c[nfl_zmw] if c2cp[cid] is not None]
+            if cps:
+                nfl_zmw2cp[nfl_zmw] = get_consensus_func(cps)
+            else:
+                nfl_zmw2cp[nfl_zmw] = 'cid_no_cprimer'
+        else:
+            nfl_zmw2cp[nfl_zmw] = 'no_cid_no_cprimer'
+    return nfl_zmw2cp
+
+
+def synthetic_links(n_zmws, n_clusters, max_links, seed=0):
+    """Return (all zmws, ZmwClusterLinks of 90% of them to 1..max_links random clusters, int64 consensus primers of clusters)."""
+    rng = np.random.RandomState(seed)
+    zmws = np.arange(n_zmws, dtype=np.int64) * 7 # sorted, unique
+    linked = zmws[rng.rand(n_zmws) < 0.9]
+    n_links = rng.randint(1, max_links + 1, size=len(linked)).astype(np.int64)
+    offsets = np.zeros(len(linked) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(n_links)
+    clusters = rng.randint(0, n_clusters, size=int(offsets[-1])).astype(np.int64)
+    cprimers = rng.choice([0, 1, -1], size=n_clusters, p=[0.45, 0.45, 0.1]).astype(np.int64)
+    rng.shuffle(zmws)
+    return zmws, ZmwClusterLinks(linked, offsets, clusters), cprimers
+
+
+def as_dicts(links, cprimers):
+    """Return (flnc_z2c{zmw: cid}, nfl_z2c{zmw: [cids]}, c2cp{cid: primer or None}) of synthetic links."""
+    clusters, offsets = links.clusters.tolist(), links.offsets.tolist()
+    nfl_z2c = dict([(zmw, ['c%d' % c for c in clusters[s:e]]) for zmw, s, e in zip(links.zmws.tolist(), offsets[:-1], offsets[1:])])
+    flnc_z2c = dict([(zmw, cids[0]) for zmw, cids in nfl_z2c.iteritems()])
+    c2cp = defaultdict(lambda: None)
+    c2cp.update([('c%d' % c, None if cp == -1 else cp) for c, cp in enumerate(cprimers.tolist())])
+    return flnc_z2c, nfl_z2c, c2cp
+
+
+def timed(f, *args):
+    start = time.time()
+    ret = f(*args)
+    return ret, time.time() - start
+
+
+def get_parser():
+    """return arg parser"""
+    desc = """Benchmark batched zmw to consensus primer assignment."""
+    parser = ArgumentParser(description=desc)
+    parser.add_argument("--n_zmws", default="100000,1000000,10000000", help="Comma separated numbers of zmws")
+    parser.add_argument("--zmws_per_cluster", default=10, type=int, help="Number of zmws per cluster")
+    parser.add_argument("--max_links", default=3, type=int, help="Maximum number of clusters of an nfl zmw")
+    parser.add_argument("--reference_max", default=20000, type=int,
+                        help="Also time and check the former per-zmw functions up to this many zmws, they are quadratic")
+    return parser
+
+
+def run(args):
+    print 'n_zmws\tflnc_sec\tnfl_sec\tns_per_zmw\treference_sec'
+    for n_zmws in [int(n) for n in args.n_zmws.split(',')]:
+        zmws, links, cprimers = synthetic_links(n_zmws, max(1, n_zmws / args.zmws_per_cluster), args.max_links)
+        n_values = 2
+        first_links = ZmwClusterLinks(links.zmws, np.arange(len(links) + 1), links.clusters[links.offsets[:-1]])
+        _, t_flnc = timed(assign_first_cluster, zmws, first_links, cprimers)
+        _, t_nfl = timed(assign_most_common, zmws, links, cprimers, n_values, 0.9)
+        t_reference = ''
+        if n_zmws <= args.reference_max:
+            flnc_z2c, nfl_z2c, c2cp = as_dicts(links, cprimers)
+            zmw_list = zmws.tolist()
+            ref_flnc, t_ref_flnc = timed(reference_flnc_zmw_to_consensus_primer, zmw_list, flnc_z2c, c2cp)
+            ref_nfl, t_ref_nfl = timed(reference_nfl_zmw_to_consensus_primer, zmw_list, nfl_z2c, c2cp, get_most_common_item)
+            if ref_flnc != flnc_zmw_to_consensus_primer(zmw_list, flnc_z2c, c2cp):
+                raise ValueError("flnc_zmw_to_consensus_primer disagrees with the reference on %d zmws" % n_zmws)
+            if ref_nfl != nfl_zmw_to_consensus_primer(zmw_list, nfl_z2c, c2cp, consensus='majority'):
+                raise ValueError("nfl_zmw_to_consensus_primer disagrees with the reference on %d zmws" % n_zmws)
+            t_reference = '%.2f' % (t_ref_flnc + t_ref_nfl)
+        print '%d\t%.2f\t%.2f\t%.0f\t%s' % (n_zmws, t_flnc, t_nfl, (t_flnc + t_nfl) / n_zmws * 1e9, t_reference)
+
+
+def main():
+    """main"""
+    sys.exit(run(get_parser().parse_args(sys.argv[1:])))
+
+if __name__ == "__main__":
+    main()
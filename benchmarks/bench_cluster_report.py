@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+Benchmark cluster report parsing throughput in lines per second,
+yield_cluster_report_batches against yield_cluster_report.
+
+    python benchmarks/bench_cluster_report.py --n_lines 50000000
+    python benchmarks/bench_cluster_report.py --cluster_report_fn all.cluster_report.csv --compare
+"""
+import sys
+import os
+import time
+import random
+import tempfile
+from argparse import ArgumentParser
+from debarcode.zmw_table import ZmwTable
+from debarcode.cluster_report import yield_cluster_report_batches
+from debarcode.cluster_to_consensus_primer import yield_cluster_report
+
+
+def write_synthetic_cluster_report(fn, n_lines, reads_per_cluster=20, n_movies=4, seed=0):
+    """Write a cluster report of n_lines reads, in clusters of about reads_per_cluster reads."""
+    rng = random.Random(seed)
+    movies = ['m54000_170101_%06d' % i for i in range(n_movies)]
+    with open(fn, 'w') as writer:
+        writer.write('# synthetic cluster report\ncluster_id,read_id,read_type\n')
+        cid, lines = 0, []
+        for i in xrange(n_lines):
+            if rng.random() < 1.0 / reads_per_cluster:
+                cid += 1
+            lines.append('i0_ICE_sample%06x|c%d,%s/%d/0_%d_CCS,%s\n' %
+                         (cid % 65536, cid, movies[i % n_movies], i, rng.randint(500, 5000), 'FL' if i % 3 else 'NonFL'))
+            if len(lines) == 100000:
+                writer.write(''.join(lines))
+                lines = []
+        writer.write(''.join(lines))
+
+
+def count_batches(fn):
+    n_clusters, n_lines = 0, 0
+    with open(fn, 'r') as reader:
+        for batch in yield_cluster_report_batches(reader, ZmwTable()):
+            n_clusters += len(batch)
+            n_lines += batch.n_reads
+    return n_clusters, n_lines
+
+
+def count_report_objs(fn):
+    n_clusters, n_lines = 0, 0
+    with open(fn, 'r') as reader:
+        for records in yield_cluster_report(reader, ZmwTable()):
+            n_clusters += 1
+            n_lines += len(records)
+    return n_clusters, n_lines
+
+
+def get_parser():
+    """return arg parser"""
+    desc = """Benchmark cluster report parsing throughput."""
+    parser = ArgumentParser(description=desc)
+    parser.add_argument("--cluster_report_fn", default=None, help="Input cluster report, default: write a synthetic one")
+    parser.add_argument("--n_lines", default=50000000, type=int, help="Number of lines of the synthetic cluster report")
+    parser.add_argument("--compare", default=False, action='store_true', help="Also time yield_cluster_report")
+    return parser
+
+
+def run(args):
+    fn = args.cluster_report_fn
+    if fn is None:
+        fn = tempfile.mktemp(suffix='.cluster_report.csv')
+        print 'Writing %s lines to %s' % (args.n_lines, fn)
+        write_synthetic_cluster_report(fn, args.n_lines)
+    try:
+        funcs = [('yield_cluster_report_batches', count_batches)]
+        if args.compare:
+            funcs.append(('yield_cluster_report', count_report_objs))
+        results = []
+        for name, f in funcs:
+            start = time.time()
+            n_clusters, n_lines = f(fn)
+            elapsed = time.time() - start
+            results.append((n_clusters, n_lines))
+            print '%s: %d clusters, %d lines, %.2f sec, %.0f lines/sec' % (name, n_clusters, n_lines, elapsed, n_lines / elapsed)
+        if len(set(results)) != 1:
+            raise ValueError("Parsers disagree on %s: %s" % (fn, results))
+    finally:
+        if args.cluster_report_fn is None:
+            os.remove(fn)
+
+
+def main():
+    """main"""
+    sys.exit(run(get_parser().parse_args(sys.argv[1:])))
+
+if __name__ == "__main__":
+    main()
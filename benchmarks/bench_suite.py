@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+"""
+Time every stage of isoseq-demultiplex on a synthetic dataset (see synthetic.py),
+or on a dataset written earlier with --data_dir, and write results as JSON to
+track regressions between releases.
+
+    python benchmarks/bench_suite.py --n_zmws 1000000 --json_fn bench.json
+    python benchmarks/bench_suite.py --data_dir synthetic_1M --stages z2p,consensus --repeat 3
+
+Stages:
+    z2p                          zmw -> primer of FLNC and NFL FASTA files
+    cluster_report               parse cluster report batches
+    consensus                    consensus primers of clusters
+    z2c                          write binary flnc_z2c and nfl_z2c directories
+    cluster_to_consensus_primer  cluster-to-consensus-primer, writing inputs of the next stage
+    zmw_to_consensus_primer      zmw-to-consensus-primer
+    ice_pickles                  load ICE pickles, z2c and c2z
+    demultiplex                  isoseq-demultiplex run
+"""
+import sys
+import os
+import os.path as op
+import time
+import json
+import shutil
+import platform
+import tempfile
+from argparse import ArgumentParser
+from collections import OrderedDict
+import numpy as np
+import debarcode
+from debarcode.zmw_table import ZmwTable
+from debarcode.utils import zmw_to_primer_from_fastas
+from debarcode.cluster_report import yield_cluster_report_batches
+from debarcode.cluster_to_consensus_primer import (yield_batch_consensus, cluster_to_consensus_primer, add_batch_to_z2c_runs,
+                                                   write_z2c_dir)
+from debarcode.cluster_ids import Z2cStore
+from debarcode.zmw_cluster_runs import ZmwClusterRuns
+from debarcode import zmw_to_consensus_primer
+from debarcode.ice_edges import IceEdges
+from debarcode.pipeline import demultiplex
+from synthetic import read_dataset, add_dataset_arguments, dataset_from_args
+
+BENCH_FORMAT_VERSION = 1
+
+
+class BenchContext(object):
+    """Inputs of stages, and z2p stores shared by stages after z2p."""
+    def __init__(self, dataset, out_dir, threads):
+        self.dataset, self.out_dir, self.threads = dataset, out_dir, threads
+        self._z2p = None
+
+    def z2p(self):
+        """Return (zmw_table, flnc_z2p, nfl_z2p), computed once, outside of timed stages but z2p"""
+        if self._z2p is None:
+            bench_z2p(self)
+        return self._z2p
+
+    def stage_dir(self, name):
+        d = op.join(self.out_dir, name)
+        if op.exists(d):
+            shutil.rmtree(d)
+        os.makedirs(d)
+        return d
+
+
+def bench_z2p(ctx):
+    zmw_table = ZmwTable()
+    flnc_z2p, nfl_z2p = zmw_to_primer_from_fastas([ctx.dataset['flnc_fa_fn'], ctx.dataset['nfl_fa_fn']], zmw_table, threads=ctx.threads)
+    ctx._z2p = (zmw_table, flnc_z2p, nfl_z2p)
+    return len(flnc_z2p) + len(nfl_z2p)
+
+
+def bench_cluster_report(ctx):
+    n_lines = 0
+    with open(ctx.dataset['cluster_report_fn'], 'r') as reader:
+        for batch in yield_cluster_report_batches(reader, ZmwTable()):
+            n_lines += batch.n_reads
+    return n_lines
+
+
+def bench_consensus(ctx):
+    zmw_table, flnc_z2p, nfl_z2p = ctx.z2p()
+    n_clusters = 0
+    for batch, primers, consensus in yield_batch_consensus(ctx.dataset['cluster_report_fn'], flnc_z2p, nfl_z2p, zmw_table, 0.6, ctx.threads):
+        n_clusters += len(batch)
+    return n_clusters
+
+
+def bench_z2c(ctx):
+    out_dir = ctx.stage_dir('z2c')
+    zmw_table = ZmwTable()
+    cids = []
+    with ZmwClusterRuns() as flnc_runs, ZmwClusterRuns() as nfl_runs:
+        with open(ctx.dataset['cluster_report_fn'], 'r') as reader:
+            for batch in yield_cluster_report_batches(reader, zmw_table):
+                add_batch_to_z2c_runs(flnc_runs, nfl_runs, batch, len(cids))
+                cids.extend(batch.cids)
+        write_z2c_dir(flnc_runs, op.join(out_dir, 'flnc_z2c'), cids, zmw_table)
+        write_z2c_dir(nfl_runs, op.join(out_dir, 'nfl_z2c'), cids, zmw_table)
+        return len(flnc_runs) + len(nfl_runs)
+
+
+def bench_cluster_to_consensus_primer(ctx):
+    zmw_table, flnc_z2p, nfl_z2p = ctx.z2p()
+    out_dir = ctx.stage_dir('cluster_to_consensus_primer')
+    cluster_to_consensus_primer(ctx.dataset['cluster_report_fn'], flnc_z2p, nfl_z2p, out_dir, zmw_table, threads=ctx.threads)
+    return len(flnc_z2p) + len(nfl_z2p)
+
+
+def bench_zmw_to_consensus_primer(ctx):
+    c2cp_dir = op.join(ctx.out_dir, 'cluster_to_consensus_primer')
+    if not op.exists(op.join(c2cp_dir, 'cluster_dict')):
+        bench_cluster_to_consensus_primer(ctx)
+    out_dir = ctx.stage_dir('zmw_to_consensus_primer')
+    parser = zmw_to_consensus_primer.get_parser()
+    zmw_to_consensus_primer.run(parser.parse_args([op.join(c2cp_dir, 'flnc_z2c'), op.join(c2cp_dir, 'nfl_z2c'),
+                                                   op.join(c2cp_dir, 'cluster_dict'), out_dir, '--threads', str(ctx.threads)]))
+    return sum([len(Z2cStore(op.join(c2cp_dir, fn), ZmwTable()).last_clusters()[0]) for fn in ['flnc_z2c', 'nfl_z2c']])
+
+
+def bench_ice_pickles(ctx):
+    if 'flnc_pickle_fns' not in ctx.dataset:
+        return None
+    zmw_table = ZmwTable()
+    flnc = IceEdges.from_pickles('flnc', ctx.dataset['flnc_pickle_fns'], zmw_table, threads=ctx.threads)
+    nfl = IceEdges.from_pickles('nfl', ctx.dataset['nfl_pickle_fns'], zmw_table, threads=ctx.threads)
+    flnc.z2c(), flnc.c2z(), nfl.z2c()
+    return len(flnc) + len(nfl)
+
+
+def bench_demultiplex(ctx):
+    out_dir = ctx.stage_dir('demultiplex')
+    flnc_z2cp, nfl_z2cp = demultiplex(ctx.dataset['flnc_fa_fn'], ctx.dataset['nfl_fa_fn'], ctx.dataset['cluster_report_fn'],
+                                      out_dir, ZmwTable(), threads=ctx.threads)
+    return len(flnc_z2cp) + len(nfl_z2cp)
+
+
+STAGES = OrderedDict([
+    ('z2p', bench_z2p),
+    ('cluster_report', bench_cluster_report),
+    ('consensus', bench_consensus),
+    ('z2c', bench_z2c),
+    ('cluster_to_consensus_primer', bench_cluster_to_consensus_primer),
+    ('zmw_to_consensus_primer', bench_zmw_to_consensus_primer),
+    ('ice_pickles', bench_ice_pickles),
+    ('demultiplex', bench_demultiplex),
+])
+
+
+def parse_stages(s):
+    stages = [x.strip() for x in s.split(',') if x.strip()]
+    for stage in stages:
+        if stage not in STAGES:
+            raise ValueError("Unknown stage %s, must be one of %s" % (stage, ','.join(STAGES.keys())))
+    return stages
+
+
+def time_stage(func, ctx, repeat):
+    """Return {seconds, cpu_seconds, items, items_per_sec} of the fastest of repeat runs of func(ctx)"""
+    best = None
+    for _ in range(repeat):
+        start, cpu_start = time.time(), sum(os.times()[:4])
+        items = func(ctx)
+        elapsed, cpu = time.time() - start, sum(os.times()[:4]) - cpu_start
+        if best is None or elapsed < best['seconds']:
+            best = {'seconds': round(elapsed, 4), 'cpu_seconds': round(cpu, 4), 'items': items,
+                    'items_per_sec': round(items / elapsed, 1) if items and elapsed > 0 else None}
+    return best
+
+
+def environment():
+    return {'debarcode': debarcode.get_version(), 'python': platform.python_version(), 'numpy': np.__version__,
+            'platform': platform.platform(), 'processor': platform.processor(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def get_parser():
+    """return arg parser"""
+    desc = """Benchmark stages of isoseq-demultiplex on a synthetic dataset, writing results as JSON."""
+    parser = ArgumentParser(description=desc)
+    parser.add_argument("--data_dir", default=None, help="Dataset written by benchmarks/synthetic.py, default: write one to a temporary directory")
+    add_dataset_arguments(parser)
+    parser.add_argument("--stages", default=','.join(STAGES.keys()), type=parse_stages,
+                        help="Comma separated stages to run, default: all of %s" % ','.join(STAGES.keys()))
+    parser.add_argument("--threads", default=1, type=int, help="Number of processes of stages that take --threads")
+    parser.add_argument("--repeat", default=1, type=int, help="Keep the fastest of this many runs of each stage")
+    parser.add_argument("--json_fn", default=None, help="Output JSON, default: print to stdout")
+    return parser
+
+
+def run(args):
+    tmp_dir = tempfile.mkdtemp(prefix='bench_suite.')
+    try:
+        if args.data_dir is None:
+            data_dir = op.join(tmp_dir, 'data')
+            print 'Writing synthetic dataset of %d zmws to %s' % (args.n_zmws, data_dir)
+            dataset = dataset_from_args(args).write(data_dir)
+        else:
+            dataset = read_dataset(args.data_dir)
+        ctx = BenchContext(dataset, op.join(tmp_dir, 'out'), args.threads)
+        stages = OrderedDict()
+        for stage in args.stages:
+            stages[stage] = time_stage(STAGES[stage], ctx, args.repeat)
+            print 'stage %s: %s' % (stage, json.dumps(stages[stage], sort_keys=True))
+        report = {'version': BENCH_FORMAT_VERSION, 'environment': environment(), 'dataset': dataset['params'],
+                  'threads': args.threads, 'repeat': args.repeat, 'stages': stages}
+    finally:
+        shutil.rmtree(tmp_dir)
+    if args.json_fn is None:
+        print json.dumps(report, indent=2)
+    else:
+        with open(args.json_fn, 'w') as writer:
+            json.dump(report, writer, indent=2)
+        print 'Wrote %s' % args.json_fn
+
+
+def main():
+    """main"""
+    sys.exit(run(get_parser().parse_args(sys.argv[1:])))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+"""
+Benchmark zmw_to_primer_from_fasta (header-only scanner) against
+zmw_to_primer_from_fasta_pbcore (pbcore FastaReader).
+
+    python benchmarks/bench_zmw_to_primer.py --n_reads 1000000
+    python benchmarks/bench_zmw_to_primer.py --fasta_fn flnc.fasta
+"""
+import sys
+import os
+import time
+import random
+import tempfile
+from argparse import ArgumentParser
+from debarcode.utils import zmw_to_primer_from_fasta, zmw_to_primer_from_fasta_pbcore
+from debarcode.zmw_table import ZmwTable
+
+
+def write_synthetic_fasta(fasta_fn, n_reads, read_len, n_movies=4, seed=0):
+    """Write n_reads isoseq_flnc like records with primer= in headers."""
+    rng = random.Random(seed)
+    movies = ['m54000_170101_%06d' % i for i in range(n_movies)]
+    seq = ''.join(rng.choice('ACGT') for _ in range(read_len))
+    lines = '\n'.join([seq[i:i+80] for i in range(0, read_len, 80)])
+    with open(fasta_fn, 'w') as writer:
+        for i in range(n_reads):
+            primer = rng.choice(['0', '1', 'NA'])
+            writer.write('>%s/%d/ccs strand=+;fiveseen=1;polyAseen=1;threeseen=1;fiveend=31;polyAend=%d;threeend=%d;primer=%s;chimera=0\n%s\n' %
+                         (movies[i % n_movies], i, read_len, read_len, primer, lines))
+
+
+def timed(f, *args):
+    start = time.time()
+    ret = f(*args)
+    return ret, time.time() - start
+
+
+def get_parser():
+    """return arg parser"""
+    desc = """Benchmark header-only FASTA primer extraction against pbcore FastaReader."""
+    parser = ArgumentParser(description=desc)
+    parser.add_argument("--fasta_fn", default=None, help="Input FASTA, default: write a synthetic one")
+    parser.add_argument("--n_reads", default=200000, type=int, help="Number of synthetic reads")
+    parser.add_argument("--read_len", default=2000, type=int, help="Length of synthetic reads")
+    parser.add_argument("--threads", default=1, type=int, help="Also time the header scanner with this many processes")
+    parser.add_argument("--skip_pbcore", default=False, action='store_true', help="Only time the header scanner")
+    return parser
+
+
+def run(args):
+    fasta_fn = args.fasta_fn
+    if fasta_fn is None:
+        fasta_fn = tempfile.mktemp(suffix='.fasta')
+        print 'Writing %s reads of length %s to %s' % (args.n_reads, args.read_len, fasta_fn)
+        write_synthetic_fasta(fasta_fn, args.n_reads, args.read_len)
+    try:
+        size_mb = os.path.getsize(fasta_fn) / 1e6
+        z2p, t_scan = timed(zmw_to_primer_from_fasta, fasta_fn, ZmwTable())
+        print 'header scanner: %d zmws, %.2f sec, %.1f MB/sec, store %.1f MB' % (len(z2p), t_scan, size_mb / t_scan, z2p.nbytes / 1e6)
+        if args.threads > 1:
+            z2p_mp, t_mp = timed(zmw_to_primer_from_fasta, fasta_fn, ZmwTable(), args.threads)
+            print 'header scanner, %d processes: %d zmws, %.2f sec, %.1f MB/sec' % (args.threads, len(z2p_mp), t_mp, size_mb / t_mp)
+            if z2p.to_dict() != z2p_mp.to_dict():
+                raise ValueError("zmw_to_primer_from_fasta disagrees with itself using %d processes on %s" % (args.threads, fasta_fn))
+        if not args.skip_pbcore:
+            z2p_pbcore, t_pbcore = timed(zmw_to_primer_from_fasta_pbcore, fasta_fn, ZmwTable())
+            print 'pbcore FastaReader: %d zmws, %.2f sec, %.1f MB/sec' % (len(z2p_pbcore), t_pbcore, size_mb / t_pbcore)
+            if z2p.to_dict() != z2p_pbcore.to_dict():
+                raise ValueError("zmw_to_primer_from_fasta and zmw_to_primer_from_fasta_pbcore disagree on %s" % fasta_fn)
+            print 'speedup: %.1fx' % (t_pbcore / t_scan)
+    finally:
+        if args.fasta_fn is None:
+            os.remove(fasta_fn)
+
+
+def main():
+    """main"""
+    sys.exit(run(get_parser().parse_args(sys.argv[1:])))
+
+if __name__ == "__main__":
+    main()
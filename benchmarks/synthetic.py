@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+"""
+Write a synthetic barcoded Iso-Seq dataset for benchmarks:
+
+    out_dir/
+        flnc.fasta                  one FLNC read per zmw, primer= in headers
+        nfl.fasta                   one NFL read per zmw, primer= in headers
+        all.cluster_report.csv      FLNC reads in one cluster, NFL reads in 1..nfl_multiplicity clusters
+        ice/<c_prefix>.final.pickle         ICE {'d': {read: {cid: weight}}} of FLNC reads of a bin
+        ice/<c_prefix>.partial_uc.pickle    ICE {'partial_uc': {cid: [reads]}} of NFL reads of a bin
+        dataset.json                parameters, and {c_prefix: pickle_fn} of flnc and nfl pickles
+
+Every cluster belongs to one of two samples; reads of a cluster carry the primer
+of its sample, except for a fraction `noise` of reads with the other primer or NA.
+
+    python benchmarks/synthetic.py out_dir --n_zmws 1000000 --n_clusters 50000
+"""
+import sys
+import os
+import os.path as op
+import json
+import cPickle
+from collections import defaultdict
+from argparse import ArgumentParser
+import numpy as np
+
+PRIMERS = ['0', '1', 'NA']
+WRITE_CHUNK_SIZE = 100000 # lines formatted per write
+
+
+def movie_names(n_movies):
+    return ['m54000_170101_%06d' % i for i in range(n_movies)]
+
+
+def c_prefix_of_bin(i):
+    return '%dto%dkb_part0' % (i, i + 1)
+
+
+def cid_of_cluster(c_prefix_idx, c_id):
+    """cluster_id of a cluster in the cluster report"""
+    return 'i%d_ICE_sample%02x|c%d' % (c_prefix_idx, c_id % 256, c_id)
+
+
+class SyntheticDataset(object):
+    """Reads, primers and clusters of a synthetic dataset, as numpy arrays.
+    Zmws 0..n_flnc-1 have FLNC reads, zmws n_flnc..n_zmws-1 have NFL reads,
+    zmw i is zmw i of movie i % n_movies.
+    """
+    def __init__(self, n_movies=4, n_zmws=100000, n_clusters=5000, nfl_multiplicity=3, flnc_fraction=0.6,
+                 n_bins=4, noise=0.1, read_len=100, seed=0):
+        self.params = dict(n_movies=n_movies, n_zmws=n_zmws, n_clusters=n_clusters, nfl_multiplicity=nfl_multiplicity,
+                           flnc_fraction=flnc_fraction, n_bins=n_bins, noise=noise, read_len=read_len, seed=seed)
+        rng = np.random.RandomState(seed)
+        self.movies = movie_names(n_movies)
+        self.n_zmws, self.n_clusters, self.n_bins, self.read_len = n_zmws, n_clusters, n_bins, read_len
+        self.n_flnc = int(n_zmws * flnc_fraction)
+        self.cluster_samples = rng.randint(0, 2, size=n_clusters)
+        # FLNC zmw -> one cluster
+        self.flnc_clusters = rng.randint(0, n_clusters, size=self.n_flnc)
+        # NFL zmw -> 1..nfl_multiplicity clusters
+        n_nfl = n_zmws - self.n_flnc
+        n_links = rng.randint(1, nfl_multiplicity + 1, size=n_nfl)
+        self.nfl_link_zmws = np.repeat(np.arange(self.n_flnc, n_zmws), n_links)
+        self.nfl_link_clusters = rng.randint(0, n_clusters, size=len(self.nfl_link_zmws))
+        # primer of a zmw: sample of its (first) cluster, or noise
+        first_cluster = np.concatenate([self.flnc_clusters, self.nfl_link_clusters[np.cumsum(n_links) - n_links]])
+        self.primers = self.cluster_samples[first_cluster]
+        noisy = rng.rand(n_zmws) < noise
+        self.primers[noisy] = rng.randint(0, 3, size=int(noisy.sum())) # 2 is NA
+        self.weights = -rng.exponential(100.0, size=self.n_flnc)
+
+    def read_names(self, zmws):
+        """Read names of zmws, e.g., m54000_170101_000001/5/0_100_CCS"""
+        return ['%s/%d/0_%d_CCS' % (self.movies[z % len(self.movies)], z, self.read_len) for z in zmws.tolist()]
+
+    def write_fasta(self, fasta_fn, zmws):
+        seq = ''.join(np.random.RandomState(self.params['seed']).choice(list('ACGT'), size=self.read_len))
+        with open(fasta_fn, 'w') as writer:
+            for start in xrange(0, len(zmws), WRITE_CHUNK_SIZE):
+                chunk = zmws[start:start+WRITE_CHUNK_SIZE]
+                writer.write(''.join(['>%s strand=+;fiveseen=1;polyAseen=1;threeseen=1;fiveend=31;polyAend=%d;threeend=%d;primer=%s;chimera=0\n%s\n' %
+                                      (name, self.read_len, self.read_len, PRIMERS[p], seq)
+                                      for name, p in zip(self.read_names(chunk), self.primers[chunk].tolist())]))
+
+    def cluster_links(self):
+        """Return (cluster, zmw, is_fl) of all reads in clusters, sorted by cluster, FLNC reads first"""
+        clusters = np.concatenate([self.flnc_clusters, self.nfl_link_clusters])
+        zmws = np.concatenate([np.arange(self.n_flnc), self.nfl_link_zmws])
+        is_fl = np.arange(len(zmws)) < self.n_flnc
+        order = np.lexsort((~is_fl, clusters))
+        return clusters[order], zmws[order], is_fl[order]
+
+    def write_cluster_report(self, fn):
+        clusters, zmws, is_fl = self.cluster_links()
+        with open(fn, 'w') as writer:
+            writer.write('# synthetic cluster report\ncluster_id,read_id,read_type\n')
+            for start in xrange(0, len(zmws), WRITE_CHUNK_SIZE):
+                end = start + WRITE_CHUNK_SIZE
+                writer.write(''.join(['%s,%s,%s\n' % (cid_of_cluster(c % self.n_bins, c), name, 'FL' if fl else 'NonFL')
+                                      for c, name, fl in zip(clusters[start:end].tolist(), self.read_names(zmws[start:end]),
+                                                             is_fl[start:end].tolist())]))
+
+    def write_ice_pickles(self, ice_dir):
+        """Write final.pickle and partial_uc pickle of every bin, return ({c_prefix: flnc pickle}, {c_prefix: nfl pickle})"""
+        if not op.exists(ice_dir):
+            os.makedirs(ice_dir)
+        flnc_d = [{} for _ in range(self.n_bins)]
+        for name, c, w in zip(self.read_names(np.arange(self.n_flnc)), self.flnc_clusters.tolist(), self.weights.tolist()):
+            flnc_d[c % self.n_bins][name] = {c: w}
+        partial_uc = [defaultdict(lambda: []) for _ in range(self.n_bins)]
+        for name, c in zip(self.read_names(self.nfl_link_zmws), self.nfl_link_clusters.tolist()):
+            partial_uc[c % self.n_bins][c].append(name)
+        flnc_fns, nfl_fns = {}, {}
+        for i in range(self.n_bins):
+            c_prefix = c_prefix_of_bin(i)
+            flnc_fns[c_prefix] = op.join(ice_dir, c_prefix + '.final.pickle')
+            nfl_fns[c_prefix] = op.join(ice_dir, c_prefix + '.partial_uc.pickle')
+            with open(flnc_fns[c_prefix], 'wb') as writer:
+                cPickle.dump({'d': flnc_d[i]}, writer, cPickle.HIGHEST_PROTOCOL)
+            with open(nfl_fns[c_prefix], 'wb') as writer:
+                cPickle.dump({'partial_uc': dict(partial_uc[i])}, writer, cPickle.HIGHEST_PROTOCOL)
+        return flnc_fns, nfl_fns
+
+    def write(self, out_dir, ice=True):
+        """Write all files of the dataset to out_dir, return the dataset.json dict"""
+        if not op.exists(out_dir):
+            os.makedirs(out_dir)
+        d = {'params': self.params,
+             'flnc_fa_fn': op.join(out_dir, 'flnc.fasta'), 'nfl_fa_fn': op.join(out_dir, 'nfl.fasta'),
+             'cluster_report_fn': op.join(out_dir, 'all.cluster_report.csv')}
+        self.write_fasta(d['flnc_fa_fn'], np.arange(self.n_flnc))
+        self.write_fasta(d['nfl_fa_fn'], np.arange(self.n_flnc, self.n_zmws))
+        self.write_cluster_report(d['cluster_report_fn'])
+        if ice:
+            d['flnc_pickle_fns'], d['nfl_pickle_fns'] = self.write_ice_pickles(op.join(out_dir, 'ice'))
+        with open(op.join(out_dir, 'dataset.json'), 'w') as writer:
+            json.dump(d, writer, indent=2, sort_keys=True)
+        return d
+
+
+def read_dataset(out_dir):
+    """Return the dataset.json dict of a dataset written by SyntheticDataset.write"""
+    with open(op.join(out_dir, 'dataset.json'), 'r') as reader:
+        return json.load(reader)
+
+
+def add_dataset_arguments(parser):
+    """Add scale of a synthetic dataset to an argument parser"""
+    parser.add_argument("--n_movies", default=4, type=int, help="Number of movies")
+    parser.add_argument("--n_zmws", default=100000, type=int, help="Number of zmws, each with one FLNC or NFL read")
+    parser.add_argument("--n_clusters", default=5000, type=int, help="Number of clusters")
+    parser.add_argument("--nfl_multiplicity", default=3, type=int, help="Maximum number of clusters of an NFL read")
+    parser.add_argument("--flnc_fraction", default=0.6, type=float, help="Fraction of zmws with FLNC reads")
+    parser.add_argument("--n_bins", default=4, type=int, help="Number of ICE c_prefix bins")
+    parser.add_argument("--noise", default=0.1, type=float, help="Fraction of reads with a random primer or NA")
+    parser.add_argument("--read_len", default=100, type=int, help="Length of reads")
+    parser.add_argument("--seed", default=0, type=int, help="Random seed")
+
+
+def dataset_from_args(args):
+    return SyntheticDataset(n_movies=args.n_movies, n_zmws=args.n_zmws, n_clusters=args.n_clusters,
+                            nfl_multiplicity=args.nfl_multiplicity, flnc_fraction=args.flnc_fraction, n_bins=args.n_bins,
+                            noise=args.noise, read_len=args.read_len, seed=args.seed)
+
+
+def get_parser():
+    """return arg parser"""
+    desc = """Write a synthetic barcoded Iso-Seq dataset: FASTA files, a cluster report and ICE pickles."""
+    parser = ArgumentParser(description=desc)
+    parser.add_argument("out_dir", help="Output directory")
+    add_dataset_arguments(parser)
+    parser.add_argument("--no_ice", default=False, action='store_true', help="Do not write ICE pickles")
+    return parser
+
+
+def run(args):
+    d = dataset_from_args(args).write(args.out_dir, ice=not args.no_ice)
+    print 'Wrote %s' % op.join(args.out_dir, 'dataset.json')
+
+
+def main():
+    """main"""
+    sys.exit(run(get_parser().parse_args(sys.argv[1:])))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""
+Batched assignment of zmws to consensus primers of their clusters.
+
+flnc_zmw_to_consensus_primer and nfl_zmw_to_consensus_primer used to look zmws
+up one at a time. Here zmw -> cluster links are kept as ZmwClusterLinks, i.e.,
+sorted encoded zmws with CSR offsets into int64 cluster codes, and consensus
+primers of clusters as an array indexed by cluster code, so that all zmws are
+joined at once with searchsorted, and the most common consensus primer of
+zmws in many clusters is taken with one bincount, or with one weighted
+bincount when votes of clusters are weighted by the read support of their
+consensus primers. Work is linear in the number of zmws and links, besides
+sorting zmws of the links once.
+
+Assignments are int64 codes: an index into ClusterCodes.values for a primer,
+or one of NO_CONSENSUS, CID_NO_CPRIMER and NO_CID_NO_CPRIMER.
+"""
+from collections import defaultdict
+import numpy as np
+from .primer_store import searchsorted_keys
+from .cluster_ids import ClusterIds, NO_CLUSTER
+from .consensus import has_min_fraction
+
+NO_CONSENSUS = -1 # the consensus function returned None
+CID_NO_CPRIMER = -2 # zmw in clusters, none of which has a consensus primer
+NO_CID_NO_CPRIMER = -3 # zmw in no cluster
+
+
+class ClusterCodes(object):
+    """Integer codes of cids in c2cp{cid: consensus_primer or None}, and codes of their consensus primers.
+    cids not in c2cp share the last code, whose consensus primer is None, as in a defaultdict c2cp.
+    ...doctest:
+        >>> c = ClusterCodes({'c1': 1, 'c0': 0, 'c2': None})
+        >>> c.values, c.cprimers[c.codes(['c0', 'c1', 'c2', 'cx'])].tolist()
+        ([0, 1], [0, 1, -1, -1])
+    """
+    def __init__(self, c2cp):
+        self.cluster_ids = ClusterIds(c2cp.keys())
+        self.cids = self.cluster_ids.names
+        self.values = sorted(set([cp for cp in c2cp.values() if cp is not None]))
+        value_codes = dict(zip(self.values, xrange(len(self.values))))
+        self.cprimers = np.array([NO_CONSENSUS if c2cp[cid] is None else value_codes[c2cp[cid]] for cid in self.cids] + [NO_CONSENSUS],
+                                 dtype=np.int64)
+
+    def codes(self, cids):
+        codes = self.cluster_ids.lookup(cids).astype(np.int64)
+        codes[codes == NO_CLUSTER] = len(self.cids)
+        return codes
+
+    def weights(self, c2w):
+        """Return float64 weights of clusters by code, from c2w{cid: weight}, 1.0 for cids not in c2w.
+        ...doctest:
+            >>> c = ClusterCodes({'c0': 0, 'c1': 1})
+            >>> c.weights({'c1': 0.5})[c.codes(['c0', 'c1', 'cx'])].tolist()
+            [1.0, 0.5, 1.0]
+        """
+        return np.array([c2w.get(cid, 1.0) for cid in self.cids] + [1.0], dtype=np.float64)
+
+
+class ZmwClusterLinks(object):
+    """Clusters of zmws in CSR layout: clusters of zmws[i] are clusters[offsets[i]:offsets[i+1]].
+    ...doctest:
+        >>> codes = ClusterCodes({'c0': 0, 'c1': None})
+        >>> links = ZmwClusterLinks.from_dict({7: ['c1', 'c0'], 3: 'c0', 5: None, 9: []}, codes)
+        >>> links.zmws.tolist(), links.offsets.tolist(), [codes.cids[c] for c in links.clusters]
+        ([3, 5, 7, 9], [0, 1, 1, 3, 3], ['c0', 'c1', 'c0'])
+        >>> found, rows = links.lookup([7, 4, 3])
+        >>> found.tolist(), rows[found].tolist()
+        ([True, False, True], [2, 0])
+    """
+    def __init__(self, zmws, offsets, clusters):
+        """zmws must be sorted and unique"""
+        self.zmws = np.asarray(zmws, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.clusters = np.asarray(clusters, dtype=np.int64)
+
+    @classmethod
+    def from_dict(cls, z2c, cluster_codes):
+        """Build links from z2c{encoded_zmw: cid, [cids] or None} and ClusterCodes of cids."""
+        zmws = np.fromiter(z2c.iterkeys(), dtype=np.int64, count=len(z2c))
+        cids, n_links = [], np.zeros(len(z2c), dtype=np.int64)
+        for i, c in enumerate(z2c.itervalues()):
+            if c is None or len(c) == 0:
+                continue
+            if isinstance(c, list):
+                cids.extend(c)
+                n_links[i] = len(c)
+            else:
+                cids.append(c)
+                n_links[i] = 1
+        clusters = cluster_codes.codes(cids)
+        order = np.argsort(zmws, kind='mergesort')
+        starts = np.cumsum(n_links) - n_links
+        n_links = n_links[order]
+        offsets = np.zeros(len(zmws) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(n_links)
+        # position in clusters of every link, in sorted zmw order
+        link_idxs = np.repeat(starts[order] - offsets[:-1], n_links) + np.arange(offsets[-1], dtype=np.int64)
+        return cls(zmws[order], offsets, clusters[link_idxs])
+
+    def __len__(self):
+        return len(self.zmws)
+
+    @property
+    def n_links(self):
+        return np.diff(self.offsets)
+
+    def lookup(self, zmws):
+        """Return (bool array of zmws with at least one cluster, row of every found zmw in links)"""
+        zmws = np.asarray(zmws, dtype=np.int64)
+        if len(self.zmws) == 0:
+            return np.zeros(len(zmws), dtype=bool), np.zeros(len(zmws), dtype=np.int64)
+        rows = np.minimum(searchsorted_keys(self.zmws, zmws), len(self.zmws) - 1)
+        found = (self.zmws[rows] == zmws) & (self.n_links[rows] > 0)
+        return found, rows
+
+
+def assign_first_cluster(zmws, links, cprimers):
+    """Assign every zmw the consensus primer of its first cluster, as flnc_zmw_to_consensus_primer.
+    ...doctest:
+        >>> links = ZmwClusterLinks([3, 5, 7], [0, 1, 2, 2], [0, 1])
+        >>> assign_first_cluster([3, 5, 7, 9], links, np.array([1, -1])).tolist()
+        [1, -2, -3, -3]
+    """
+    found, rows = links.lookup(zmws)
+    assigned = np.full(len(found), NO_CID_NO_CPRIMER, dtype=np.int64)
+    cps = cprimers[links.clusters[links.offsets[rows[found]]]]
+    assigned[found] = np.where(cps == NO_CONSENSUS, CID_NO_CPRIMER, cps)
+    return assigned
+
+
+def _found_links(zmws, links, cprimers):
+    """Return (found, index among found zmws of every link of found zmws, consensus primer of the link,
+    cluster code of the link), only keeping links to clusters with a consensus primer."""
+    found, rows = links.lookup(zmws)
+    rows = rows[found]
+    n_links = links.n_links[rows]
+    starts = links.offsets[rows]
+    link_rows = np.repeat(np.arange(len(rows), dtype=np.int64), n_links)
+    link_idxs = np.repeat(starts - (np.cumsum(n_links) - n_links), n_links) + np.arange(int(n_links.sum()), dtype=np.int64)
+    clusters = links.clusters[link_idxs]
+    cps = cprimers[clusters]
+    has_cp = cps != NO_CONSENSUS
+    return found, link_rows[has_cp], cps[has_cp], clusters[has_cp]
+
+
+def _assign_best(found, link_rows, cps, n_values, min_fraction, weights=None):
+    """Assign every found zmw the consensus primer with the most (weighted) votes of its links,
+    if it has >= min_fraction of all votes, see consensus.has_min_fraction."""
+    n_found = int(found.sum())
+    counts = np.bincount(link_rows * n_values + cps, weights=weights, minlength=n_found * n_values).reshape(n_found, n_values)
+    assigned = np.full(len(found), NO_CID_NO_CPRIMER, dtype=np.int64)
+    found_assigned = np.full(n_found, CID_NO_CPRIMER, dtype=np.int64)
+    if n_values > 0:
+        totals = counts.sum(axis=1)
+        best = counts.argmax(axis=1) # ties go to the smallest primer, as Counter.most_common does for small ints
+        best_counts = counts[np.arange(n_found), best]
+        no_links = np.bincount(link_rows, minlength=n_found) == 0
+        found_assigned = np.where(no_links, CID_NO_CPRIMER, np.where(has_min_fraction(best_counts, totals, min_fraction), best, NO_CONSENSUS))
+    assigned[found] = found_assigned
+    return assigned
+
+
+def assign_most_common(zmws, links, cprimers, n_values, min_fraction):
+    """Assign every zmw the most common consensus primer of its clusters, if it is >= min_fraction of
+    consensus primers of its clusters, as nfl_zmw_to_consensus_primer with get_most_common_item.
+    ...doctest:
+        >>> links = ZmwClusterLinks([1, 2, 3, 4], [0, 3, 5, 5, 6], [0, 1, 2, 0, 3, 4])
+        >>> cprimers = np.array([0, 0, 0, 1, -1])
+        >>> assign_most_common([1, 2, 3, 4, 5], links, cprimers, 2, 0.9).tolist()
+        [0, -1, -3, -2, -3]
+    """
+    found, link_rows, cps, clusters = _found_links(zmws, links, cprimers)
+    return _assign_best(found, link_rows, cps, n_values, min_fraction)
+
+
+def assign_weighted(zmws, links, cprimers, cweights, n_values, min_fraction):
+    """Assign every zmw the consensus primer of its clusters with the most votes, where clusters vote with
+    weights cweights by cluster code, e.g., read support of their consensus primers, if it has >= min_fraction
+    of all votes. With equal weights, this is assign_most_common.
+    ...doctest:
+        >>> links = ZmwClusterLinks([1, 2, 3], [0, 3, 5, 6], [0, 1, 2, 0, 3, 4])
+        >>> cprimers, cweights = np.array([0, 0, 1, 1, -1]), np.array([0.95, 0.9, 0.1, 0.6, 1.0])
+        >>> assign_weighted([1, 2, 3, 4], links, cprimers, cweights, 2, 0.9).tolist()
+        [0, -1, -2, -3]
+        >>> assign_most_common([1, 2, 3, 4], links, cprimers, 2, 0.9).tolist()
+        [-1, -1, -2, -3]
+        >>> links = ZmwClusterLinks([1], [0, 10], range(10)) # 9 of 10 equal votes sum to a hair under 0.9 of all
+        >>> assign_weighted([1], links, np.array([0] * 9 + [1]), np.full(10, 0.97), 2, 0.9).tolist()
+        [0]
+    """
+    found, link_rows, cps, clusters = _found_links(zmws, links, cprimers)
+    return _assign_best(found, link_rows, cps, n_values, min_fraction, weights=np.asarray(cweights, dtype=np.float64)[clusters])
+
+
+def assign_by_func(zmws, links, cprimers, values, get_consensus_func):
+    """Assign every zmw get_consensus_func of consensus primers of its clusters, for any get_consensus_func.
+    Links are still joined at once, only get_consensus_func is called per zmw. Return values that are not
+    in values, e.g., labels of mixed clusters, are appended to values, so that their codes decode to them.
+    ...doctest:
+        >>> links = ZmwClusterLinks([1, 2], [0, 2, 3], [0, 1, 2])
+        >>> assign_by_func([1, 2, 3], links, np.array([0, 1, -1]), ['a', 'b'], lambda items: items[-1]).tolist()
+        [1, -2, -3]
+        >>> values = ['a', 'b']
+        >>> assigned = assign_by_func([1, 2], links, np.array([0, 1, -1]), values, lambda items: 'mixed')
+        >>> assigned.tolist(), decode_assignments(assigned, values)
+        ([2, -2], ['mixed', 'cid_no_cprimer'])
+    """
+    found, link_rows, cps, clusters = _found_links(zmws, links, cprimers)
+    value_codes = dict(zip(values, xrange(len(values))))
+    n_found = int(found.sum())
+    bounds = np.searchsorted(link_rows, np.arange(n_found + 1)).tolist()
+    cps = cps.tolist()
+    found_assigned = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        if start == end:
+            found_assigned.append(CID_NO_CPRIMER)
+        else:
+            cp = get_consensus_func([values[c] for c in cps[start:end]])
+            if cp is not None and cp not in value_codes:
+                value_codes[cp] = len(values)
+                values.append(cp)
+            found_assigned.append(NO_CONSENSUS if cp is None else value_codes[cp])
+    assigned = np.full(len(found), NO_CID_NO_CPRIMER, dtype=np.int64)
+    assigned[found] = found_assigned
+    return assigned
+
+
+def decode_assignments(assigned, values, no_cid_label='no_cid_no_cprimer'):
+    """Return list of consensus primers or category labels of assignment codes.
+    ...doctest:
+        >>> decode_assignments(np.array([1, -1, -2, -3]), ['a', 'b'])
+        ['b', None, 'cid_no_cprimer', 'no_cid_no_cprimer']
+    """
+    labels = {NO_CONSENSUS: None, CID_NO_CPRIMER: 'cid_no_cprimer', NO_CID_NO_CPRIMER: no_cid_label}
+    return [values[a] if a >= 0 else labels[a] for a in assigned.tolist()]
+
+
+def zmw_to_consensus_primer_dict(zmws, assigned, values, no_cid_label='no_cid_no_cprimer'):
+    """Return defaultdict{zmw: consensus primer or category label}."""
+    z2cp = defaultdict(lambda: None)
+    z2cp.update(zip(zmws, decode_assignments(assigned, values, no_cid_label)))
+    return z2cp
@@ -0,0 +1,158 @@
+"""
+Background threads overlapping I/O of a stage with its compute.
+
+prefetch(iterable) runs a producer, e.g., reading and parsing blocks of the
+cluster report, in a reader thread that keeps at most `depth` items ahead of
+the consumer in a bounded queue, and BackgroundWriter runs writes, e.g., of
+cluster_dict columns, in a writer thread in submission order, at most
+`depth` writes behind. Blocking file reads and writes release the GIL, so on
+slow or networked storage their waits overlap with the compute of the main
+thread instead of adding to it. Exceptions of either thread are re-raised in
+the main thread.
+"""
+import sys
+import threading
+import Queue
+
+PREFETCH_DEPTH = 4 # items a reader thread keeps ahead of its consumer
+WRITE_QUEUE_DEPTH = 16 # writes a writer thread may lag behind
+PREFETCH_BLOCK_SIZE = 4 * 1024 * 1024 # bytes of a prefetched block of lines
+_POLL_SECONDS = 0.1 # how often a blocked producer checks whether its consumer is gone
+
+_DONE = object()
+
+
+def _put(queue, item, stop):
+    """Put item to a bounded queue, unless stop is set while waiting; return False if stopped"""
+    while not stop.is_set():
+        try:
+            queue.put(item, timeout=_POLL_SECONDS)
+            return True
+        except Queue.Full:
+            pass
+    return False
+
+
+def prefetch(iterable, depth=PREFETCH_DEPTH):
+    """Yield items of iterable, produced by a reader thread at most depth items ahead.
+    ...doctest:
+        >>> list(prefetch(xrange(5), depth=2))
+        [0, 1, 2, 3, 4]
+        >>> def fail():
+        ...     yield 1
+        ...     raise KeyError(7)
+        >>> list(prefetch(fail()))
+        Traceback (most recent call last):
+        ...
+        KeyError: 7
+    """
+    queue, stop = Queue.Queue(maxsize=max(1, depth)), threading.Event()
+
+    def produce():
+        try:
+            for item in iterable:
+                if not _put(queue, (item, None), stop):
+                    return
+            _put(queue, (_DONE, None), stop)
+        except BaseException:
+            _put(queue, (_DONE, sys.exc_info()), stop)
+
+    thread = threading.Thread(target=produce, name='prefetch')
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            item, exc_info = queue.get()
+            if item is _DONE:
+                if exc_info is not None:
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                break
+            yield item
+    finally:
+        stop.set() # lets the reader thread exit if the consumer stops early
+        thread.join()
+
+
+def yield_file_blocks(fn, block_size=PREFETCH_BLOCK_SIZE):
+    """Yield blocks of about block_size bytes of fn, each ending at the end of a line"""
+    with open(fn, 'rb') as reader:
+        while True:
+            block = reader.read(block_size)
+            if not block:
+                break
+            if not block.endswith('\n'):
+                block += reader.readline()
+            yield block
+
+
+def yield_prefetched_lines(fn, block_size=PREFETCH_BLOCK_SIZE, depth=PREFETCH_DEPTH):
+    """Yield lines of fn, including newlines, read in blocks by a reader thread.
+    ...doctest:
+        >>> import tempfile, os
+        >>> fn = tempfile.mktemp()
+        >>> open(fn, 'w').write('a\\nbb\\nccc\\nd')
+        >>> list(yield_prefetched_lines(fn, block_size=3))
+        ['a\\n', 'bb\\n', 'ccc\\n', 'd']
+        >>> os.remove(fn)
+    """
+    for block in prefetch(yield_file_blocks(fn, block_size), depth):
+        for line in block.splitlines(True):
+            yield line
+
+
+class BackgroundWriter(object):
+    """Run func(*args) of submit(func, *args) in a writer thread, in submission order,
+    with at most depth submissions waiting. close() waits for all of them, and re-raises
+    the first exception of the writer thread, which is also raised by the next submit.
+    ...doctest:
+        >>> out = []
+        >>> writer = BackgroundWriter(depth=1)
+        >>> for i in range(5):
+        ...     writer.submit(out.append, i)
+        >>> writer.close()
+        >>> out
+        [0, 1, 2, 3, 4]
+    """
+    def __init__(self, depth=WRITE_QUEUE_DEPTH):
+        self.queue = Queue.Queue(maxsize=max(1, depth))
+        self.exc_info = None
+        self.thread = threading.Thread(target=self._run, name='writer')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            task = self.queue.get()
+            if task is _DONE:
+                return
+            if self.exc_info is None: # drop writes after an error, close() raises it
+                try:
+                    func, args = task
+                    func(*args)
+                except BaseException:
+                    self.exc_info = sys.exc_info()
+
+    def _raise(self):
+        if self.exc_info is not None:
+            exc_info, self.exc_info = self.exc_info, None
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def submit(self, func, *args):
+        self._raise()
+        self.queue.put((func, args))
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(_DONE)
+            self.thread.join()
+        self._raise()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.close()
+        else: # finish queued writes, but keep the exception of the main thread
+            self.queue.put(_DONE)
+            self.thread.join()
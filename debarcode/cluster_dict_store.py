@@ -0,0 +1,200 @@
+"""
+Binary columnar cluster_dict format.
+
+A cluster_dict directory keeps one raw binary file per column, in CSR layout:
+reads of the i-th cluster are flnc_zmws[flnc_offsets[i]:flnc_offsets[i+1]]
+and nfl_zmws[nfl_offsets[i]:nfl_offsets[i+1]], next to their int8 primers
+(NO_PRIMER for None), and consensus[i] is the consensus primer of the cluster.
+Cluster ids are kept as a byte blob with offsets. Columns are appended batch
+by batch by ClusterDictWriter and memory-mapped by ClusterDictStore, so
+reading a cluster_dict does not parse or copy anything.
+
+    cluster_dict/
+        meta.json       number of clusters and dtypes of columns
+        movies.txt      ZmwTable of encoded zmws
+        <column>.bin    raw column data
+"""
+import os
+import os.path as op
+import json
+from collections import defaultdict
+import numpy as np
+from .zmw_table import ZmwTable
+from .primer_store import int8_to_primer
+
+CLUSTER_DICT_FORMAT_VERSION = 1
+
+CLUSTER_DICT_COLUMNS = [
+    ('cid_offsets', np.int64),
+    ('cid_chars', np.uint8),
+    ('flnc_offsets', np.int64),
+    ('flnc_zmws', np.int64),
+    ('flnc_primers', np.int8),
+    ('nfl_offsets', np.int64),
+    ('nfl_zmws', np.int64),
+    ('nfl_primers', np.int8),
+    ('consensus', np.int8),
+]
+
+
+def is_cluster_dict_dir(path):
+    """Return True if path is a binary cluster_dict directory rather than a cluster_dict.csv"""
+    return op.isdir(path) and op.exists(op.join(path, 'meta.json'))
+
+
+def remove_meta_json(path):
+    """Remove meta.json of a binary directory about to be rewritten, so that an interrupted
+    rewrite is not taken for a complete directory."""
+    meta_fn = op.join(path, 'meta.json')
+    if op.exists(meta_fn):
+        os.remove(meta_fn)
+
+
+def write_meta_json(path, meta):
+    """Write meta.json of a binary directory last, through a temporary file renamed into place.
+    ...doctest:
+        >>> import tempfile, shutil
+        >>> d = tempfile.mkdtemp()
+        >>> write_meta_json(d, {'version': 1})
+        >>> is_cluster_dict_dir(d), os.listdir(d)
+        (True, ['meta.json'])
+        >>> remove_meta_json(d)
+        >>> is_cluster_dict_dir(d)
+        False
+        >>> shutil.rmtree(d)
+    """
+    tmp_fn = op.join(path, '.meta.json.tmp')
+    with open(tmp_fn, 'w') as writer:
+        json.dump(meta, writer, indent=2, sort_keys=True)
+    os.rename(tmp_fn, op.join(path, 'meta.json'))
+
+
+def _csr_offsets(counts, start):
+    """
+    ...doctest:
+        >>> _csr_offsets(np.array([2, 0, 1]), 10).tolist()
+        [12, 12, 13]
+    """
+    return start + np.cumsum(counts, dtype=np.int64)
+
+
+class ClusterDictWriter(object):
+    """Append batches of clusters to a binary cluster_dict directory.
+    ...doctest:
+        >>> import tempfile, shutil
+        >>> d = tempfile.mkdtemp()
+        >>> w = ClusterDictWriter(op.join(d, 'cluster_dict'))
+        >>> w.write(['c1', 'c2'], [0, 3, 4], [1, 2, 3, 4], [True, False, True, True], [0, 1, -1, 0], [0, 0])
+        >>> w.write(['c3'], [0, 1], [5], [False], [1], [-1])
+        >>> w.close(ZmwTable(['m']))
+        >>> s = ClusterDictStore(op.join(d, 'cluster_dict'))
+        >>> len(s), s.cids, s.consensus.tolist()
+        (3, ['c1', 'c2', 'c3'], [0, 0, -1])
+        >>> [(cid, f.tolist(), n.tolist(), fp.tolist(), np_.tolist(), cp) for cid, f, n, fp, np_, cp in s]
+        [('c1', [1, 3], [2], [0, -1], [1], 0), ('c2', [4], [], [0], [], 0), ('c3', [], [5], [], [1], None)]
+        >>> sorted(s.c2cp().items())
+        [('c1', 0), ('c2', 0), ('c3', None)]
+        >>> shutil.rmtree(d)
+    """
+    def __init__(self, path):
+        self.path = path
+        if not op.exists(path):
+            os.makedirs(path)
+        remove_meta_json(path) # column files are truncated below, meta.json is written last by close()
+        self.writers = dict([(name, open(op.join(path, name + '.bin'), 'wb')) for name, dtype in CLUSTER_DICT_COLUMNS])
+        self.n_clusters, self.n_cid_chars, self.n_flnc, self.n_nfl = 0, 0, 0, 0
+        self._write_column('cid_offsets', [0])
+        self._write_column('flnc_offsets', [0])
+        self._write_column('nfl_offsets', [0])
+
+    def _write_column(self, name, arr):
+        np.asarray(arr, dtype=dict(CLUSTER_DICT_COLUMNS)[name]).tofile(self.writers[name])
+
+    def write(self, cids, offsets, zmws, is_fl, primers, consensus):
+        """Append consecutive clusters, given in the CSR layout of ClusterReportBatch:
+        reads of the i-th cluster are zmws[offsets[i]:offsets[i+1]] with int8 primers,
+        is_fl marks flnc reads, and consensus is the int8 consensus primer of each cluster.
+        """
+        offsets = np.asarray(offsets, dtype=np.int64)
+        zmws, is_fl, primers = np.asarray(zmws, dtype=np.int64), np.asarray(is_fl, dtype=bool), np.asarray(primers, dtype=np.int8)
+        cluster_idxs = np.repeat(np.arange(len(cids)), np.diff(offsets))
+        n_flnc = np.bincount(cluster_idxs[is_fl], minlength=len(cids))
+        n_nfl = np.bincount(cluster_idxs[~is_fl], minlength=len(cids))
+        cid_lens = np.array([len(cid) for cid in cids], dtype=np.int64)
+
+        self._write_column('cid_offsets', _csr_offsets(cid_lens, self.n_cid_chars))
+        self.writers['cid_chars'].write(''.join(cids))
+        self._write_column('flnc_offsets', _csr_offsets(n_flnc, self.n_flnc))
+        self._write_column('flnc_zmws', zmws[is_fl])
+        self._write_column('flnc_primers', primers[is_fl])
+        self._write_column('nfl_offsets', _csr_offsets(n_nfl, self.n_nfl))
+        self._write_column('nfl_zmws', zmws[~is_fl])
+        self._write_column('nfl_primers', primers[~is_fl])
+        self._write_column('consensus', consensus)
+
+        self.n_clusters += len(cids)
+        self.n_cid_chars += int(cid_lens.sum())
+        self.n_flnc += int(is_fl.sum())
+        self.n_nfl += len(is_fl) - int(is_fl.sum())
+
+    def close(self, zmw_table):
+        """Close column files and write the movie table of encoded zmws, then meta.json."""
+        for writer in self.writers.values():
+            writer.close()
+        zmw_table.write(op.join(self.path, 'movies.txt'))
+        meta = {'format': 'cluster_dict', 'version': CLUSTER_DICT_FORMAT_VERSION,
+                'n_clusters': self.n_clusters, 'n_flnc': self.n_flnc, 'n_nfl': self.n_nfl,
+                'columns': dict([(name, np.dtype(dtype).str) for name, dtype in CLUSTER_DICT_COLUMNS])}
+        write_meta_json(self.path, meta)
+
+
+class ClusterDictStore(object):
+    """Memory-mapped binary cluster_dict directory written by ClusterDictWriter."""
+    def __init__(self, path):
+        self.path = path
+        with open(op.join(path, 'meta.json'), 'r') as reader:
+            self.meta = json.load(reader)
+        if self.meta.get('version') != CLUSTER_DICT_FORMAT_VERSION:
+            raise ValueError("Unsupported cluster_dict version %s in %s" % (self.meta.get('version'), path))
+        for name, dtype in CLUSTER_DICT_COLUMNS:
+            setattr(self, name, self._mmap_column(name, dtype))
+        self._cids = None
+
+    def _mmap_column(self, name, dtype):
+        fn = op.join(self.path, name + '.bin')
+        if op.getsize(fn) == 0: # empty files can not be memory-mapped
+            return np.zeros(0, dtype=dtype)
+        return np.memmap(fn, dtype=dtype, mode='r')
+
+    def __len__(self):
+        return self.meta['n_clusters']
+
+    @property
+    def zmw_table(self):
+        return ZmwTable.read(op.join(self.path, 'movies.txt'))
+
+    @property
+    def cids(self):
+        """List of cluster ids, decoded from the cid blob on first access."""
+        if self._cids is None:
+            blob = self.cid_chars.tostring()
+            offsets = self.cid_offsets.tolist()
+            self._cids = [blob[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+        return self._cids
+
+    def cluster(self, i):
+        """Return (cid, flnc_zmws, nfl_zmws, flnc_primers, nfl_primers, consensus_primer) of the i-th cluster"""
+        fs, fe = self.flnc_offsets[i], self.flnc_offsets[i+1]
+        ns, ne = self.nfl_offsets[i], self.nfl_offsets[i+1]
+        return (self.cids[i], self.flnc_zmws[fs:fe], self.nfl_zmws[ns:ne],
+                self.flnc_primers[fs:fe], self.nfl_primers[ns:ne], int8_to_primer(self.consensus[i]))
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self.cluster(i)
+
+    def c2cp(self):
+        """Return defaultdict{cid: consensus_primer}, where the last cluster of a cid wins"""
+        c2cp = defaultdict(lambda: None)
+        c2cp.update(zip(self.cids, [int8_to_primer(p) for p in self.consensus.tolist()]))
+        return c2cp
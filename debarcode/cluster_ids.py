@@ -0,0 +1,217 @@
+"""
+Dense int32 indices of cluster ids.
+
+Cluster ids are cids of a cluster report, e.g., 'i0_ICE_sample6343b5|c11',
+or (c_prefix, cid) of ICE pickles, e.g., ('0to1kb_part0', 11). ClusterIds
+hashes every name once and hands out indices in order of first appearance,
+so that maps of zmws to clusters keep int32 indices, consensus primers of
+clusters are an int8 array indexed by them, and names are only decoded when
+outputs are written.
+
+zmw -> cluster links are also written as a binary z2c directory, next to the
+human readable z2c csv, sorted by zmw, then by cluster in report order:
+
+    z2c_dir/
+        meta.json           number of links and dtypes of columns
+        movies.txt          ZmwTable of encoded zmws
+        cluster_ids.txt     name of every cluster index
+        zmws.bin            int64 encoded zmw of every link
+        cluster_idxs.bin    int32 cluster index of every link
+"""
+import os
+import os.path as op
+import json
+import numpy as np
+from .zmw_table import ZmwTable, remap_codes
+from .primer_store import NO_PRIMER
+from .cluster_dict_store import remove_meta_json, write_meta_json
+
+NO_CLUSTER = -1 # index of a cluster id not in ClusterIds
+CLUSTER_IDX_DTYPE = np.int32
+Z2C_FORMAT_VERSION = 1
+Z2C_COLUMNS = [
+    ('zmws', np.int64),
+    ('cluster_idxs', CLUSTER_IDX_DTYPE),
+]
+
+
+def _name_to_line(name):
+    """cid, or c_prefix and cid of an ICE cluster separated by a tab"""
+    return '%s\t%s' % name if isinstance(name, tuple) else name
+
+
+def _line_to_name(line):
+    if '\t' in line:
+        c_prefix, cid = line.split('\t')
+        return (c_prefix, int(cid))
+    return line
+
+
+class ClusterIds(object):
+    """Cluster ids <-> dense int32 indices, in order of first appearance.
+    ...doctest:
+        >>> c = ClusterIds(['c1', 'c2'])
+        >>> c.indices(['c2', 'c3', 'c2']).tolist(), len(c)
+        ([1, 2, 1], 3)
+        >>> c.lookup(['c3', 'cx']).tolist(), c.decode([2, 0])
+        ([2, -1], ['c3', 'c1'])
+        >>> ClusterIds([('0to1kb_part0', 11)]).lookup([('0to1kb_part0', 11)]).tolist()
+        [0]
+        >>> import tempfile
+        >>> fn = tempfile.mktemp()
+        >>> ClusterIds(['c1', ('0to1kb_part0', 11)]).save(fn)
+        >>> ClusterIds.load(fn).names
+        ['c1', ('0to1kb_part0', 11)]
+        >>> os.remove(fn)
+    """
+    def __init__(self, names=None):
+        self.names = []
+        self.name2idx = {}
+        if names is not None:
+            self.indices(names)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, idx):
+        return self.names[idx]
+
+    def index(self, name):
+        """Return index of name, adding it if it is new."""
+        try:
+            return self.name2idx[name]
+        except KeyError:
+            self.name2idx[name] = len(self.names)
+            self.names.append(name)
+            return self.name2idx[name]
+
+    def indices(self, names):
+        """Return int32 indices of names, adding new ones."""
+        index = self.index
+        return np.fromiter((index(name) for name in names), dtype=CLUSTER_IDX_DTYPE)
+
+    def lookup(self, names):
+        """Return int32 indices of names, NO_CLUSTER for names not in the table, which is not changed."""
+        get = self.name2idx.get
+        return np.fromiter((get(name, NO_CLUSTER) for name in names), dtype=CLUSTER_IDX_DTYPE)
+
+    def decode(self, idxs):
+        """Return names of indices"""
+        names = self.names
+        return [names[i] for i in idxs]
+
+    def save(self, fn):
+        """Write names, one per line in index order"""
+        with open(fn, 'w') as writer:
+            for name in self.names:
+                writer.write(_name_to_line(name) + '\n')
+
+    @classmethod
+    def load(cls, fn):
+        with open(fn, 'r') as reader:
+            return cls([_line_to_name(line.rstrip('\n')) for line in reader])
+
+
+def last_of_clusters(idxs, n_idxs):
+    """Return, for each of n_idxs cluster indices, the position of its last occurrence in idxs, -1 if none.
+    ...doctest:
+        >>> last_of_clusters(np.array([0, 1, 0]), 3).tolist()
+        [2, 1, -1]
+    """
+    last = np.full(n_idxs, -1, dtype=np.int64)
+    np.maximum.at(last, np.asarray(idxs, dtype=np.int64), np.arange(len(idxs), dtype=np.int64))
+    return last
+
+
+def cluster_consensus(idxs, consensus, n_idxs):
+    """Return int8 consensus primer of each of n_idxs cluster indices, given indices and consensus primers of
+    clusters in report order; like a c2cp dict, the last cluster of a cluster id wins, NO_PRIMER if none.
+    ...doctest:
+        >>> cluster_consensus([0, 1, 0], [1, 0, -1], 3).tolist()
+        [-1, 0, -1]
+    """
+    last = last_of_clusters(idxs, n_idxs)
+    found = last >= 0
+    primers = np.full(n_idxs, NO_PRIMER, dtype=np.int8)
+    primers[found] = np.asarray(consensus, dtype=np.int8)[last[found]]
+    return primers
+
+
+def is_z2c_dir(path):
+    """Return True if path is a binary z2c directory rather than a z2c csv"""
+    return op.isdir(path) and op.exists(op.join(path, 'meta.json'))
+
+
+class Z2cWriter(object):
+    """Append (zmw, cluster index) links, sorted by zmw, to a binary z2c directory.
+    ...doctest:
+        >>> import tempfile, shutil
+        >>> d = tempfile.mkdtemp()
+        >>> w = Z2cWriter(op.join(d, 'z2c'))
+        >>> w.write([3, 5], [0, 0]); w.write([5, 7], [1, 1])
+        >>> w.close(ClusterIds(['c1', 'c2']), ZmwTable(['m']))
+        >>> s = Z2cStore(op.join(d, 'z2c'), ZmwTable(['m']))
+        >>> len(s), s.cluster_ids.names, s.zmws.tolist(), s.cluster_idxs.tolist()
+        (4, ['c1', 'c2'], [3, 5, 5, 7], [0, 0, 1, 1])
+        >>> zmws, last = s.last_clusters()
+        >>> zmws.tolist(), last.tolist()
+        ([3, 5, 7], [0, 1, 1])
+        >>> w = Z2cWriter(op.join(d, 'z2c'))
+        >>> is_z2c_dir(op.join(d, 'z2c'))
+        False
+        >>> shutil.rmtree(d)
+    """
+    def __init__(self, path):
+        self.path = path
+        if not op.exists(path):
+            os.makedirs(path)
+        remove_meta_json(path)
+        self.writers = dict([(name, open(op.join(path, name + '.bin'), 'wb')) for name, dtype in Z2C_COLUMNS])
+        self.n_links = 0
+
+    def write(self, zmws, cluster_idxs):
+        np.asarray(zmws, dtype=np.int64).tofile(self.writers['zmws'])
+        np.asarray(cluster_idxs, dtype=CLUSTER_IDX_DTYPE).tofile(self.writers['cluster_idxs'])
+        self.n_links += len(zmws)
+
+    def close(self, cluster_ids, zmw_table):
+        """Close column files and write names of cluster indices, the movie table of encoded zmws, and meta.json last."""
+        for writer in self.writers.values():
+            writer.close()
+        cluster_ids.save(op.join(self.path, 'cluster_ids.txt'))
+        zmw_table.write(op.join(self.path, 'movies.txt'))
+        meta = {'format': 'z2c', 'version': Z2C_FORMAT_VERSION, 'n_links': self.n_links,
+                'columns': dict([(name, np.dtype(dtype).str) for name, dtype in Z2C_COLUMNS])}
+        write_meta_json(self.path, meta)
+
+
+class Z2cStore(object):
+    """Memory-mapped binary z2c directory written by Z2cWriter, with zmws re-encoded by zmw_table."""
+    def __init__(self, path, zmw_table):
+        with open(op.join(path, 'meta.json'), 'r') as reader:
+            meta = json.load(reader)
+        if meta.get('version') != Z2C_FORMAT_VERSION:
+            raise ValueError("Unsupported z2c version %s in %s" % (meta.get('version'), path))
+        columns = {}
+        for name, dtype in Z2C_COLUMNS:
+            fn = op.join(path, name + '.bin')
+            columns[name] = np.memmap(fn, dtype=dtype, mode='r') if op.getsize(fn) else np.zeros(0, dtype=dtype)
+        self.zmws, self.cluster_idxs = columns['zmws'], columns['cluster_idxs']
+        movie_idx_map = zmw_table.merge(ZmwTable.read(op.join(path, 'movies.txt')).movies)
+        if movie_idx_map != range(len(movie_idx_map)):
+            # links stay grouped by zmw, but zmws need to be sorted again under the new movie indices
+            zmws = remap_codes(self.zmws, movie_idx_map)
+            order = np.argsort(zmws, kind='mergesort')
+            self.zmws, self.cluster_idxs = zmws[order], self.cluster_idxs[order]
+        self.cluster_ids = ClusterIds.load(op.join(path, 'cluster_ids.txt'))
+
+    def __len__(self):
+        return len(self.zmws)
+
+    def last_clusters(self):
+        """Return (sorted unique zmws, index of the last cluster of each zmw), as ZmwClusterRuns.last_clusters"""
+        if len(self.zmws) == 0:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=CLUSTER_IDX_DTYPE)
+        last = np.ones(len(self.zmws), dtype=bool)
+        last[:-1] = self.zmws[1:] != self.zmws[:-1]
+        return np.asarray(self.zmws[last]), np.asarray(self.cluster_idxs[last])
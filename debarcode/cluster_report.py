@@ -0,0 +1,212 @@
+"""
+High-throughput parser of all.cluster_report.csv.
+
+Lines look like
+    i0_ICE_sample6343b5|c11,m54200_170722_173443/38404462/30_644_CCS,FL
+and reads of a cluster are on consecutive lines. Instead of a ReportObj per
+read and a list per cluster, consecutive clusters are returned together as a
+ClusterReportBatch in CSR layout: reads of the i-th cluster are
+zmws[offsets[i]:offsets[i+1]], with an is_fl mask next to encoded zmws.
+"""
+import os.path as op
+import numpy as np
+from .zmw_table import ZMW_BITS
+
+CLUSTER_REPORT_BUFFER_SIZE = 16 * 1024 * 1024
+CLUSTER_REPORT_CHUNKS_PER_THREAD = 4 # byte ranges per process, to balance uneven ranges
+
+
+class ClusterReportBatch(object):
+    """Consecutive clusters of a cluster report.
+    ...doctest:
+        >>> b = ClusterReportBatch(['c1', 'c2'], [0, 2, 3], [100, 101, 102], [True, False, True])
+        >>> len(b), b.cluster_idxs.tolist()
+        (2, [0, 0, 1])
+        >>> [(cid, zmws.tolist(), is_fl.tolist()) for cid, zmws, is_fl in b]
+        [('c1', [100, 101], [True, False]), ('c2', [102], [True])]
+    """
+    def __init__(self, cids, offsets, zmws, is_fl):
+        self.cids = cids
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.zmws = np.asarray(zmws, dtype=np.int64)
+        self.is_fl = np.asarray(is_fl, dtype=bool)
+
+    def __len__(self):
+        return len(self.cids)
+
+    def __iter__(self):
+        for i, cid in enumerate(self.cids):
+            start, end = self.offsets[i], self.offsets[i+1]
+            yield (cid, self.zmws[start:end], self.is_fl[start:end])
+
+    @property
+    def n_reads(self):
+        return len(self.zmws)
+
+    @property
+    def cluster_idxs(self):
+        """Index of the cluster of every read within this batch."""
+        return np.repeat(np.arange(len(self.cids)), np.diff(self.offsets))
+
+
+READ_TYPE_IS_FL = {'FL': True, 'NonFL': False}
+
+
+def _encode_movie_zmws(movies, zmw_ids, zmw_table):
+    """Encode lists of movie names and zmw ids (strings) as an int64 array,
+    raise ValueError if a zmw id is not an integer."""
+    for movie in set(movies):
+        zmw_table.movie_index(movie)
+    movie_idxs = np.array(map(zmw_table.movie2idx.__getitem__, movies), dtype=np.int64)
+    zmw_ids = np.fromstring(' '.join(zmw_ids), dtype=np.int64, sep=' ')
+    if len(zmw_ids) != len(movie_idxs):
+        raise ValueError("Could not parse zmw ids")
+    return (movie_idxs << ZMW_BITS) | zmw_ids
+
+
+def _parse_lines(lines, zmw_table):
+    """Parse cluster report lines one by one, return (cids, encoded zmws, is_fl) arrays."""
+    cids, movies, zmw_ids, is_fl = [], [], [], []
+    for line in lines:
+        if line[0] == '#' or line[0] in '\r\n' or line.startswith('cluster_id'):
+            continue
+        cid, read, read_type = line.rstrip('\r\n').split(',', 3)[0:3]
+        movie, zmw_id = read.split('/', 2)[0:2]
+        cids.append(cid)
+        movies.append(movie)
+        zmw_ids.append(zmw_id)
+        is_fl.append(read_type == 'FL')
+    if not cids:
+        return np.array([], dtype='S1'), np.array([], dtype=np.int64), np.array([], dtype=bool)
+    return np.array(cids), _encode_movie_zmws(movies, zmw_ids, zmw_table), np.array(is_fl, dtype=bool)
+
+
+def _parse_block(block, zmw_table):
+    """Parse a block of complete cluster report lines, return (cids, encoded zmws, is_fl) arrays.
+    Blocks where every line is 'cid,movie/zmw/range,FL|NonFL' are split into
+    columns with a few str and numpy calls; other blocks, e.g., with comment or
+    header lines, fall back to _parse_lines.
+    ...doctest:
+        >>> from .zmw_table import ZmwTable
+        >>> t = ZmwTable(['m0', 'm1'])
+        >>> cids, zmws, is_fl = _parse_block('c1,m1/5/0_9_CCS,FL\\nc2,m0/6/0_9_CCS,NonFL\\n', t)
+        >>> cids.tolist(), zmws.tolist(), is_fl.tolist()
+        (['c1', 'c2'], [4294967301, 6], [True, False])
+        >>> cids, zmws, is_fl = _parse_block('#x\\ncluster_id,read_id,read_type\\nc1,m1/5,FL\\n', t)
+        >>> cids.tolist(), zmws.tolist(), is_fl.tolist()
+        (['c1'], [4294967301], [True])
+    """
+    while block.startswith('#') or block.startswith('cluster_id'): # comment and header lines at the beginning of the file
+        block = block[block.find('\n') + 1:]
+    if not block:
+        return _parse_lines([], zmw_table)
+    if '\n#' in block or '\ncluster_id' in block or '\r' in block or '\n\n' in block or block[0] == '\n':
+        return _parse_lines(block.splitlines(True), zmw_table)
+    tokens = block.replace('/', ',').replace('\n', ',').split(',')
+    tokens.pop() # block ends with '\n'
+    n_lines = block.count('\n')
+    if len(tokens) != 5 * n_lines:
+        return _parse_lines(block.splitlines(True), zmw_table)
+    try:
+        is_fl = np.array(map(READ_TYPE_IS_FL.__getitem__, tokens[4::5]), dtype=bool)
+        zmws = _encode_movie_zmws(tokens[1::5], tokens[2::5], zmw_table)
+    except (KeyError, ValueError):
+        return _parse_lines(block.splitlines(True), zmw_table)
+    return np.array(tokens[0::5]), zmws, is_fl
+
+
+def yield_cluster_report_batches(fp, zmw_table, buffer_size=CLUSTER_REPORT_BUFFER_SIZE, n_bytes=None):
+    """Yield ClusterReportBatch of consecutive clusters from cluster report file object fp,
+    reading about buffer_size bytes at a time. Reads of consecutive lines with
+    the same cluster id are grouped into one cluster, as in yield_cluster_report,
+    also across buffer boundaries. Comment, header and empty lines are skipped.
+    If n_bytes is not None, read n_bytes from the current position of fp,
+    which must be a range of complete lines, e.g., of cluster_report_chunk_ranges.
+    ...doctest:
+        >>> from StringIO import StringIO
+        >>> from .zmw_table import ZmwTable
+        >>> fp = StringIO('#comment\\ncluster_id,read_id,read_type\\ncid1,movie/100,FL\\ncid1,movie/101/0_10_CCS,FL\\ncid1,movie/102,NonFL\\ncid2,movie/103,FL\\ncid3,movie/103,FL\\ncid4,movie/104,NonFL')
+        >>> batches = list(yield_cluster_report_batches(fp, ZmwTable(), buffer_size=10))
+        >>> [(cid, zmws.tolist(), is_fl.tolist()) for b in batches for cid, zmws, is_fl in b]
+        [('cid1', [100, 101, 102], [True, True, False]), ('cid2', [103], [True]), ('cid3', [103], [True]), ('cid4', [104], [False])]
+    """
+    # reads of the last cluster seen so far, which may continue in the next block
+    pending_cids, pending_zmws, pending_is_fl = np.array([], dtype='S1'), np.array([], dtype=np.int64), np.array([], dtype=bool)
+    remaining = n_bytes
+    while True:
+        block = fp.read(buffer_size if remaining is None else min(buffer_size, remaining))
+        if not block:
+            break
+        if not block.endswith('\n'):
+            block += fp.readline() # complete the last line
+        if remaining is not None:
+            remaining -= len(block)
+        if not block.endswith('\n'):
+            block += '\n'
+        cids, zmws, is_fl = _parse_block(block, zmw_table)
+        cids = np.concatenate([pending_cids, cids])
+        zmws = np.concatenate([pending_zmws, zmws])
+        is_fl = np.concatenate([pending_is_fl, is_fl])
+        if len(cids) == 0:
+            continue
+        starts = np.flatnonzero(cids[1:] != cids[:-1]) + 1
+        if len(starts) > 0:
+            last_start = starts[-1]
+            offsets = np.concatenate([[0], starts])
+            yield ClusterReportBatch(cids[offsets[:-1]].tolist(), offsets, zmws[:last_start], is_fl[:last_start])
+        else:
+            last_start = 0
+        pending_cids, pending_zmws, pending_is_fl = cids[last_start:], zmws[last_start:], is_fl[last_start:]
+    if len(pending_cids) > 0:
+        yield ClusterReportBatch([pending_cids[0]], [0, len(pending_zmws)], pending_zmws, pending_is_fl)
+
+
+def cluster_report_chunk_ranges(cluster_report_fn, n_chunks):
+    """Split a cluster report into at most n_chunks byte ranges [(start, end)] of complete
+    clusters, i.e., every start is the offset of a line whose cluster id differs from
+    that of the previous line.
+    ...doctest:
+        >>> import tempfile, os
+        >>> fn = tempfile.mktemp(suffix='.csv')
+        >>> open(fn, 'w').write('c1,m/1,FL\\nc1,m/2,FL\\nc1,m/3,NonFL\\nc2,m/4,FL\\nc3,m/5,FL\\n')
+        >>> cluster_report_chunk_ranges(fn, 2)
+        [(0, 43), (43, 53)]
+        >>> cluster_report_chunk_ranges(fn, 10)
+        [(0, 33), (33, 53)]
+        >>> os.remove(fn)
+    """
+    size = op.getsize(cluster_report_fn)
+    bounds = [0]
+    with open(cluster_report_fn, 'rb') as reader:
+        for k in range(1, n_chunks):
+            pos = size * k // n_chunks
+            if pos <= bounds[-1]:
+                continue
+            reader.seek(pos - 1)
+            reader.readline() # move to the first line starting at or after pos
+            cid, found = None, None
+            while True:
+                line_start = reader.tell()
+                line = reader.readline()
+                if not line:
+                    break
+                if not line.strip() or line.startswith('#'):
+                    continue
+                line_cid = line.split(',', 1)[0]
+                if cid is None:
+                    cid = line_cid
+                elif line_cid != cid:
+                    found = line_start
+                    break
+            if found is None:
+                break
+            bounds.append(found)
+    bounds.append(size)
+    return zip(bounds[:-1], bounds[1:])
+
+
+def yield_cluster_report_arrays(fp, zmw_table, buffer_size=CLUSTER_REPORT_BUFFER_SIZE):
+    """Yield (cid, encoded zmws, is_fl mask) of every cluster in a cluster report."""
+    for batch in yield_cluster_report_batches(fp, zmw_table, buffer_size=buffer_size):
+        for cluster in batch:
+            yield cluster
@@ -4,20 +4,33 @@ import sys
 import os
 import os.path as op
 from argparse import ArgumentParser
+from itertools import izip
+import multiprocessing
+import numpy as np
 from .utils import *
-
-MOVIES = ['m54006_170729_232022', 'm54026_170727_103805', 'm54200_170721_210832', 'm54200_170722_173443']
-IDXS = range(0, 4)
-MOVIE2IDX = dict(zip(MOVIES, IDXS))
-IDX2MOVIE = dict(zip(IDXS, MOVIES))
-
-def parse_cluster_report_line(s):
+from .zmw_table import ZmwTable
+from .primer_store import ZmwPrimerStore, primer_to_int8, int8_to_primer
+from .consensus import BatchConsensus, PrimerCounts
+from .cluster_report import yield_cluster_report_batches, cluster_report_chunk_ranges, CLUSTER_REPORT_CHUNKS_PER_THREAD
+from .cluster_dict_store import ClusterDictWriter, ClusterDictStore
+from .zmw_cluster_runs import ZmwClusterRuns
+from .cluster_ids import ClusterIds, Z2cWriter
+from .stage_cache import add_cache_arguments, stage_cache_from_args
+from .output import add_output_arguments, output_writer_from_args
+from .background import prefetch, BackgroundWriter
+from .instrument import RunReport, add_report_arguments, run_report_from_args, finish_run_report
+
+
+def parse_cluster_report_line(s, zmw_table):
     """
     i0_ICE_sample6343b5|c11,m54200_170722_173443/38404462/30_644_CCS,FL
-    return (cid, zmw, is_FL)
+    return (cid, encoded_zmw, is_FL)
+    ...doctest:
+        >>> parse_cluster_report_line('i0_ICE_sample6343b5|c11,m54200_170722_173443/38404462/30_644_CCS,FL', ZmwTable())
+        ('i0_ICE_sample6343b5|c11', 38404462, True)
     """
     cid, read, is_FL = s.strip().split(',')[0:3]
-    return (cid, readname2moviezmw(read), True if is_FL == 'FL' else False)
+    return (cid, zmw_table.encode(read), True if is_FL == 'FL' else False)
 
 
 class ReportObj(object):
@@ -39,16 +52,16 @@ class ReportObj(object):
     def __cmp__(self, other):
         return cmp((self.cid, self.zmw, self.is_flnc), (other.cid, other.zmw, other.is_flnc))
 
-def yield_cluster_report(fp):
+def yield_cluster_report(fp, zmw_table):
     """
-    ...doctest: >>> lines = ['cid1,movie/100,FL', 'cid1,movie/101,FL', 'cid1,movie/102,NonFL', 'cid2,movie/103,FL', 'cid3,movie/103,FL', 'cid4,movie/104,NonFL'] >>> [r for r in yield_cluster_report(lines)]
-        [[(cid1, movie/100, True), (cid1, movie/101, True), (cid1, movie/102, False)], [(cid2, movie/103, True)], [(cid3, movie/103, True)], [(cid4, movie/104, False)]]
+    ...doctest: >>> lines = ['cid1,movie/100,FL', 'cid1,movie/101,FL', 'cid1,movie/102,NonFL', 'cid2,movie/103,FL', 'cid3,movie/103,FL', 'cid4,movie/104,NonFL'] >>> [r for r in yield_cluster_report(lines, ZmwTable())]
+        [[(cid1, 100, True), (cid1, 101, True), (cid1, 102, False)], [(cid2, 103, True)], [(cid3, 103, True)], [(cid4, 104, False)]]
     """
     prev = None
     ret = []
     for line in fp:
         if not line.startswith('#') and not line.startswith('cluster_id'):
-            cid, zmw, is_flnc = parse_cluster_report_line(line)
+            cid, zmw, is_flnc = parse_cluster_report_line(line, zmw_table)
             if prev is None:
                 prev = ReportObj(cid, zmw, is_flnc)
             else:
@@ -108,19 +121,38 @@ def get_consensus_primer_from_flnc_nfl_primers(flnc_primers, nfl_primers, min_fr
 
 class ClusterDict(object):
     __sep__ = '\t'
-    def __init__(self, cluster_reports, flnc_z2p, nfl_z2p, min_fraction=0.6, consensus_primer=None, recompute_consensus_primer=True):
-        assert len(cluster_reports) > 0
-        self.cid = cluster_reports[0].cid
-        self.flnc_zmws = [cluster_report.zmw for cluster_report in cluster_reports if cluster_report.is_flnc is True]
-        self.nfl_zmws = [cluster_report.zmw for cluster_report in cluster_reports if cluster_report.is_flnc is False]
-        self.flnc_primers = [flnc_z2p[flnc_zmw] for flnc_zmw in self.flnc_zmws]
-        self.nfl_primers = [nfl_z2p[nfl_zmw] for nfl_zmw in self.nfl_zmws]
+    def __init__(self, cid, flnc_zmws, nfl_zmws, flnc_primer_arr, nfl_primer_arr, min_fraction=0.6, consensus_primer=None, recompute_consensus_primer=True):
+        """flnc_zmws, nfl_zmws: lists of encoded zmws
+        flnc_primer_arr, nfl_primer_arr: int8 arrays of their primers, NO_PRIMER for None
+        """
+        self.cid = cid
+        self.flnc_zmws = flnc_zmws
+        self.nfl_zmws = nfl_zmws
+        self.flnc_primer_arr = flnc_primer_arr
+        self.nfl_primer_arr = nfl_primer_arr
         self.min_fraction = min_fraction
         if recompute_consensus_primer:
             self.consensus_primer = self.recompute_consensus_primer()
         else:
             self.consensus_primer = consensus_primer
 
+    @classmethod
+    def fromReports(cls, cluster_reports, flnc_z2p, nfl_z2p, min_fraction=0.6, consensus_primer=None, recompute_consensus_primer=True):
+        """Construct from ReportObjs of a cluster, looking up primers in ZmwPrimerStores flnc_z2p and nfl_z2p"""
+        assert len(cluster_reports) > 0
+        flnc_zmws = [cluster_report.zmw for cluster_report in cluster_reports if cluster_report.is_flnc is True]
+        nfl_zmws = [cluster_report.zmw for cluster_report in cluster_reports if cluster_report.is_flnc is False]
+        return ClusterDict(cluster_reports[0].cid, flnc_zmws, nfl_zmws, flnc_z2p.lookup(flnc_zmws), nfl_z2p.lookup(nfl_zmws),
+                           min_fraction, consensus_primer=consensus_primer, recompute_consensus_primer=recompute_consensus_primer)
+
+    @property
+    def flnc_primers(self):
+        return [int8_to_primer(p) for p in self.flnc_primer_arr.tolist()]
+
+    @property
+    def nfl_primers(self):
+        return [int8_to_primer(p) for p in self.nfl_primer_arr.tolist()]
+
     def recompute_consensus_primer(self):
         return get_consensus_primer_from_flnc_nfl_primers(self.flnc_primers, self.nfl_primers, self.min_fraction, self.cid)
 
@@ -128,8 +160,10 @@ class ClusterDict(object):
     def header(self):
         return self.__sep__.join(['cluster_id', 'flnc_zmws', 'nfl_zmws', 'flnc_primers', 'nfl_primers', 'consensus_primer'])
 
-    def to_str(self):
-        return self.__sep__.join([str(x) for x in [self.cid, list_to_str(self.flnc_zmws), list_to_str(self.nfl_zmws), list_to_str(self.flnc_primers), list_to_str(self.nfl_primers), self.consensus_primer]])
+    def to_str(self, zmw_table):
+        flnc_zmws = [zmw_table.decode(zmw) for zmw in self.flnc_zmws]
+        nfl_zmws = [zmw_table.decode(zmw) for zmw in self.nfl_zmws]
+        return self.__sep__.join([str(x) for x in [self.cid, list_to_str(flnc_zmws), list_to_str(nfl_zmws), list_to_str(self.flnc_primers), list_to_str(self.nfl_primers), self.consensus_primer]])
 
     @property
     def flnc_z2c(self):
@@ -140,36 +174,38 @@ class ClusterDict(object):
         return {nfl_zmw: self.cid for nfl_zmw in self.nfl_zmws}
 
     @classmethod
-    def fromString(cls, s, min_fraction=0.6):
+    def fromString(cls, s, zmw_table, min_fraction=0.6):
         """
         >>> s = 'cid\\t[movie1/1,movie1/2]\\t[movie2/3,movie3/4]\\t[0,0]\\t[1,None]\\t0'
-        >>> o = ClusterDict.fromString(s)
+        >>> t = ZmwTable()
+        >>> o = ClusterDict.fromString(s, t)
         >>> o.cid
         'cid'
         >>> o.flnc_primers
         [0, 0]
         >>> o.nfl_primers
         [1, None]
-        >>> o.flnc_z2c
+        >>> t.decode_keys(o.flnc_z2c)
         {'movie1/1': 'cid', 'movie1/2': 'cid'}
-        >>> o.nfl_z2c
+        >>> t.decode_keys(o.nfl_z2c)
         {'movie3/4': 'cid', 'movie2/3': 'cid'}
-        >>> o.flnc_zmws
+        >>> [t.decode(zmw) for zmw in o.flnc_zmws]
         ['movie1/1', 'movie1/2']
-        >>> o.nfl_zmws
+        >>> [t.decode(zmw) for zmw in o.nfl_zmws]
         ['movie2/3', 'movie3/4']
+        >>> o.to_str(t) == s
+        True
         """
         fs = s.strip().split(cls.__sep__)
         cid = fs[0]
-        flnc_zmws = str_to_list(fs[1], str_or_none) #[str_or_none(x) for x in fs[1][1:-1].split(',')]
-        nfl_zmws = str_to_list(fs[2], str_or_none) #[str_or_none(x) for x in fs[2][1:-1].split(',')]
+        flnc_zmws = [zmw_table.encode(zmw) for zmw in str_to_list(fs[1], str)]
+        nfl_zmws = [zmw_table.encode(zmw) for zmw in str_to_list(fs[2], str)]
         flnc_primers = str_to_list(fs[3], int_or_none) # [int_or_none(x) for x in fs[3][1:-1].split(',')]
         nfl_primers = str_to_list(fs[4], int_or_none) #[int_or_none(x) for x in fs[4][1:-1].split(',')]
         consensus_primer = int_or_none(fs[5])
-        reports = [ReportObj(cid, zmw, True) for zmw in flnc_zmws] + [ReportObj(cid, zmw, False) for zmw in nfl_zmws]
-        flnc_z2p = dict(zip(flnc_zmws, flnc_primers))
-        nfl_z2p = dict(zip(nfl_zmws, nfl_primers))
-        return ClusterDict(reports, flnc_z2p, nfl_z2p, min_fraction, consensus_primer=consensus_primer, recompute_consensus_primer=False)
+        flnc_primer_arr = np.array([primer_to_int8(p) for p in flnc_primers], dtype=np.int8)
+        nfl_primer_arr = np.array([primer_to_int8(p) for p in nfl_primers], dtype=np.int8)
+        return ClusterDict(cid, flnc_zmws, nfl_zmws, flnc_primer_arr, nfl_primer_arr, min_fraction, consensus_primer=consensus_primer, recompute_consensus_primer=False)
 
 def int_or_none(x):
     return None if x == 'None' else int(x)
@@ -196,96 +232,258 @@ def str_to_list(s, f):
 
 
 
-def simplified_zmw(zmw, movie2idx):
-    """
-    ...doctest:
-        >>> simplified_zmw('movie1/0', {'movie1':1, 'movie2':2})
-        (1, 0)
-    """
-    movie, zmw_id = zmw.split('/')
-    movie_id = movie2idx[movie]
-    return (int(movie_id), int(zmw_id))
+def write_z2c(z2c, z2c_fn, zmw_table):
+    """write {encoded_zmw: [cids]}, or an iterator of (encoded_zmw, [cids]), to z2c_fn, zmws decoded as 'movie/zmw'"""
+    z2c_writer = open(z2c_fn, 'w')
+    for zmw, cids in (z2c.iteritems() if isinstance(z2c, dict) else z2c):
+        z2c_writer.write('\t'.join([zmw_table.decode(zmw), list_to_str(cids)]) + '\n')
+    z2c_writer.close()
 
 
-def simplified_dict(d, movie2idx):
-    """
+def write_z2c_dir(runs, z2c_dir, cids, zmw_table):
+    """Write ZmwClusterRuns of cluster indices in report order, whose cids are cids, to the binary z2c_dir,
+    keeping int32 indices of ClusterIds of cids instead of cid strings.
     ...doctest:
-        >>> movie2idx = {'movie1': 1, 'movie2': 2}
-        >>> d = {'movie1/101': 'cid1', 'movie2/102': 'cid2'}
-        >>> simplified_dict(d, movie2idx)
-        {(1, 101): 'cid1', (2, 102): 'cid2'}
+        >>> import tempfile, shutil
+        >>> from .cluster_ids import Z2cStore
+        >>> d = tempfile.mkdtemp()
+        >>> runs = ZmwClusterRuns()
+        >>> runs.add([5, 3, 5], [0, 1, 2])
+        >>> write_z2c_dir(runs, op.join(d, 'z2c'), ['c1', 'c2', 'c1'], ZmwTable(['m']))
+        >>> s = Z2cStore(op.join(d, 'z2c'), ZmwTable(['m']))
+        >>> s.zmws.tolist(), s.cluster_ids.decode(s.cluster_idxs)
+        ([3, 5, 5], ['c2', 'c1', 'c1'])
+        >>> shutil.rmtree(d)
     """
-    ret = {}
-    for zmw, cid in d.iteritems():
-        ret[simplified_zmw(zmw, movie2idx)] = cid
-    return ret
-
-def write_z2c(z2c_dict, z2c_fn, idx2movie):
-    z2c_writer = open(z2c_fn, 'w')
-    for (movie_id, zmw_id), cids in z2c_dict.iteritems():
-        z2c_writer.write('\t'.join(['%s/%s' % (idx2movie[movie_id], zmw_id), list_to_str(cids)]) + '\n')
-    z2c_writer.close()
+    cluster_ids = ClusterIds()
+    idx_of_cluster = cluster_ids.indices(cids)
+    writer = Z2cWriter(z2c_dir)
+    for zmws, cluster_idxs in runs.yield_pair_chunks():
+        writer.write(zmws, idx_of_cluster[cluster_idxs])
+    writer.close(cluster_ids, zmw_table)
 
 
-def write_ophan_zmws(zmws, simplified_zmws_in_cluster, movie2idx, o_fn):
+def write_ophan_zmws(zmws, zmws_in_cluster, zmw_table, o_fn):
     with open(o_fn, 'w') as writer:
         for zmw in zmws:
-            if not simplified_zmw(zmw, movie2idx) in simplified_zmws_in_cluster:
-                writer.write('%s\n' % zmw)
+            if not zmw in zmws_in_cluster:
+                writer.write('%s\n' % zmw_table.decode(zmw))
 
 
-def update_simplified_z2c(simplified_z2c, z2c, movie2idx):
+def update_z2c(z2c_lists, z2c):
     """
     ...doctest:
-        >>> s_z2c = {(1,1): [], (2,2):['cid2']}
-        >>> z2c = {'movie1/1': 'cid1', 'movie2/2': 'cid3'}
-        >>> update_simplified_z2c(s_z2c, z2c, {'movie1':1, 'movie2':2})
-        {(1, 1): ['cid1'], (2, 2): ['cid2', 'cid3']}
-        >>> s_z2c
-        {(1, 1): ['cid1'], (2, 2): ['cid2', 'cid3']}
+        >>> z2c_lists = {1: [], 2:['cid2']}
+        >>> update_z2c(z2c_lists, {1: 'cid1', 2: 'cid3'})
+        {1: ['cid1'], 2: ['cid2', 'cid3']}
+        >>> z2c_lists
+        {1: ['cid1'], 2: ['cid2', 'cid3']}
     """
     for zmw, cid in z2c.iteritems():
-        s_zmw = simplified_zmw(zmw, movie2idx)
-        simplified_z2c[s_zmw].append(cid)
-    return simplified_z2c
+        z2c_lists[zmw].append(cid)
+    return z2c_lists
 
 
-def cluster_to_consensus_primer(cluster_report_fn, flnc_z2p, nfl_z2p, out_dir):
-    flnc_z2c_fn, nfl_z2c_fn = op.join(out_dir, 'flnc_z2c.csv'), op.join(out_dir, 'nfl_z2c.csv')
-    o_cluster_dict_csv_fn = op.join(out_dir, 'cluster_dict.csv')
-    cluster_report_reader = open(cluster_report_fn, 'r')
-    cluster_dict_writer = open(o_cluster_dict_csv_fn, 'w')
+def get_batch_primers(batch, flnc_z2p, nfl_z2p):
+    """Look up int8 primers of all reads in a ClusterReportBatch at once.
+    ...doctest:
+        >>> from .cluster_report import ClusterReportBatch
+        >>> batch = ClusterReportBatch(['c1', 'c2'], [0, 6, 7], [1, 2, 3, 4, 5, 6, 7], [True] * 4 + [False] * 2 + [True])
+        >>> flnc_z2p = ZmwPrimerStore.from_dict({1: 0, 2: 0, 3: 1, 4: 1, 7: None})
+        >>> nfl_z2p = ZmwPrimerStore.from_dict({5: 0, 6: None})
+        >>> get_batch_primers(batch, flnc_z2p, nfl_z2p).tolist()
+        [0, 0, 1, 1, 0, -1, -1]
+    """
+    is_fl = batch.is_fl
+    primers = np.empty(batch.n_reads, dtype=np.int8)
+    primers[is_fl] = flnc_z2p.lookup(batch.zmws[is_fl])
+    primers[~is_fl] = nfl_z2p.lookup(batch.zmws[~is_fl])
+    return primers
 
-    s_flnc_z2c = defaultdict(lambda: [])
-    s_nfl_z2c = defaultdict(lambda: [])
-    print 'Reading %s' %  (cluster_report_fn)
 
-    for cluster_records in yield_cluster_report(cluster_report_reader):
-        cluster_dict = ClusterDict(cluster_records, flnc_z2p, nfl_z2p)
-        cluster_dict_writer.write(cluster_dict.to_str() + '\n')
-        update_simplified_z2c(s_flnc_z2c, cluster_dict.flnc_z2c, MOVIE2IDX)
-        update_simplified_z2c(s_nfl_z2c, cluster_dict.nfl_z2c, MOVIE2IDX)
+def add_batch_to_z2c_runs(flnc_runs, nfl_runs, batch, first_cluster_idx):
+    """Add (zmw, cluster index) pairs of flnc and nfl reads in a ClusterReportBatch, whose first
+    cluster is the first_cluster_idx-th cluster of the report, to ZmwClusterRuns."""
+    cluster_idxs = batch.cluster_idxs + first_cluster_idx
+    flnc_runs.add(batch.zmws[batch.is_fl], cluster_idxs[batch.is_fl])
+    nfl_runs.add(batch.zmws[~batch.is_fl], cluster_idxs[~batch.is_fl])
 
-    cluster_report_reader.close()
-    cluster_dict_writer.close()
 
-    print 'Writing z2c %s' %  (flnc_z2c_fn)
-    write_z2c(s_flnc_z2c, flnc_z2c_fn, IDX2MOVIE)
-    print 'Writing nfl z2c %s' %  (nfl_z2c_fn)
-    write_z2c(s_nfl_z2c, nfl_z2c_fn, IDX2MOVIE)
+def yield_z2c_from_runs(runs, cids):
+    """Yield (encoded_zmw, [cids]) of ZmwClusterRuns in sorted zmw order, cids of a zmw in report order.
+    ...doctest:
+        >>> runs = ZmwClusterRuns()
+        >>> runs.add([5, 3, 5], [0, 1, 1])
+        >>> list(yield_z2c_from_runs(runs, ['c1', 'c2']))
+        [(3, ['c2']), (5, ['c1', 'c2'])]
+    """
+    for zmw, cluster_idxs in runs.yield_z2c():
+        yield (zmw, [cids[i] for i in cluster_idxs])
+
+
+def cluster_dict_from_store_row(row, min_fraction=0.6):
+    """Return ClusterDict of a row (cid, flnc_zmws, nfl_zmws, flnc_primers, nfl_primers, consensus_primer) of ClusterDictStore"""
+    cid, flnc_zmws, nfl_zmws, flnc_primers, nfl_primers, consensus_primer = row
+    return ClusterDict(cid, flnc_zmws.tolist(), nfl_zmws.tolist(), flnc_primers, nfl_primers, min_fraction,
+                       consensus_primer=consensus_primer, recompute_consensus_primer=False)
+
+
+def write_cluster_dict_csv(cluster_dict_dir, csv_fn):
+    """Export a binary cluster_dict directory to the human readable cluster_dict.csv"""
+    store = ClusterDictStore(cluster_dict_dir)
+    zmw_table = store.zmw_table
+    with open(csv_fn, 'w') as writer:
+        for row in store:
+            writer.write(cluster_dict_from_store_row(row).to_str(zmw_table) + '\n')
+
+
+def yield_batch_consensus_of_range(cluster_report_fn, start, end, flnc_z2p, nfl_z2p, zmw_table, min_fraction=0.6, progress=None):
+    """Yield (ClusterReportBatch, int8 primers of its reads, BatchConsensus) of consecutive clusters
+    in byte range [start, end) of cluster_report_fn, end=None for the end of file.
+    Reads and bytes read so far are reported to Progress progress if it is not None."""
+    with open(cluster_report_fn, 'rb') as cluster_report_reader:
+        cluster_report_reader.seek(start)
+        n_bytes = None if end is None else end - start
+        for batch in yield_cluster_report_batches(cluster_report_reader, zmw_table, n_bytes=n_bytes):
+            primers = get_batch_primers(batch, flnc_z2p, nfl_z2p)
+            consensus = BatchConsensus(batch.cluster_idxs, primers, batch.is_fl, len(batch), min_fraction)
+            if progress is not None:
+                progress.update(batch.n_reads, cluster_report_reader.tell())
+            yield batch, primers, consensus
+
+
+# (flnc_z2p, nfl_z2p, zmw_table) of the parent process, set before the process pool
+# is created, so that workers share them read-only instead of pickling them per task
+_WORKER_Z2P = {}
+
+def _batch_consensus_of_range(args):
+    """Process pool worker, return [(ClusterReportBatch, primers, BatchConsensus)] of clusters in a byte range.
+    Zmws are encoded by the zmw_table inherited from the parent, which already has all movies of z2p;
+    a zmw of another movie is not in z2p and raises KeyError as in the serial run.
+    """
+    cluster_report_fn, start, end, min_fraction = args
+    flnc_z2p, nfl_z2p, zmw_table = _WORKER_Z2P['flnc_z2p'], _WORKER_Z2P['nfl_z2p'], _WORKER_Z2P['zmw_table']
+    return list(yield_batch_consensus_of_range(cluster_report_fn, start, end, flnc_z2p, nfl_z2p, zmw_table, min_fraction))
+
+
+def yield_batch_consensus(cluster_report_fn, flnc_z2p, nfl_z2p, zmw_table, min_fraction=0.6, threads=1, progress=None):
+    """Yield (ClusterReportBatch, int8 primers of its reads, BatchConsensus) of consecutive clusters in cluster_report_fn.
+    If threads > 1, split the report into byte ranges of complete clusters and
+    compute them in a pool of threads processes, otherwise in a reader thread a
+    few batches ahead of the caller. Results are yielded in file order, so
+    outputs are identical to the serial run.
+    Reads and bytes of the report done so far are reported to Progress progress if it is not None.
+    """
+    print 'Reading %s' %  (cluster_report_fn)
+    if threads <= 1:
+        for result in prefetch(yield_batch_consensus_of_range(cluster_report_fn, 0, None, flnc_z2p, nfl_z2p, zmw_table, min_fraction, progress)):
+            yield result
+        return
+
+    tasks = [(cluster_report_fn, start, end, min_fraction)
+             for start, end in cluster_report_chunk_ranges(cluster_report_fn, threads * CLUSTER_REPORT_CHUNKS_PER_THREAD)]
+    _WORKER_Z2P.update({'flnc_z2p': flnc_z2p, 'nfl_z2p': nfl_z2p, 'zmw_table': zmw_table})
+    pool = multiprocessing.Pool(processes=threads)
+    try:
+        for (_, start, end, _), results in izip(tasks, pool.imap(_batch_consensus_of_range, tasks, chunksize=1)):
+            if progress is not None:
+                progress.update(sum([batch.n_reads for batch, primers, consensus in results]),
+                                op.getsize(cluster_report_fn) if end is None else end)
+            for result in results:
+                yield result
+    finally:
+        pool.close()
+        pool.join()
+        _WORKER_Z2P.clear()
+
+
+def write_disagree_cids(disagree_cids, disagree_fn):
+    """Write clusters whose consensus primers from flnc and (flnc+nfl) differ, one cid per line."""
+    if disagree_cids:
+        print "Warning %s clusters have different consensus primers from flnc and (flnc+nfl), see %s" % (len(disagree_cids), disagree_fn)
+    with open(disagree_fn, 'w') as writer:
+        for cid in disagree_cids:
+            writer.write(cid + '\n')
+
+
+def cluster_to_consensus_primer(cluster_report_fn, flnc_z2p, nfl_z2p, out_dir, zmw_table, min_fraction=0.6, write_csv=False,
+                                memory_budget=None, tmp_dir=None, threads=1, report=None, write_z2c_csv=False):
+    """Compute consensus primers of clusters in cluster_report_fn, write them to
+    the binary cluster_dict directory (and cluster_dict.csv if write_csv),
+    and write the binary flnc_z2c and nfl_z2c directories (and flnc_z2c.csv and nfl_z2c.csv if write_z2c_csv),
+    and primer counts of clusters to primer_counts.npz.
+    zmw -> cluster links are spilled to sorted runs in tmp_dir once they take
+    more than memory_budget bytes, see ZmwClusterRuns. Clusters are computed in
+    a pool of threads processes, see yield_batch_consensus, and written to
+    cluster_dict by a writer thread. Stages are measured by RunReport report."""
+    report = RunReport() if report is None else report
+    flnc_z2c_fn, nfl_z2c_fn = op.join(out_dir, 'flnc_z2c.csv'), op.join(out_dir, 'nfl_z2c.csv')
+    o_cluster_dict_dir = op.join(out_dir, 'cluster_dict')
+    o_cluster_dict_csv_fn = op.join(out_dir, 'cluster_dict.csv')
+    disagree_fn = op.join(out_dir, 'consensus_disagree_cids.txt')
+    primer_counts_fn = op.join(out_dir, 'primer_counts.npz')
+    cluster_dict_writer = ClusterDictWriter(o_cluster_dict_dir)
+
+    # (encoded_zmw, cluster index), run files are removed on exit, also on errors
+    with ZmwClusterRuns(memory_budget=memory_budget, tmp_dir=tmp_dir) as flnc_runs, \
+            ZmwClusterRuns(memory_budget=memory_budget, tmp_dir=tmp_dir) as nfl_runs:
+        cids, disagree_cids, counts = [], [], []
+        with report.stage('consensus') as stage:
+            progress = report.progress('cluster report', total=op.getsize(cluster_report_fn))
+            with BackgroundWriter() as writer:
+                for batch, primers, consensus in yield_batch_consensus(cluster_report_fn, flnc_z2p, nfl_z2p, zmw_table, min_fraction, threads, progress):
+                    counts.append(consensus.counts)
+                    disagree_cids.extend([batch.cids[i] for i in consensus.disagree_clusters])
+                    writer.submit(cluster_dict_writer.write, batch.cids, batch.offsets, batch.zmws, batch.is_fl, primers, consensus.consensus)
+                    add_batch_to_z2c_runs(flnc_runs, nfl_runs, batch, len(cids))
+                    cids.extend(batch.cids)
+            stage.records = progress.records
+
+            cluster_dict_writer.close(zmw_table)
+            PrimerCounts.concatenate(counts, cids=cids).save(primer_counts_fn)
+
+        if write_csv:
+            with report.stage('cluster_dict_csv') as stage:
+                print 'Writing %s' % (o_cluster_dict_csv_fn)
+                write_cluster_dict_csv(o_cluster_dict_dir, o_cluster_dict_csv_fn)
+                stage.records = len(cids)
+
+        write_disagree_cids(disagree_cids, disagree_fn)
+
+        with report.stage('z2c') as stage:
+            write_z2c_dir(flnc_runs, op.join(out_dir, 'flnc_z2c'), cids, zmw_table)
+            write_z2c_dir(nfl_runs, op.join(out_dir, 'nfl_z2c'), cids, zmw_table)
+            stage.records = len(flnc_runs) + len(nfl_runs)
+
+        if write_z2c_csv:
+            with report.stage('z2c_csv') as stage:
+                print 'Writing z2c %s' %  (flnc_z2c_fn)
+                write_z2c(yield_z2c_from_runs(flnc_runs, cids), flnc_z2c_fn, zmw_table)
+                print 'Writing nfl z2c %s' %  (nfl_z2c_fn)
+                write_z2c(yield_z2c_from_runs(nfl_runs, cids), nfl_z2c_fn, zmw_table)
+                stage.records = len(flnc_runs) + len(nfl_runs)
 
 
 #super slow, ignore
-#def write_other(flnc_z2p, flnc_z2c, nfl_z2p, nfl_z2c):
+#def write_other(flnc_z2p, flnc_z2c, nfl_z2p, nfl_z2c, zmw_table):
 #    print 'Writing orphan flnc zmws %s' %  ('flnc.orphan.csv')
-#    write_ophan_zmws(zmws=flnc_z2p.keys(), simplified_zmws_in_cluster=flnc_z2c.keys(), movie2idx=MOVIE2IDX, o_fn='flnc.orphan.csv')
+#    write_ophan_zmws(zmws=flnc_z2p.keys(), zmws_in_cluster=flnc_z2c, zmw_table=zmw_table, o_fn='flnc.orphan.csv')
 #    print 'Writing orphan nfl zmws %s' %  ('nfl.orphan.csv')
-#    write_ophan_zmws(zmws=nfl_z2p.keys(), simplified_zmws_in_cluster=nfl_z2c.keys(), movie2idx=MOVIE2IDX, o_fn='nfl.orphan.csv')
+#    write_ophan_zmws(zmws=nfl_z2p.keys(), zmws_in_cluster=nfl_z2c, zmw_table=zmw_table, o_fn='nfl.orphan.csv')
 
 
 CLUSTER_REPORT_FN = '/pbi/dept/secondary/siv/smrtlink/smrtlink-alpha/jobs-root/020/020643/tasks/pbtranscript.tasks.separate_flnc-0/combined/all.cluster_report.csv'
 FLNC_FA_FN, NFL_FA_FN = '/pbi/dept/secondary/siv/yli/isoseq/lima/data/flnc.fasta', '/pbi/dept/secondary/siv/yli/isoseq/lima/data/nfl.fasta'
 
+def memory_budget_bytes(memory_budget_mb):
+    """
+    ...doctest:
+        >>> memory_budget_bytes(None), memory_budget_bytes(1.5)
+        (None, 1572864)
+    """
+    return None if memory_budget_mb is None else int(memory_budget_mb * 1024 * 1024)
+
+
 def get_parser():
     """return arg parser"""
     desc = """Find consensus primers of clusters."""
@@ -294,14 +492,29 @@ def get_parser():
     parser.add_argument("nfl_fa_fn", help="Input FLNC FASTA, e.g., %s" % NFL_FA_FN)
     parser.add_argument("cluster_report_fn", help="Input consensus_report_fn, e.g., %s" % CLUSTER_REPORT_FN)
     parser.add_argument("out_dir", help="Output directory")
+    parser.add_argument("--threads", help="Number of processes to parse FASTA files and the cluster report with.", default=1, type=int)
+    parser.add_argument("--memory_budget", help="Spill zmw to cluster links to sorted runs on disk once they take more than this many MB, default: keep in memory", default=None, type=float)
+    parser.add_argument("--tmp_dir", help="Directory of sorted runs spilled under --memory_budget, default: system temp directory", default=None)
+    parser.add_argument("--cluster_dict_csv", help="Also export the binary out_dir/cluster_dict to out_dir/cluster_dict.csv", default=False, action='store_true')
+    parser.add_argument("--z2c_csv", help="Also write out_dir/flnc_z2c.csv and out_dir/nfl_z2c.csv next to the binary z2c directories", default=False, action='store_true')
+    add_cache_arguments(parser)
+    add_output_arguments(parser)
+    add_report_arguments(parser)
     return parser
 
 def run(args):
-    lazy = False
     if not op.exists(args.out_dir):
         raise ValueError("Must create output directory %s" % args.out_dir)
-    flnc_z2p, nfl_z2p = get_all_z2p(args.flnc_fa_fn, args.nfl_fa_fn, o_dir=args.out_dir, lazy=lazy)
-    cluster_to_consensus_primer(args.cluster_report_fn, flnc_z2p, nfl_z2p, args.out_dir)
+    report = run_report_from_args(args, 'cluster-to-consensus-primer')
+    zmw_table = ZmwTable() # movies are added as they are seen in the FASTA files
+    with report.stage('z2p') as stage:
+        flnc_z2p, nfl_z2p = get_all_z2p(args.flnc_fa_fn, args.nfl_fa_fn, o_dir=args.out_dir, zmw_table=zmw_table, threads=args.threads,
+                                        cache=stage_cache_from_args(args), output=output_writer_from_args(args))
+        stage.records = len(flnc_z2p) + len(nfl_z2p)
+    cluster_to_consensus_primer(args.cluster_report_fn, flnc_z2p, nfl_z2p, args.out_dir, zmw_table, write_csv=args.cluster_dict_csv,
+                                memory_budget=memory_budget_bytes(args.memory_budget), tmp_dir=args.tmp_dir,
+                                threads=args.threads, report=report, write_z2c_csv=args.z2c_csv)
+    finish_run_report(report, args)
 
 
 def main():
@@ -0,0 +1,325 @@
+"""
+Batch consensus primers of many clusters at once.
+
+Input is flat arrays over all reads of all clusters: cluster index, int8
+primer (NO_PRIMER for None) and whether the read is FLNC. Primer counts of
+every cluster are computed with one bincount, and majority primers are
+taken per row, which gives the same result as calling
+get_consensus_primer_from_flnc_nfl_primers on every cluster.
+
+PrimerCounts keeps these counts, one row per cluster and one column per
+primer plus a last column of reads without primer, for flnc and nfl reads
+separately. Consensus primers at any min_fraction, or at many of them at
+once, are computed from counts alone without going back to reads.
+
+WeightedConsensus is the weighted counterpart over reads of ICE clusters:
+every read votes for its primer with its posterior within its cluster,
+from ICE log-likelihoods, instead of with 1. Read support of consensus
+primers, i.e., their share of cluster scores times the number of reads of
+the cluster, then weighs votes of clusters of zmws in many clusters, see
+assign.assign_weighted.
+"""
+import numpy as np
+from .primer_store import NO_PRIMER
+
+WEIGHT_TOLERANCE = 1e-9 # relative rounding error of summed float votes allowed at min_fraction
+
+
+def has_min_fraction(best_counts, totals, min_fraction):
+    """Return whether best_counts are >= min_fraction of totals. Float sums of weighted votes may fall a
+    rounding error short, which is forgiven up to WEIGHT_TOLERANCE; integer counts are compared exactly,
+    as in get_most_common_item.
+    ...doctest:
+        >>> has_min_fraction(np.array([9, 8]), np.array([10, 10]), 0.9).tolist()
+        [True, False]
+        >>> has_min_fraction(np.array([0.97] * 9).cumsum()[-1:], np.array([9.7]), 0.9).tolist()
+        [True]
+    """
+    min_counts = totals * min_fraction
+    if np.issubdtype(np.asarray(best_counts).dtype, np.floating):
+        min_counts = min_counts * (1 - WEIGHT_TOLERANCE)
+    return best_counts >= min_counts
+
+
+def primer_count_matrix(cluster_idxs, primers, n_clusters, n_primers):
+    """Return int64 matrix of shape (n_clusters, n_primers) counting primers of each cluster,
+    ignoring NO_PRIMER.
+    ...doctest:
+        >>> primer_count_matrix(np.array([0, 0, 0, 2]), np.array([1, 1, -1, 0]), 3, 2).tolist()
+        [[0, 2], [0, 0], [1, 0]]
+    """
+    cluster_idxs = np.asarray(cluster_idxs, dtype=np.int64)
+    primers = np.asarray(primers, dtype=np.int64)
+    has_primer = primers != NO_PRIMER
+    flat = cluster_idxs[has_primer] * n_primers + primers[has_primer]
+    return np.bincount(flat, minlength=n_clusters * n_primers).reshape(n_clusters, n_primers)
+
+
+def majority_primers(counts, min_fraction):
+    """Return int8 array of the most common primer of each row in counts, if
+    it is >= min_fraction of the row total, otherwise NO_PRIMER.
+    Ties go to the smallest primer, as Counter.most_common does for small ints.
+    ...doctest:
+        >>> majority_primers(np.array([[0, 2], [0, 0], [3, 2], [1, 1]]), 0.6).tolist()
+        [1, -1, 0, -1]
+    """
+    n_clusters, n_primers = counts.shape
+    if n_primers == 0:
+        return np.full(n_clusters, NO_PRIMER, dtype=np.int8)
+    totals = counts.sum(axis=1)
+    best = counts.argmax(axis=1)
+    best_counts = counts[np.arange(n_clusters), best]
+    ok = (totals > 0) & has_min_fraction(best_counts, totals, min_fraction)
+    return np.where(ok, best, NO_PRIMER).astype(np.int8)
+
+
+def majority_primers_sweep(counts, min_fractions):
+    """Return int8 array of shape (len(min_fractions), n_clusters), whose i-th row is
+    majority_primers(counts, min_fractions[i]). The most common primers are found once.
+    ...doctest:
+        >>> majority_primers_sweep(np.array([[0, 2], [0, 0], [3, 2], [1, 1]]), [0.5, 0.6]).tolist()
+        [[1, -1, 0, 0], [1, -1, 0, -1]]
+    """
+    min_fractions = np.asarray(min_fractions, dtype=np.float64).reshape(-1, 1)
+    n_clusters, n_primers = counts.shape
+    if n_primers == 0:
+        return np.full((len(min_fractions), n_clusters), NO_PRIMER, dtype=np.int8)
+    totals = counts.sum(axis=1)
+    best = counts.argmax(axis=1)
+    best_counts = counts[np.arange(n_clusters), best]
+    ok = (totals > 0) & has_min_fraction(best_counts, totals, min_fractions)
+    return np.where(ok, best, NO_PRIMER).astype(np.int8)
+
+
+def flnc_first_consensus(from_flnc, from_both):
+    """Consensus primer from flnc reads first, then from flnc+nfl reads."""
+    return np.where(from_flnc != NO_PRIMER, from_flnc, from_both).astype(np.int8)
+
+
+def consensus_from_counts(flnc_counts, nfl_counts, min_fraction):
+    """Return int8 consensus primers of clusters given their flnc and nfl primer count matrices.
+    ...doctest:
+        >>> consensus_from_counts(np.array([[4, 0], [2, 2], [0, 0]]), np.array([[0, 0], [2, 0], [1, 3]]), 0.6).tolist()
+        [0, 0, 1]
+    """
+    return flnc_first_consensus(majority_primers(flnc_counts, min_fraction),
+                                majority_primers(flnc_counts + nfl_counts, min_fraction))
+
+
+def _pad_primer_columns(counts, n_primers):
+    """Pad a count matrix whose last column counts reads without primer to n_primers primer columns.
+    ...doctest:
+        >>> _pad_primer_columns(np.array([[1, 5]]), 3).tolist()
+        [[1, 0, 0, 5]]
+    """
+    n_missing = n_primers + 1 - counts.shape[1]
+    if n_missing <= 0:
+        return counts
+    return np.hstack([counts[:, :-1], np.zeros((len(counts), n_missing), dtype=np.int64), counts[:, -1:]])
+
+
+class PrimerCounts(object):
+    """Primer counts of flnc and nfl reads of clusters, as int64 matrices of shape
+    (n_clusters, n_primers + 1), whose last column counts reads without primer.
+    ...doctest:
+        >>> c = PrimerCounts.from_reads([0, 0, 0, 1, 1, 1], [0, 0, -1, 1, 1, 0], [1, 1, 1, 1, 0, 0], 2, cids=['c1', 'c2'])
+        >>> c.flnc.tolist(), c.nfl.tolist()
+        ([[2, 0, 1], [0, 1, 0]], [[0, 0, 0], [1, 1, 0]])
+        >>> c.n_clusters, c.n_primers, c.consensus(0.6).tolist()
+        (2, 2, [0, 1])
+        >>> c.sweep([0.6, 1.0]).tolist()
+        [[0, 1], [0, 1]]
+        >>> c = PrimerCounts.concatenate([c, PrimerCounts.from_reads([0], [2], [0], 1, cids=['c3'])])
+        >>> c.cids, c.nfl.tolist()
+        (['c1', 'c2', 'c3'], [[0, 0, 0, 0], [1, 1, 0, 0], [0, 0, 1, 0]])
+        >>> import tempfile, os
+        >>> fn = tempfile.mktemp(suffix='.npz')
+        >>> c.save(fn)
+        >>> d = PrimerCounts.load(fn)
+        >>> d.cids, (d.flnc == c.flnc).all(), (d.nfl == c.nfl).all()
+        (['c1', 'c2', 'c3'], True, True)
+        >>> os.remove(fn)
+    """
+    def __init__(self, flnc, nfl, cids=None):
+        self.flnc = flnc
+        self.nfl = nfl
+        self.cids = cids
+
+    @classmethod
+    def from_reads(cls, cluster_idxs, primers, is_flnc, n_clusters, n_primers=None, cids=None):
+        """Count int8 primers (NO_PRIMER for None) of flnc and nfl reads of n_clusters clusters,
+        given the cluster index of every read."""
+        cluster_idxs = np.asarray(cluster_idxs, dtype=np.int64)
+        primers = np.asarray(primers, dtype=np.int64)
+        is_flnc = np.asarray(is_flnc, dtype=bool)
+        if n_primers is None:
+            n_primers = int(primers.max()) + 1 if len(primers) and primers.max() >= 0 else 0
+        columns = np.where(primers == NO_PRIMER, n_primers, primers) # reads without primer go to the last column
+        return cls(primer_count_matrix(cluster_idxs[is_flnc], columns[is_flnc], n_clusters, n_primers + 1),
+                   primer_count_matrix(cluster_idxs[~is_flnc], columns[~is_flnc], n_clusters, n_primers + 1), cids)
+
+    @classmethod
+    def concatenate(cls, counts_list, cids=None):
+        """Concatenate PrimerCounts of consecutive batches, which may have seen different numbers of primers."""
+        if not counts_list:
+            empty = np.zeros((0, 1), dtype=np.int64)
+            return cls(empty, empty.copy(), [] if cids is None else cids)
+        n_primers = max([counts.n_primers for counts in counts_list])
+        if cids is None and all([counts.cids is not None for counts in counts_list]):
+            cids = [cid for counts in counts_list for cid in counts.cids]
+        return cls(np.vstack([_pad_primer_columns(counts.flnc, n_primers) for counts in counts_list]),
+                   np.vstack([_pad_primer_columns(counts.nfl, n_primers) for counts in counts_list]), cids)
+
+    def __len__(self):
+        return len(self.flnc)
+
+    @property
+    def n_clusters(self):
+        return len(self.flnc)
+
+    @property
+    def n_primers(self):
+        return self.flnc.shape[1] - 1
+
+    @property
+    def flnc_primer_counts(self):
+        """flnc counts of primers, without reads of no primer"""
+        return self.flnc[:, :-1]
+
+    @property
+    def nfl_primer_counts(self):
+        return self.nfl[:, :-1]
+
+    def consensus(self, min_fraction):
+        """Return int8 consensus primers of clusters, as BatchConsensus.consensus"""
+        return consensus_from_counts(self.flnc_primer_counts, self.nfl_primer_counts, min_fraction)
+
+    def sweep(self, min_fractions):
+        """Return int8 array of shape (len(min_fractions), n_clusters) of consensus primers at every min_fraction."""
+        return flnc_first_consensus(majority_primers_sweep(self.flnc_primer_counts, min_fractions),
+                                    majority_primers_sweep(self.flnc_primer_counts + self.nfl_primer_counts, min_fractions))
+
+    def save(self, fn):
+        """Save counts, and cids if any, to an npz file"""
+        arrays = {'flnc': self.flnc, 'nfl': self.nfl}
+        if self.cids is not None:
+            arrays['cids'] = np.array(self.cids, dtype=str)
+        np.savez(fn, **arrays)
+
+    @classmethod
+    def load(cls, fn):
+        with np.load(fn) as d:
+            return cls(d['flnc'], d['nfl'], d['cids'].tolist() if 'cids' in d.files else None)
+
+
+class BatchConsensus(object):
+    """Consensus primers of n_clusters clusters, computed from flat per-read arrays.
+    ...doctest:
+        >>> cluster_idxs = [0, 0, 0, 0, 1, 1, 1, 1, 1, 1, 2, 2, 2, 2, 2, 2]
+        >>> primers =      [0, 0, 0, 0, 0, 0, 1, 1, 0, 0, 0, 0, 1, 1, 0, 1]
+        >>> is_flnc =      [1, 1, 1, 1, 1, 1, 1, 1, 0, 0, 1, 1, 1, 1, 0, 0]
+        >>> b = BatchConsensus(cluster_idxs, primers, is_flnc, 3, 0.6)
+        >>> b.consensus.tolist()
+        [0, 0, -1]
+        >>> b.from_flnc.tolist(), b.from_nfl.tolist(), b.from_both.tolist()
+        ([0, -1, -1], [-1, 0, -1], [0, 0, -1])
+        >>> b.n_disagree, b.disagree_clusters.tolist()
+        (0, [])
+        >>> b = BatchConsensus([1] * 10, [0] * 3 + [1] * 7, [1] * 3 + [0] * 7, 2, 0.6)
+        >>> b.consensus.tolist(), b.n_disagree, b.disagree_clusters.tolist()
+        ([-1, 0], 1, [1])
+    """
+    def __init__(self, cluster_idxs, primers, is_flnc, n_clusters, min_fraction):
+        cluster_idxs = np.asarray(cluster_idxs, dtype=np.int64)
+        primers = np.asarray(primers, dtype=np.int8)
+        is_flnc = np.asarray(is_flnc, dtype=bool)
+        self.min_fraction = min_fraction
+        self.counts = PrimerCounts.from_reads(cluster_idxs, primers, is_flnc, n_clusters)
+        self.flnc_counts = self.counts.flnc_primer_counts
+        self.nfl_counts = self.counts.nfl_primer_counts
+        self.from_flnc = majority_primers(self.flnc_counts, min_fraction)
+        self.from_nfl = majority_primers(self.nfl_counts, min_fraction)
+        self.from_both = majority_primers(self.flnc_counts + self.nfl_counts, min_fraction)
+        self.consensus = flnc_first_consensus(self.from_flnc, self.from_both)
+        # clusters where flnc and flnc+nfl reads give different consensus primers
+        self.disagree_clusters = np.flatnonzero((self.from_flnc != NO_PRIMER) & (self.from_both != NO_PRIMER) &
+                                                (self.from_flnc != self.from_both))
+
+    @property
+    def n_disagree(self):
+        return len(self.disagree_clusters)
+
+
+DEFAULT_TEMPERATURE = 1.0 # log-likelihoods are divided by it before taking posteriors
+
+
+def read_posteriors(cluster_offsets, log_likelihoods, temperature=DEFAULT_TEMPERATURE):
+    """Return posteriors of reads within their clusters, given CSR offsets of clusters in reads sorted by cluster
+    and ICE log-likelihoods of reads: exp(ll / temperature) normalized to sum to 1 over every cluster.
+    NaN log-likelihoods, e.g., of nfl reads, count as the best read of their cluster.
+    ...doctest:
+        >>> read_posteriors(np.array([0, 2, 4, 5]), np.array([-1.0, -1.0, 0.0, -np.log(3), np.nan])).round(2).tolist()
+        [0.5, 0.5, 0.75, 0.25, 1.0]
+    """
+    offsets = np.asarray(cluster_offsets, dtype=np.int64)
+    ll = np.asarray(log_likelihoods, dtype=np.float64) / temperature
+    sizes = np.diff(offsets)
+    if len(ll) == 0:
+        return np.zeros(0, dtype=np.float64)
+    starts = offsets[:-1][sizes > 0]
+    best = np.repeat(np.fmax.reduceat(ll, starts), sizes[sizes > 0]) # NaN if all reads of a cluster are NaN
+    delta = np.where(np.isnan(ll), 0.0, ll - best)
+    delta[np.isnan(delta)] = 0.0
+    posteriors = np.exp(delta)
+    return posteriors / np.repeat(np.add.reduceat(posteriors, starts), sizes[sizes > 0])
+
+
+def primer_score_matrix(cluster_idxs, primers, scores, n_clusters, n_primers):
+    """Return float64 matrix of shape (n_clusters, n_primers + 1) summing scores of reads of each cluster by primer,
+    whose last column sums scores of reads without primer.
+    ...doctest:
+        >>> primer_score_matrix([0, 0, 0, 1], [1, 0, -1, 0], [0.5, 0.25, 0.25, 1.0], 2, 2).tolist()
+        [[0.25, 0.5, 0.25], [1.0, 0.0, 0.0]]
+    """
+    cluster_idxs = np.asarray(cluster_idxs, dtype=np.int64)
+    primers = np.asarray(primers, dtype=np.int64)
+    columns = np.where(primers == NO_PRIMER, n_primers, primers)
+    flat = cluster_idxs * (n_primers + 1) + columns
+    return np.bincount(flat, weights=np.asarray(scores, dtype=np.float64),
+                       minlength=n_clusters * (n_primers + 1)).reshape(n_clusters, n_primers + 1)
+
+
+class WeightedConsensus(object):
+    """Consensus primers of clusters, where every read votes with its posterior within its cluster.
+    As with get_most_common_item of all primers of a cluster, reads without primer vote too, and
+    a cluster has no consensus primer if they win, or if the best primer has < min_fraction of scores.
+    confidence is the score share of the consensus primer, which is in [min_fraction, 1], 0 for clusters without one.
+    support is confidence times the number of reads of the cluster, i.e., the number of reads behind the consensus
+    primer, which grows with the cluster rather than staying near 1, and is how clusters vote for NFL zmws.
+    ...doctest:
+        >>> offsets = [0, 3, 5]
+        >>> primers = [0, 1, 1, 0, -1]
+        >>> w = WeightedConsensus(offsets, primers, [0.0, -3.0, -3.0, -1.0, -1.0], 0.9)
+        >>> w.consensus.tolist(), w.confidence.round(2).tolist(), w.support.round(2).tolist()
+        ([0, -1], [0.91, 0.0], [2.73, 0.0])
+        >>> WeightedConsensus(offsets, primers, [np.nan] * 5, 0.9).consensus.tolist()
+        [-1, -1]
+        >>> WeightedConsensus([0, 70], [0] * 63 + [1] * 7, [-5.0] * 70, 0.9).consensus.tolist() # equal weights, 63 of 70
+        [0]
+    """
+    def __init__(self, cluster_offsets, primers, log_likelihoods, min_fraction, temperature=DEFAULT_TEMPERATURE):
+        cluster_offsets = np.asarray(cluster_offsets, dtype=np.int64)
+        primers = np.asarray(primers, dtype=np.int8)
+        n_clusters = len(cluster_offsets) - 1
+        n_primers = int(primers.max()) + 1 if len(primers) and primers.max() >= 0 else 0
+        cluster_idxs = np.repeat(np.arange(n_clusters, dtype=np.int64), np.diff(cluster_offsets))
+        self.min_fraction = min_fraction
+        self.posteriors = read_posteriors(cluster_offsets, log_likelihoods, temperature)
+        self.scores = primer_score_matrix(cluster_idxs, primers, self.posteriors, n_clusters, n_primers)
+        best = majority_primers(self.scores, min_fraction) # column n_primers is reads without primer
+        self.consensus = np.where(best == n_primers, NO_PRIMER, best).astype(np.int8)
+        totals = self.scores.sum(axis=1)
+        has_cp = self.consensus != NO_PRIMER
+        self.confidence = np.zeros(n_clusters, dtype=np.float64)
+        self.confidence[has_cp] = self.scores[np.flatnonzero(has_cp), self.consensus[has_cp]] / totals[has_cp]
+        self.support = self.confidence * np.diff(cluster_offsets)
@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+"""
+Binary edge lists of ICE cluster pickles.
+
+An ICE final.pickle ('d', {read: {cid: weight}}) of flnc reads, or a
+partial_uc pickle ('partial_uc', {cid: [reads]}) of nfl reads, is loaded once
+and converted to edges (c_prefix index, cid, encoded zmw, weight) sorted by
+cluster, then zmw. Clusters -> zmws are contiguous runs of edges, and zmws ->
+clusters come from one stable argsort by zmw, so neither direction loads the
+pickle again or parses read names again. Pickles of many c_prefix bins can be
+loaded in a process pool, a bounded number at a time, and are merged in
+sorted c_prefix order. An edge list is saved as one raw
+binary file per column, which is memory-mapped when loaded:
+
+    edges_dir/
+        meta.json           kind (flnc or nfl), number of edges and dtypes of columns
+        movies.txt          ZmwTable of encoded zmws
+        c_prefixes.txt      c_prefix of every c_prefix index
+        <column>.bin        raw column data
+"""
+import sys
+import os
+import os.path as op
+import json
+import cPickle
+import multiprocessing
+from argparse import ArgumentParser
+from collections import defaultdict, deque
+import numpy as np
+from .zmw_table import ZmwTable, remap_codes
+from .assign import ZmwClusterLinks
+from .cluster_dict_store import remove_meta_json, write_meta_json
+
+ICE_EDGES_FORMAT_VERSION = 1
+ICE_PICKLE_KEYS = {'flnc': 'd', 'nfl': 'partial_uc'}
+ICE_SHARDS_IN_FLIGHT_PER_THREAD = 2 # pickles loaded or waiting to be merged per process
+
+ICE_EDGES_COLUMNS = [
+    ('c_prefix_idxs', np.int32),
+    ('c_ids', np.int64),
+    ('zmws', np.int64),
+    ('weights', np.float64), # ICE weight of a flnc read in a cluster, NaN for nfl reads
+]
+
+
+def edges_of_flnc_pickle_d(pickle_d, zmw_table, c_prefix=None):
+    """Return (c_ids, zmws, weights) arrays of edges of a flnc pickle dict{read: {cid: weight}} of c_prefix,
+    raise ValueError if a zmw maps to multiple cids, as zmw_to_cid_from_flnc_pickle_d does.
+    ...doctest:
+        >>> t = ZmwTable()
+        >>> c_ids, zmws, weights = edges_of_flnc_pickle_d({'m/7/0_10_CCS': {38: -1.5}}, t)
+        >>> c_ids.tolist(), zmws.tolist(), weights.tolist()
+        ([38], [7], [-1.5])
+        >>> edges_of_flnc_pickle_d({'m/7/0_10_CCS': {38: -1.5, 39: -2.0}}, t, 'p')
+        Traceback (most recent call last):
+        ...
+        ValueError: FLNC zmw m/7 maps to multiple cids ('p', 38), (p, 39)
+    """
+    c_ids, zmws, weights = [], [], []
+    for read, cid2w in pickle_d.iteritems():
+        zmw = zmw_table.encode(read)
+        for c_id, weight in cid2w.iteritems():
+            c_ids.append(c_id)
+            zmws.append(zmw)
+            weights.append(weight)
+    c_ids, zmws = np.array(c_ids, dtype=np.int64), np.array(zmws, dtype=np.int64)
+    order = np.argsort(zmws, kind='mergesort')
+    dup = np.flatnonzero(zmws[order][1:] == zmws[order][:-1])
+    if len(dup):
+        first, second = order[dup[0]], order[dup[0] + 1]
+        raise ValueError("FLNC zmw %s maps to multiple cids %s, (%s, %s)" %
+                         (zmw_table.decode(int(zmws[first])), (c_prefix, int(c_ids[first])), c_prefix, int(c_ids[second])))
+    return c_ids, zmws, np.array(weights, dtype=np.float64)
+
+
+def edges_of_partial_pickle_d(pickle_d, zmw_table):
+    """Return (c_ids, zmws, weights) arrays of edges of a partial_uc pickle dict{cid: [reads]}, weights are NaN.
+    ...doctest:
+        >>> t = ZmwTable()
+        >>> c_ids, zmws, weights = edges_of_partial_pickle_d({5: ['m/1/0_9_CCS', 'm/2/0_9_CCS']}, t)
+        >>> c_ids.tolist(), zmws.tolist(), np.isnan(weights).all()
+        ([5, 5], [1, 2], True)
+    """
+    c_ids, zmws = [], []
+    for c_id, reads_in_c in pickle_d.iteritems():
+        c_ids.extend([c_id] * len(reads_in_c))
+        zmws.extend([zmw_table.encode(read) for read in reads_in_c])
+    return np.array(c_ids, dtype=np.int64), np.array(zmws, dtype=np.int64), np.full(len(zmws), np.nan)
+
+
+def load_ice_pickle_d(pickle_fn, kind):
+    """Load the flnc 'd' or nfl 'partial_uc' dict of an ICE pickle."""
+    with open(pickle_fn, 'rb') as reader:
+        return cPickle.load(reader)[ICE_PICKLE_KEYS[kind]]
+
+
+def edges_of_ice_pickle(pickle_fn, kind, zmw_table, c_prefix=None):
+    """Return (c_ids, zmws, weights) of an ICE pickle of kind flnc or nfl"""
+    pickle_d = load_ice_pickle_d(pickle_fn, kind)
+    if kind == 'flnc':
+        return edges_of_flnc_pickle_d(pickle_d, zmw_table, c_prefix)
+    return edges_of_partial_pickle_d(pickle_d, zmw_table)
+
+
+def _edges_of_ice_pickle_shard(args):
+    """Process pool worker, return (movies, c_ids, zmws, weights) of the ICE pickle of a c_prefix,
+    where zmws are encoded by a ZmwTable local to this shard.
+    """
+    c_prefix, pickle_fn, kind = args
+    zmw_table = ZmwTable()
+    c_ids, zmws, weights = edges_of_ice_pickle(pickle_fn, kind, zmw_table, c_prefix)
+    return (zmw_table.movies, c_ids, zmws, weights)
+
+
+def yield_ice_pickle_shards(kind, c_prefix_to_pickle_fn_dict, zmw_table, threads=1, max_in_flight=None):
+    """Yield (c_prefix, c_ids, zmws, weights) of ICE pickles in sorted c_prefix order, zmws encoded by zmw_table.
+    If threads > 1, pickles are loaded in a pool of threads processes, with at most max_in_flight shards
+    (default ICE_SHARDS_IN_FLIGHT_PER_THREAD * threads) being loaded or waiting to be merged, to cap memory.
+    """
+    tasks = [(c_prefix, c_prefix_to_pickle_fn_dict[c_prefix], kind) for c_prefix in sorted(c_prefix_to_pickle_fn_dict.keys())]
+    if threads <= 1:
+        shards = (_edges_of_ice_pickle_shard(task) for task in tasks)
+    else:
+        shards = _bounded_pool_map(_edges_of_ice_pickle_shard, tasks, threads,
+                                   max_in_flight or ICE_SHARDS_IN_FLIGHT_PER_THREAD * threads)
+    for (c_prefix, pickle_fn, _), (movies, c_ids, zmws, weights) in zip(tasks, shards):
+        yield c_prefix, c_ids, remap_codes(zmws, zmw_table.merge(movies)), weights
+
+
+def _bounded_pool_map(func, tasks, threads, max_in_flight):
+    """Yield func(task) of tasks in order from a pool of threads processes, with at most max_in_flight
+    tasks submitted and not yet yielded."""
+    pool = multiprocessing.Pool(processes=threads)
+    try:
+        in_flight = deque()
+        for task in tasks:
+            if len(in_flight) >= max_in_flight:
+                yield in_flight.popleft().get()
+            in_flight.append(pool.apply_async(func, (task, )))
+        while in_flight:
+            yield in_flight.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class IceEdges(object):
+    """Edges between clusters (c_prefix, cid) and encoded zmws, sorted by cluster, then zmw.
+    ...doctest:
+        >>> t = ZmwTable()
+        >>> e = IceEdges.from_pickle_ds('nfl', {'b': {1: ['m/3/0_1_CCS'], 0: ['m/4/0_1_CCS', 'm/3/0_9_CCS']},
+        ...                                     'a': {2: ['m/4/0_1_CCS']}}, t)
+        >>> len(e), e.n_clusters, e.cids()
+        (4, 3, [('a', 2), ('b', 0), ('b', 1)])
+        >>> sorted(e.c2z().items())
+        [(('a', 2), [4]), (('b', 0), [3, 4]), (('b', 1), [3])]
+        >>> sorted(e.z2c().items())
+        [(3, [('b', 0), ('b', 1)]), (4, [('a', 2), ('b', 0)])]
+        >>> links = e.links()
+        >>> links.zmws.tolist(), links.offsets.tolist(), links.clusters.tolist()
+        ([3, 4], [0, 2, 4], [1, 2, 0, 1])
+    """
+    def __init__(self, kind, c_prefixes, c_prefix_idxs, c_ids, zmws, weights):
+        """Columns must be sorted by (c_prefix_idx, c_id, zmw), see from_unsorted"""
+        self.kind = kind
+        self.c_prefixes = list(c_prefixes)
+        self.c_prefix_idxs = c_prefix_idxs
+        self.c_ids = c_ids
+        self.zmws = zmws
+        self.weights = weights
+        self._cluster_offsets = None
+
+    @classmethod
+    def from_unsorted(cls, kind, c_prefixes, c_prefix_idxs, c_ids, zmws, weights):
+        c_prefix_idxs = np.asarray(c_prefix_idxs, dtype=np.int32)
+        c_ids, zmws = np.asarray(c_ids, dtype=np.int64), np.asarray(zmws, dtype=np.int64)
+        order = np.lexsort((zmws, c_ids, c_prefix_idxs))
+        return cls(kind, c_prefixes, c_prefix_idxs[order], c_ids[order], zmws[order], np.asarray(weights, dtype=np.float64)[order])
+
+    @classmethod
+    def from_pickle_ds(cls, kind, c_prefix_to_pickle_d, zmw_table):
+        """Edges of dict{c_prefix: flnc or nfl pickle dict} of ICE pickles already loaded"""
+        c_prefixes = sorted(c_prefix_to_pickle_d.keys())
+        if kind == 'flnc':
+            parts = [edges_of_flnc_pickle_d(c_prefix_to_pickle_d[c_prefix], zmw_table, c_prefix) for c_prefix in c_prefixes]
+        else:
+            parts = [edges_of_partial_pickle_d(c_prefix_to_pickle_d[c_prefix], zmw_table) for c_prefix in c_prefixes]
+        return cls._from_parts(kind, c_prefixes, parts)
+
+    @classmethod
+    def from_pickles(cls, kind, c_prefix_to_pickle_fn_dict, zmw_table, threads=1, max_in_flight=None):
+        """Edges of dict{c_prefix: ICE pickle file} of kind flnc or nfl, loading every pickle once,
+        in a pool of threads processes if threads > 1, see yield_ice_pickle_shards."""
+        c_prefixes, parts = [], []
+        for c_prefix, c_ids, zmws, weights in yield_ice_pickle_shards(kind, c_prefix_to_pickle_fn_dict, zmw_table,
+                                                                      threads=threads, max_in_flight=max_in_flight):
+            c_prefixes.append(c_prefix)
+            parts.append((c_ids, zmws, weights))
+        return cls._from_parts(kind, c_prefixes, parts)
+
+    @classmethod
+    def _from_parts(cls, kind, c_prefixes, parts):
+        """parts: (c_ids, zmws, weights) of each c_prefix"""
+        c_prefix_idxs = [np.full(len(c_ids), i, dtype=np.int32) for i, (c_ids, zmws, weights) in enumerate(parts)]
+        columns = [np.concatenate([part[i] for part in parts]) if parts else np.zeros(0) for i in range(3)]
+        return cls.from_unsorted(kind, c_prefixes, np.concatenate(c_prefix_idxs) if parts else np.zeros(0, dtype=np.int32), *columns)
+
+    def __len__(self):
+        return len(self.zmws)
+
+    @property
+    def cluster_offsets(self):
+        """CSR offsets of clusters: edges of the i-th cluster are [cluster_offsets[i], cluster_offsets[i+1])"""
+        if self._cluster_offsets is None:
+            new = np.ones(len(self), dtype=bool)
+            new[1:] = (self.c_prefix_idxs[1:] != self.c_prefix_idxs[:-1]) | (self.c_ids[1:] != self.c_ids[:-1])
+            self._cluster_offsets = np.append(np.flatnonzero(new), len(self)).astype(np.int64)
+        return self._cluster_offsets
+
+    @property
+    def n_clusters(self):
+        return len(self.cluster_offsets) - 1
+
+    def cids(self):
+        """(c_prefix, cid) of every cluster, in edge order"""
+        starts = self.cluster_offsets[:-1]
+        return [(self.c_prefixes[p], c) for p, c in zip(self.c_prefix_idxs[starts].tolist(), self.c_ids[starts].tolist())]
+
+    def cluster_idxs(self):
+        """Index of the cluster of every edge"""
+        return np.repeat(np.arange(self.n_clusters, dtype=np.int64), np.diff(self.cluster_offsets))
+
+    def c2z(self):
+        """Return defaultdict{(c_prefix, cid): [encoded zmws]}, as cid_to_zmws_from_*_pickle_fns"""
+        c2z = defaultdict(lambda: [])
+        zmws, offsets = self.zmws.tolist(), self.cluster_offsets.tolist()
+        for cid, start, end in zip(self.cids(), offsets[:-1], offsets[1:]):
+            c2z[cid] = zmws[start:end]
+        return c2z
+
+    def z2c(self):
+        """Return {encoded zmw: (c_prefix, cid)} of flnc edges, as zmw_to_cid_from_flnc_pickle_fns, where
+        a zmw in several c_prefixes keeps its cid of the last c_prefix, or
+        defaultdict{encoded zmw: [(c_prefix, cid)]} of nfl edges in cluster order, as zmw_to_cids_from_partial_pickle_fns"""
+        cids = self.cids()
+        if self.kind == 'flnc':
+            return dict(zip(self.zmws.tolist(), [cids[i] for i in self.cluster_idxs().tolist()]))
+        links = self.links()
+        z2c = defaultdict(lambda: [])
+        clusters, offsets = links.clusters.tolist(), links.offsets.tolist()
+        for zmw, start, end in zip(links.zmws.tolist(), offsets[:-1], offsets[1:]):
+            z2c[zmw] = [cids[i] for i in clusters[start:end]]
+        return z2c
+
+    def links(self):
+        """Return ZmwClusterLinks of zmws to indices of their clusters in cids(), in cluster order"""
+        order = np.argsort(self.zmws, kind='mergesort') # stable, clusters of a zmw stay in cluster order
+        zmws = self.zmws[order]
+        new = np.ones(len(zmws), dtype=bool)
+        new[1:] = zmws[1:] != zmws[:-1]
+        starts = np.flatnonzero(new)
+        return ZmwClusterLinks(zmws[starts], np.append(starts, len(zmws)), self.cluster_idxs()[order])
+
+    def save(self, edges_dir, zmw_table):
+        """Save columns to edges_dir, to be memory-mapped by load. meta.json of an existing edges_dir is
+        removed first and written last, so that an interrupted rewrite is not taken for a complete edges_dir."""
+        if not op.exists(edges_dir):
+            os.makedirs(edges_dir)
+        remove_meta_json(edges_dir)
+        for name, dtype in ICE_EDGES_COLUMNS:
+            np.asarray(getattr(self, name), dtype=dtype).tofile(op.join(edges_dir, name + '.bin'))
+        zmw_table.write(op.join(edges_dir, 'movies.txt'))
+        with open(op.join(edges_dir, 'c_prefixes.txt'), 'w') as writer:
+            for c_prefix in self.c_prefixes:
+                writer.write('%s\n' % c_prefix)
+        meta = {'format': 'ice_edges', 'version': ICE_EDGES_FORMAT_VERSION, 'kind': self.kind, 'n_edges': len(self),
+                'columns': dict([(name, np.dtype(dtype).str) for name, dtype in ICE_EDGES_COLUMNS])}
+        write_meta_json(edges_dir, meta)
+
+    @classmethod
+    def load(cls, edges_dir, zmw_table):
+        """Memory-map edges saved by save, re-encoding zmws by zmw_table if its movie indices differ.
+        c_prefixes are read back as strings. Raise ValueError if a column does not hold n_edges of meta.json.
+        ...doctest:
+            >>> import tempfile, shutil
+            >>> d = tempfile.mkdtemp()
+            >>> t = ZmwTable()
+            >>> IceEdges.from_pickle_ds('flnc', {'p': {'m0/3/0_1_CCS': {7: -2.0}, 'm1/5/0_1_CCS': {6: -1.0}}}, t).save(d, t)
+            >>> t2 = ZmwTable(['m1'])
+            >>> e = IceEdges.load(d, t2)
+            >>> e.kind, sorted(t2.decode_keys(e.z2c()).items()), e.weights.tolist()
+            ('flnc', [('m0/3', ('p', 7)), ('m1/5', ('p', 6))], [-1.0, -2.0])
+            >>> np.zeros(3).tofile(op.join(d, 'weights.bin')) # a column of another save
+            >>> IceEdges.load(d, t2)
+            Traceback (most recent call last):
+            ...
+            ValueError: Column weights of ... has 3 edges, not n_edges 2 of meta.json
+            >>> shutil.rmtree(d)
+        """
+        with open(op.join(edges_dir, 'meta.json'), 'r') as reader:
+            meta = json.load(reader)
+        if meta.get('version') != ICE_EDGES_FORMAT_VERSION:
+            raise ValueError("Unsupported ice_edges version %s in %s" % (meta.get('version'), edges_dir))
+        columns = {}
+        for name, dtype in ICE_EDGES_COLUMNS:
+            fn = op.join(edges_dir, name + '.bin')
+            columns[name] = np.memmap(fn, dtype=dtype, mode='r') if op.getsize(fn) else np.zeros(0, dtype=dtype)
+            if len(columns[name]) != meta['n_edges']:
+                raise ValueError("Column %s of %s has %d edges, not n_edges %d of meta.json" %
+                                 (name, edges_dir, len(columns[name]), meta['n_edges']))
+        movie_idx_map = zmw_table.merge(ZmwTable.read(op.join(edges_dir, 'movies.txt')).movies)
+        if movie_idx_map != range(len(movie_idx_map)):
+            columns['zmws'] = remap_codes(columns['zmws'], movie_idx_map) # keeps sort order within a cluster only
+            order = np.lexsort((columns['zmws'], columns['c_ids'], columns['c_prefix_idxs']))
+            columns = dict([(name, col[order]) for name, col in columns.iteritems()])
+        with open(op.join(edges_dir, 'c_prefixes.txt'), 'r') as reader:
+            c_prefixes = [line.rstrip('\n') for line in reader]
+        return cls(str(meta['kind']), c_prefixes, columns['c_prefix_idxs'], columns['c_ids'], columns['zmws'], columns['weights'])
+
+
+def is_ice_edges_dir(path):
+    """Return True if path is an edges directory saved by IceEdges.save"""
+    return op.isdir(path) and op.exists(op.join(path, 'meta.json')) and op.exists(op.join(path, 'c_prefixes.txt'))
+
+
+def get_ice_edges(kind, c_prefix_to_pickle_fn_dict, zmw_table, threads=1):
+    """Return IceEdges of kind, given either dict{c_prefix: ICE pickle file}, loaded in a pool
+    of threads processes, or an edges directory."""
+    if isinstance(c_prefix_to_pickle_fn_dict, basestring) and is_ice_edges_dir(c_prefix_to_pickle_fn_dict):
+        edges = IceEdges.load(c_prefix_to_pickle_fn_dict, zmw_table)
+        if edges.kind != kind:
+            raise ValueError("%s has %s edges, expecting %s" % (c_prefix_to_pickle_fn_dict, edges.kind, kind))
+        return edges
+    return IceEdges.from_pickles(kind, c_prefix_to_pickle_fn_dict, zmw_table, threads=threads)
+
+
+def ice_input_fns(src):
+    """Files read by get_ice_edges of src, for StageCache input_fns"""
+    if isinstance(src, basestring):
+        return [op.join(src, fn) for fn in ['meta.json', 'movies.txt', 'c_prefixes.txt']] + \
+               [op.join(src, name + '.bin') for name, dtype in ICE_EDGES_COLUMNS]
+    return sorted(src.values())
+
+
+def ice_params(src):
+    """Parameters of src, for StageCache params"""
+    return src if isinstance(src, basestring) else sorted(src.items())
+
+
+def parse_c_prefix_pickle_fn(s):
+    """
+    ...doctest:
+        >>> parse_c_prefix_pickle_fn('0to1kb_part0=/a/final.pickle')
+        ('0to1kb_part0', '/a/final.pickle')
+    """
+    if '=' not in s:
+        raise ValueError("Must be c_prefix=pickle_fn: %s" % s)
+    return tuple(s.split('=', 1))
+
+
+def get_parser():
+    """return arg parser"""
+    desc = """Convert ICE final.pickle (flnc) or partial_uc pickle (nfl) files of cluster bins into a memory-mapped edge list."""
+    parser = ArgumentParser(description=desc)
+    parser.add_argument("kind", choices=sorted(ICE_PICKLE_KEYS), help="flnc for final.pickle ('d'), nfl for partial_uc pickle ('partial_uc')")
+    parser.add_argument("edges_dir", help="Output edges directory")
+    parser.add_argument("pickle_fns", nargs='+', type=parse_c_prefix_pickle_fn,
+                        help="c_prefix=pickle_fn of every cluster bin, e.g., 13to14kb_part0=cluster_out/output/final.pickle")
+    parser.add_argument("--threads", help="Number of processes to load pickles with.", default=1, type=int)
+    parser.add_argument("--max_in_flight", help="Maximum number of pickles loaded at once, default: %d per process" % ICE_SHARDS_IN_FLIGHT_PER_THREAD,
+                        default=None, type=int)
+    return parser
+
+
+def run(args):
+    zmw_table = ZmwTable()
+    edges = IceEdges.from_pickles(args.kind, dict(args.pickle_fns), zmw_table, threads=args.threads, max_in_flight=args.max_in_flight)
+    print 'Writing %s edges of %s %s clusters to %s' % (len(edges), edges.n_clusters, args.kind, args.edges_dir)
+    edges.save(args.edges_dir, zmw_table)
+
+
+def main():
+    """main"""
+    sys.exit(run(get_parser().parse_args(sys.argv[1:])))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""
+Run reports of stages of a command.
+
+RunReport.stage(name) measures wall time, CPU time of this process and of
+finished worker processes, peak RSS and records processed per second of a
+block, and Progress prints a line with rate and ETA every progress_interval
+seconds of a long loop, e.g., over bytes of a cluster report. A RunReport
+can also run cProfile over the whole command, and is written as JSON:
+
+    {"command": ..., "argv": [...], "wall_seconds": ..., "cpu_seconds": ..., "peak_rss_mb": ...,
+     "stages": [{"name": ..., "wall_seconds": ..., "cpu_seconds": ..., "peak_rss_mb": ...,
+                 "records": ..., "records_per_sec": ...}],
+     "profile": [{"function": ..., "calls": ..., "total_seconds": ..., "cumulative_seconds": ...}]}
+
+A RunReport() with default arguments prints nothing, so functions taking a
+report=None keyword only pay for a few clock reads per stage.
+"""
+import sys
+import os
+import time
+import json
+import datetime
+import resource
+import cProfile
+import pstats
+from contextlib import contextmanager
+
+PROGRESS_INTERVAL = 60 # seconds between progress lines of command line tools
+PROFILE_TOP_FUNCTIONS = 30 # functions of cProfile in a run report, by cumulative time
+
+
+def cpu_seconds():
+    """User and system CPU seconds of this process and of its waited-for children"""
+    user, system, children_user, children_system = os.times()[:4]
+    return user + system + children_user + children_system
+
+
+def peak_rss_mb():
+    """Peak resident set size in MB of this process or of its largest waited-for child, whichever is larger"""
+    maxrss = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    return round(maxrss / (1024.0 * 1024.0 if sys.platform == 'darwin' else 1024.0), 1) # bytes on macOS, KB on Linux
+
+
+def format_seconds(seconds):
+    """
+    ...doctest:
+        >>> format_seconds(3725.4)
+        '1:02:05'
+    """
+    return str(datetime.timedelta(seconds=int(round(seconds))))
+
+
+class Progress(object):
+    """Count records of a long loop and, every interval seconds, write a line with
+    records, records per second and, given the position out of total (e.g., bytes), an ETA.
+    ...doctest:
+        >>> import StringIO
+        >>> out = StringIO.StringIO()
+        >>> p = Progress('cluster report', total=200, interval=0, stream=out)
+        >>> p.start_time -= 10
+        >>> p.update(500, position=50)
+        >>> out.getvalue()
+        'cluster report: 500 records, 25.0% of 200 bytes, 50 records/sec, ETA 0:00:30\\n'
+    """
+    def __init__(self, label, total=None, unit='bytes', interval=PROGRESS_INTERVAL, stream=None):
+        self.label, self.total, self.unit, self.interval = label, total, unit, interval
+        self.stream = stream
+        self.records, self.position = 0, None
+        self.start_time = self.last_time = time.time()
+
+    def update(self, n_records, position=None):
+        """Add n_records processed, up to position of total"""
+        self.records += n_records
+        if position is not None:
+            self.position = position
+        if self.stream is None or self.interval is None:
+            return
+        now = time.time()
+        if now - self.last_time >= self.interval:
+            self.last_time = now
+            self.stream.write(self.line(now) + '\n')
+            self.stream.flush()
+
+    def line(self, now=None):
+        elapsed = max((now or time.time()) - self.start_time, 1e-9)
+        fields = ['%s: %d records' % (self.label, self.records)]
+        if self.total and self.position is not None:
+            fields.append('%.1f%% of %d %s' % (100.0 * self.position / self.total, self.total, self.unit))
+        fields.append('%.0f records/sec' % (self.records / elapsed))
+        if self.total and self.position:
+            fields.append('ETA %s' % format_seconds(elapsed * (self.total - self.position) / self.position))
+        return ', '.join(fields)
+
+
+class StageStats(object):
+    """Measures of a stage, records is set or added to by the code of the stage."""
+    def __init__(self, name):
+        self.name = name
+        self.records = None
+        self.wall_seconds = self.cpu_seconds = self.peak_rss_mb = None
+
+    def add(self, n):
+        self.records = (self.records or 0) + n
+
+    @property
+    def records_per_sec(self):
+        if self.records is None or not self.wall_seconds:
+            return None
+        return round(self.records / self.wall_seconds, 1)
+
+    def to_dict(self):
+        return {'name': self.name, 'wall_seconds': self.wall_seconds, 'cpu_seconds': self.cpu_seconds,
+                'peak_rss_mb': self.peak_rss_mb, 'records': self.records, 'records_per_sec': self.records_per_sec}
+
+    def __str__(self):
+        s = '[%s] %.2f sec wall, %.2f sec cpu, peak rss %.1f MB' % (self.name, self.wall_seconds, self.cpu_seconds, self.peak_rss_mb)
+        if self.records is not None:
+            s += ', %d records, %s records/sec' % (self.records, self.records_per_sec)
+        return s
+
+
+class RunReport(object):
+    """Stages of a command. stream gets a line per finished stage and progress lines every
+    progress_interval seconds, both off by default; profile runs cProfile between start and finish.
+    ...doctest:
+        >>> report = RunReport('demo')
+        >>> with report.stage('count') as stage:
+        ...     stage.records = 10
+        >>> [(s.name, s.records) for s in report.stages], report.stages[0].wall_seconds >= 0
+        ([('count', 10)], True)
+        >>> sorted(report.to_dict()['stages'][0].keys())
+        ['cpu_seconds', 'name', 'peak_rss_mb', 'records', 'records_per_sec', 'wall_seconds']
+    """
+    def __init__(self, command=None, argv=None, stream=None, progress_interval=None, profile=False):
+        self.command, self.argv = command, list(argv or [])
+        self.stream, self.progress_interval = stream, progress_interval
+        self.stages = []
+        self.profiler = cProfile.Profile() if profile else None
+        self.start_wall, self.start_cpu = time.time(), cpu_seconds()
+        self.wall_seconds = self.cpu_seconds = None
+
+    def start(self):
+        self.start_wall, self.start_cpu = time.time(), cpu_seconds()
+        if self.profiler is not None:
+            self.profiler.enable()
+
+    def finish(self):
+        if self.profiler is not None:
+            self.profiler.disable()
+        self.wall_seconds = round(time.time() - self.start_wall, 4)
+        self.cpu_seconds = round(cpu_seconds() - self.start_cpu, 4)
+
+    @contextmanager
+    def stage(self, name):
+        """Measure the enclosed block as stage name, yield its StageStats"""
+        stats = StageStats(name)
+        start_wall, start_cpu = time.time(), cpu_seconds()
+        yield stats
+        stats.wall_seconds = round(time.time() - start_wall, 4)
+        stats.cpu_seconds = round(cpu_seconds() - start_cpu, 4)
+        stats.peak_rss_mb = peak_rss_mb()
+        self.stages.append(stats)
+        if self.stream is not None:
+            self.stream.write(str(stats) + '\n')
+            self.stream.flush()
+
+    def progress(self, label, total=None, unit='bytes'):
+        """Return a Progress of a loop, writing to stream every progress_interval seconds"""
+        return Progress(label, total=total, unit=unit, interval=self.progress_interval, stream=self.stream)
+
+    def profile_rows(self, n=PROFILE_TOP_FUNCTIONS):
+        """Top n functions of cProfile by cumulative time"""
+        if self.profiler is None:
+            return []
+        stats = pstats.Stats(self.profiler).stats # {(file, line, function): (primitive calls, calls, total, cumulative, callers)}
+        rows = sorted(stats.items(), key=lambda item: -item[1][3])[:n]
+        return [{'function': '%s:%d(%s)' % func, 'calls': calls, 'total_seconds': round(total, 4), 'cumulative_seconds': round(cum, 4)}
+                for func, (primitive_calls, calls, total, cum, callers) in rows]
+
+    def to_dict(self):
+        d = {'command': self.command, 'argv': self.argv, 'start_time': datetime.datetime.fromtimestamp(self.start_wall).isoformat(),
+             'wall_seconds': self.wall_seconds, 'cpu_seconds': self.cpu_seconds, 'peak_rss_mb': peak_rss_mb(),
+             'stages': [stats.to_dict() for stats in self.stages]}
+        if self.profiler is not None:
+            d['profile'] = self.profile_rows()
+        return d
+
+    def write(self, fn):
+        """Write the report as JSON to fn, and cProfile stats to fn.prof if profiling"""
+        with open(fn, 'w') as writer:
+            json.dump(self.to_dict(), writer, indent=2, sort_keys=True)
+        if self.profiler is not None:
+            self.profiler.dump_stats(fn + '.prof')
+
+
+def add_report_arguments(parser):
+    """Add --report_json, --profile and --progress_interval to an argument parser."""
+    parser.add_argument("--report_json", help="Write wall time, CPU time, peak RSS and records per second of every stage to this JSON file", default=None)
+    parser.add_argument("--profile", help="Also run cProfile, adding top functions to --report_json and writing stats to <report_json>.prof",
+                        default=False, action='store_true')
+    parser.add_argument("--progress_interval", help="Seconds between progress lines of long loops, 0 for every batch, default: %s" % PROGRESS_INTERVAL,
+                        default=PROGRESS_INTERVAL, type=float)
+
+
+def run_report_from_args(args, command):
+    """Return a RunReport of command writing stage and progress lines to stdout, started."""
+    report = RunReport(command, argv=sys.argv[1:], stream=sys.stdout, progress_interval=args.progress_interval,
+                       profile=args.profile)
+    report.start()
+    return report
+
+
+def finish_run_report(report, args):
+    """Finish report, and write it to --report_json if given"""
+    report.finish()
+    if args.report_json is not None:
+        report.write(args.report_json)
+        print 'Wrote run report %s' % args.report_json
@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+"""
+Resident lookup service of demultiplexing outputs.
+
+`demultiplex-lookup serve out_dir socket` loads zmw -> consensus primer of
+flnc and nfl zmws (flnc_z2cp.npz or .csv written by isoseq-demultiplex) as
+ZmwPrimerStores, and cluster -> consensus primer from primer_counts.npz or a
+memory-mapped cluster_dict, once, and answers batched queries of any number
+of jobs over a Unix domain socket, one thread per connection sharing the
+same tables.
+
+Requests and responses are one JSON object per line:
+
+    {"op": "zmw", "keys": ["movie/12", "movie/13/0_100_CCS"], "reads": "flnc"}
+        -> {"buckets": ["primer0", "no_cid_no_cprimer"]}
+    {"op": "cluster", "keys": ["i0_ICE_sample00|c1"]}
+        -> {"primers": [1], "missing": []}
+    {"op": "stats"}
+        -> {"requests": ..., "keys": ..., "keys_per_sec": ..., "latency_ms": {"mean": ..., "p50": ..., "p99": ...}}
+
+reads is flnc, nfl, or omitted to look in flnc, then nfl. Buckets are those
+of split-by-primer: primer<p>, cid_no_cprimer and no_cid_no_cprimer.
+LookupClient is the Python client.
+"""
+import sys
+import os
+import os.path as op
+import json
+import time
+import errno
+import signal
+import socket
+import threading
+import SocketServer
+from argparse import ArgumentParser
+from collections import deque
+import numpy as np
+from .zmw_table import ZmwTable, encode_movie_zmw
+from .primer_store import int8_to_primer
+from .consensus import PrimerCounts
+from .cluster_dict_store import ClusterDictStore, is_cluster_dict_dir
+from .split import load_z2cp, bucket_codes, bucket_name, NO_CID
+
+LOOKUP_READS = ['flnc', 'nfl']
+Z2CP_EXTS = ['.npz', '.csv', '.csv.gz', '.csv.bz2'] # in order of preference
+LATENCY_WINDOW = 10000 # latest requests kept for latency percentiles
+UNKNOWN_ZMW = -1 # code of zmws of movies not in the table, in no store
+
+
+def find_z2cp_fn(out_dir, reads):
+    """Return out_dir/<reads>_z2cp.<ext> of the first ext in Z2CP_EXTS that exists, or None"""
+    for ext in Z2CP_EXTS:
+        fn = op.join(out_dir, '%s_z2cp%s' % (reads, ext))
+        if op.exists(fn):
+            return fn
+    return None
+
+
+class LookupTables(object):
+    """Read-only zmw -> consensus primer stores {reads: ZmwPrimerStore} and cid -> int8 consensus primer,
+    shared by all connections of a LookupServer.
+    ...doctest:
+        >>> from .primer_store import ZmwPrimerStore
+        >>> t = ZmwTable(['m'])
+        >>> tables = LookupTables(t, {'flnc': ZmwPrimerStore.from_dict({1: 0}), 'nfl': ZmwPrimerStore.from_dict({1: 1, 2: None})},
+        ...                       {'c1': 1, 'c2': -1})
+        >>> tables.zmw_buckets(['m/1/ccs', 'm/2', 'm/3', 'other/1'])
+        ['primer0', 'cid_no_cprimer', 'no_cid_no_cprimer', 'no_cid_no_cprimer']
+        >>> tables.zmw_buckets(['m/1'], reads='nfl')
+        ['primer1']
+        >>> tables.cluster_primers(['c2', 'c3', 'c1'])
+        ([None, None, 1], [1])
+    """
+    def __init__(self, zmw_table, z2cp_by_reads, c2cp):
+        self.zmw_table = zmw_table
+        self.z2cp_by_reads = z2cp_by_reads
+        self.c2cp = c2cp
+
+    @classmethod
+    def from_out_dir(cls, out_dir, min_fraction=0.6, cluster_dict_dir=None):
+        """Load <reads>_z2cp of out_dir, and consensus primers of clusters from cluster_dict_dir if given,
+        else from out_dir/primer_counts.npz at min_fraction"""
+        zmw_table = ZmwTable()
+        z2cp_by_reads = {}
+        for reads in LOOKUP_READS:
+            fn = find_z2cp_fn(out_dir, reads)
+            if fn is None:
+                raise ValueError("Could not find %s_z2cp%s in %s" % (reads, '|'.join(Z2CP_EXTS), out_dir))
+            z2cp_by_reads[reads] = load_z2cp(fn, zmw_table)
+        if cluster_dict_dir is not None:
+            if not is_cluster_dict_dir(cluster_dict_dir):
+                raise ValueError("%s is not a cluster_dict directory" % cluster_dict_dir)
+            store = ClusterDictStore(cluster_dict_dir)
+            c2cp = dict(zip(store.cids, store.consensus.tolist()))
+        else:
+            counts = PrimerCounts.load(op.join(out_dir, 'primer_counts.npz'))
+            if counts.cids is None:
+                raise ValueError("primer_counts.npz of %s has no cluster ids" % out_dir)
+            c2cp = dict(zip(counts.cids, counts.consensus(min_fraction).tolist()))
+        return cls(zmw_table, z2cp_by_reads, c2cp)
+
+    def encode(self, name):
+        """Encode a zmw or read name without adding its movie to the table, which is shared by threads"""
+        movie, zmw_id = name.split('/', 2)[0:2]
+        movie_idx = self.zmw_table.movie2idx.get(movie)
+        return UNKNOWN_ZMW if movie_idx is None else encode_movie_zmw(movie_idx, int(zmw_id))
+
+    def zmw_buckets(self, names, reads=None):
+        """Return buckets of zmws or reads in z2cp of reads, or in flnc, then nfl if reads is None"""
+        zmws = np.array([self.encode(str(name)) for name in names], dtype=np.int64)
+        if reads is not None:
+            if reads not in self.z2cp_by_reads:
+                raise ValueError("reads must be one of %s, not %s" % (LOOKUP_READS, reads))
+            codes = bucket_codes(self.z2cp_by_reads[reads], zmws)
+        else:
+            codes = np.full(len(zmws), NO_CID, dtype=np.int64)
+            for reads in LOOKUP_READS:
+                unseen = codes == NO_CID
+                codes[unseen] = bucket_codes(self.z2cp_by_reads[reads], zmws[unseen])
+        return [bucket_name(code) for code in codes.tolist()]
+
+    def cluster_primers(self, cids):
+        """Return (consensus primers of clusters, None for no consensus or unknown cids; indices of unknown cids)"""
+        primers, missing = [], []
+        for i, cid in enumerate(cids):
+            p = self.c2cp.get(str(cid))
+            if p is None:
+                missing.append(i)
+            primers.append(None if p is None else int8_to_primer(p))
+        return primers, missing
+
+    def describe(self):
+        return ', '.join(['%d %s zmws' % (len(self.z2cp_by_reads[reads]), reads) for reads in LOOKUP_READS] +
+                         ['%d clusters' % len(self.c2cp)])
+
+
+class LookupStats(object):
+    """Requests, keys, and latency of the latest LATENCY_WINDOW requests, updated by all connections.
+    ...doctest:
+        >>> s = LookupStats()
+        >>> s.add(10, 0.002); s.add(30, 0.004)
+        >>> d = s.to_dict()
+        >>> d['requests'], d['keys'], d['latency_ms']['mean'], d['latency_ms']['p50']
+        (2, 40, 3.0, 3.0)
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.requests, self.keys, self.busy_seconds = 0, 0, 0.0
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+
+    def add(self, n_keys, seconds):
+        with self.lock:
+            self.requests += 1
+            self.keys += n_keys
+            self.busy_seconds += seconds
+            self.latencies.append(seconds)
+
+    def to_dict(self):
+        with self.lock:
+            latencies = np.array(self.latencies, dtype=np.float64) * 1000.0
+            d = {'requests': self.requests, 'keys': self.keys, 'uptime_seconds': round(time.time() - self.start_time, 3),
+                 'keys_per_sec': round(self.keys / self.busy_seconds, 1) if self.busy_seconds > 0 else None}
+        d['latency_ms'] = ({'mean': round(latencies.mean(), 4), 'p50': round(np.percentile(latencies, 50), 4),
+                            'p99': round(np.percentile(latencies, 99), 4), 'max': round(latencies.max(), 4)}
+                           if len(latencies) else None)
+        return d
+
+
+class LookupHandler(SocketServer.StreamRequestHandler):
+    """Answer JSON requests of a connection, one per line, until the client closes it."""
+    def handle(self):
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            start = time.time()
+            try:
+                response, n_keys = self.server.answer(json.loads(line))
+            except (ValueError, KeyError, TypeError) as e:
+                response, n_keys = {'error': '%s: %s' % (type(e).__name__, e)}, 0
+            self.wfile.write(json.dumps(response) + '\n')
+            self.wfile.flush()
+            if 'error' not in response and response.get('op') != 'stats':
+                self.server.stats.add(n_keys, time.time() - start)
+
+
+class LookupServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """Threaded Unix socket server of LookupTables."""
+    daemon_threads = True
+
+    def __init__(self, socket_path, tables):
+        remove_stale_socket(socket_path)
+        SocketServer.UnixStreamServer.__init__(self, socket_path, LookupHandler)
+        self.socket_path, self.tables = socket_path, tables
+        self.stats = LookupStats()
+
+    def answer(self, request):
+        """Return (response, number of keys) of a request, raise ValueError if it is malformed"""
+        if not isinstance(request, dict):
+            raise ValueError("Request must be a JSON object, not %s" % type(request).__name__)
+        op_ = request.get('op')
+        if op_ == 'zmw':
+            keys = _request_keys(request)
+            return {'buckets': self.tables.zmw_buckets(keys, reads=request.get('reads'))}, len(keys)
+        if op_ == 'cluster':
+            keys = _request_keys(request)
+            primers, missing = self.tables.cluster_primers(keys)
+            return {'primers': primers, 'missing': missing}, len(keys)
+        if op_ == 'stats':
+            d = self.stats.to_dict()
+            d['op'] = 'stats'
+            return d, 0
+        raise ValueError("op must be zmw, cluster or stats, not %s" % op_)
+
+    def server_close(self):
+        SocketServer.UnixStreamServer.server_close(self)
+        if op.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def _request_keys(request):
+    """Return keys of a zmw or cluster request, raise ValueError unless they are a JSON list"""
+    keys = request.get('keys')
+    if not isinstance(keys, list):
+        raise ValueError("keys must be a JSON list, not %s" % type(keys).__name__)
+    return keys
+
+
+def remove_stale_socket(socket_path):
+    """Remove socket_path left by a server that is gone, raise ValueError if a server still listens on it"""
+    if not op.exists(socket_path):
+        return
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(socket_path)
+    except socket.error as e:
+        if e.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+            raise
+        os.remove(socket_path)
+        return
+    finally:
+        sock.close()
+    raise ValueError("A lookup server is already listening on %s" % socket_path)
+
+
+class LookupClient(object):
+    """Client of a LookupServer, sending batched queries over one connection.
+    ...doctest:
+        >>> import tempfile, shutil
+        >>> from .primer_store import ZmwPrimerStore
+        >>> d = tempfile.mkdtemp()
+        >>> tables = LookupTables(ZmwTable(['m']), {'flnc': ZmwPrimerStore.from_dict({1: 0}), 'nfl': ZmwPrimerStore.from_dict({})}, {'c1': 1})
+        >>> server = LookupServer(op.join(d, 'lookup.sock'), tables)
+        >>> thread = threading.Thread(target=server.serve_forever); thread.start()
+        >>> with LookupClient(op.join(d, 'lookup.sock')) as client:
+        ...     client.zmw_buckets(['m/1', 'm/2']), client.cluster_primers(['c1', 'c2']), client.stats()['keys']
+        (['primer0', 'no_cid_no_cprimer'], ([1, None], [1]), 4)
+        >>> with LookupClient(op.join(d, 'lookup.sock')) as client:
+        ...     for request in [['m/1'], {'op': 'zmw', 'keys': 'm/1'}]:
+        ...         try:
+        ...             client.request(request)
+        ...         except ValueError as e:
+        ...             print e
+        ...     client.zmw_buckets(['m/1'])
+        ValueError: Request must be a JSON object, not list
+        ValueError: keys must be a JSON list, not unicode
+        ['primer0']
+        >>> server.shutdown(); server.server_close(); thread.join()
+        >>> shutil.rmtree(d)
+    """
+    def __init__(self, socket_path, timeout=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.sock.connect(socket_path)
+        self.reader = self.sock.makefile('rb')
+
+    def request(self, request):
+        self.sock.sendall(json.dumps(request) + '\n')
+        line = self.reader.readline()
+        if not line:
+            raise ValueError("Lookup server closed the connection")
+        response = json.loads(line)
+        if 'error' in response:
+            raise ValueError(response['error'])
+        return response
+
+    def zmw_buckets(self, names, reads=None):
+        """Return buckets of zmws or read names, in reads flnc or nfl, or in either if reads is None"""
+        request = {'op': 'zmw', 'keys': list(names)}
+        if reads is not None:
+            request['reads'] = reads
+        return [str(bucket) for bucket in self.request(request)['buckets']]
+
+    def cluster_primers(self, cids):
+        """Return (consensus primers of clusters, indices of unknown cids)"""
+        response = self.request({'op': 'cluster', 'keys': list(cids)})
+        return response['primers'], response['missing']
+
+    def stats(self):
+        return self.request({'op': 'stats'})
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+
+def serve(tables, socket_path):
+    """Serve tables on socket_path until interrupted or terminated"""
+    server = LookupServer(socket_path, tables)
+    signal.signal(signal.SIGTERM, _interrupt)
+    print 'Serving %s on %s' % (tables.describe(), socket_path)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print 'Served %s' % json.dumps(server.stats.to_dict(), sort_keys=True)
+
+
+def get_parser():
+    """return arg parser"""
+    desc = """Serve consensus primers of zmws and clusters of isoseq-demultiplex outputs to many jobs over a Unix socket."""
+    parser = ArgumentParser(description=desc)
+    subparsers = parser.add_subparsers(dest='subcommand')
+    serve_parser = subparsers.add_parser('serve', help="Load outputs once and answer queries until interrupted")
+    serve_parser.add_argument("out_dir", help="Output directory of isoseq-demultiplex, with flnc_z2cp, nfl_z2cp (npz or csv) and primer_counts.npz")
+    serve_parser.add_argument("socket_path", help="Unix socket to listen on")
+    serve_parser.add_argument("--min_fraction", help="Minimum fraction of consensus primers of clusters from primer_counts.npz", default=0.6, type=float)
+    serve_parser.add_argument("--cluster_dict", help="Read consensus primers of clusters from this cluster_dict instead of primer_counts.npz", default=None)
+
+    query_parser = subparsers.add_parser('query', help="Query a running lookup server, printing one key and answer per line")
+    query_parser.add_argument("socket_path", help="Unix socket of the lookup server")
+    query_parser.add_argument("--zmw", help="zmws or read names, e.g., movie/12", nargs='*', default=[])
+    query_parser.add_argument("--reads", help="Look up zmws in flnc or nfl only", choices=LOOKUP_READS, default=None)
+    query_parser.add_argument("--cluster", help="Cluster ids", nargs='*', default=[])
+    query_parser.add_argument("--stats", help="Print requests, throughput and latency of the server", default=False, action='store_true')
+    return parser
+
+
+def run(args):
+    if args.subcommand == 'serve':
+        serve(LookupTables.from_out_dir(args.out_dir, min_fraction=args.min_fraction, cluster_dict_dir=args.cluster_dict), args.socket_path)
+        return
+    with LookupClient(args.socket_path) as client:
+        if args.zmw:
+            for name, bucket in zip(args.zmw, client.zmw_buckets(args.zmw, reads=args.reads)):
+                print '%s\t%s' % (name, bucket)
+        if args.cluster:
+            for cid, primer in zip(args.cluster, client.cluster_primers(args.cluster)[0]):
+                print '%s\t%s' % (cid, primer)
+        if args.stats:
+            print json.dumps(client.stats(), indent=2, sort_keys=True)
+
+
+def main():
+    """main"""
+    sys.exit(run(get_parser().parse_args(sys.argv[1:])))
+
+if __name__ == "__main__":
+    main()
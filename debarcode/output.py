@@ -0,0 +1,280 @@
+"""
+Output layer of write_dict.
+
+A dict, or a ZmwPrimerStore, is written as o_prefix.<format> in each of the
+chosen formats:
+
+    csv      tab-separated key and value, with a header line
+    json     {key: value}
+    pickle   dict{key: value}, with the highest pickle protocol
+    npz      movie table, movie indices, zmw ids and int8 primers, only for
+             zmw -> primer; compressed by np.savez_compressed if compression is set
+
+Lines of csv and json are formatted in bulk, a chunk of entries per write,
+and ZmwPrimerStore values are formatted straight from its arrays. Files of
+different formats are written concurrently on a thread pool, optionally
+compressed with gzip or bz2 from the standard library, and each file is
+written to a temporary name, optionally fsync-ed, closed and then renamed, so
+a partial file never takes the place of a complete one.
+"""
+import os
+import os.path as op
+import gzip
+import bz2
+import json
+from json.encoder import encode_basestring_ascii
+import cPickle
+import threading
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from .zmw_table import ZMW_BITS, ZMW_MASK
+from .primer_store import ZmwPrimerStore, NO_PRIMER
+
+OUTPUT_FORMATS = ('csv', 'json', 'pickle', 'npz')
+DEFAULT_OUTPUT_FORMATS = ('csv', 'json', 'pickle')
+COMPRESSIONS = ('gz', 'bz2')
+WRITE_CHUNK_SIZE = 1024 * 1024 # entries formatted per write
+
+
+def parse_formats(s):
+    """
+    ...doctest:
+        >>> parse_formats('csv,npz')
+        ['csv', 'npz']
+        >>> parse_formats('csv,xml')
+        Traceback (most recent call last):
+        ...
+        ValueError: Unknown output format xml, must be one of csv,json,pickle,npz
+    """
+    formats = [f.strip() for f in s.split(',') if f.strip()]
+    for f in formats:
+        if f not in OUTPUT_FORMATS:
+            raise ValueError("Unknown output format %s, must be one of %s" % (f, ','.join(OUTPUT_FORMATS)))
+    return formats
+
+
+def _chunks(items, size=WRITE_CHUNK_SIZE):
+    for start in xrange(0, len(items), size):
+        yield items[start:start+size]
+
+
+class DictEntries(object):
+    """Keys and values of a dict or a ZmwPrimerStore to write, keys decoded to 'movie/zmw' if zmw_table is not None.
+    Decoded keys are computed once and shared by writers of all formats."""
+    def __init__(self, d, zmw_table=None):
+        self.d, self.zmw_table = d, zmw_table
+        self.is_store = isinstance(d, ZmwPrimerStore) and zmw_table is not None
+        self._str_keys = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.d)
+
+    def str_keys(self):
+        """Keys as strings, as %s formats them"""
+        with self._lock:
+            if self._str_keys is None:
+                self._str_keys = self._format_keys()
+            return self._str_keys
+
+    def _format_keys(self):
+        if self.is_store:
+            zmws = self.d.zmws
+            movies = np.array(self.zmw_table.movies, dtype=object)[zmws >> ZMW_BITS]
+            return [movie + '/' + zmw_id for movie, zmw_id in zip(movies.tolist(), (zmws & ZMW_MASK).astype(str).tolist())]
+        if self.zmw_table is not None:
+            return [self.zmw_table.decode(k) for k in self.d.iterkeys()]
+        return ['%s' % (k, ) for k in self.d.iterkeys()]
+
+    def primer_strs(self, none_str):
+        """Values of a ZmwPrimerStore as strings, NO_PRIMER as none_str"""
+        primers = self.d.primers_arr.astype(np.int64)
+        table = np.array([none_str] + [str(p) for p in range(int(primers.max()) + 1 if len(primers) else 0)], dtype=object)
+        return table[np.where(primers == NO_PRIMER, 0, primers + 1)].tolist()
+
+    def str_values(self):
+        if self.is_store:
+            return self.primer_strs('None')
+        return ['%s' % (v, ) for v in self.d.itervalues()]
+
+    def json_values(self):
+        if self.is_store:
+            return self.primer_strs('null')
+        return [json.dumps(v) for v in self.d.itervalues()]
+
+    def to_dict(self):
+        if self.is_store:
+            return dict(zip(self.str_keys(), self.d.primers(self.d.zmws)))
+        if self.zmw_table is not None:
+            return dict(zip(self.str_keys(), self.d.itervalues()))
+        return dict(self.d)
+
+
+def write_csv(writer, entries, headers):
+    writer.write("\t".join(headers) + "\n")
+    for lines in _chunks(zip(entries.str_keys(), entries.str_values())):
+        writer.write(''.join(["%s\t%s\n" % kv for kv in lines]))
+
+
+def write_json(writer, entries, headers):
+    """Write entries as a json object, keys as json strings"""
+    writer.write('{')
+    keys = entries.str_keys()
+    for i, pairs in enumerate(_chunks(zip(keys, entries.json_values()))):
+        if i > 0:
+            writer.write(', ')
+        writer.write(', '.join(['%s: %s' % (encode_basestring_ascii(k), v) for k, v in pairs]))
+    writer.write('}')
+
+
+def write_pickle(writer, entries, headers):
+    cPickle.dump(entries.to_dict(), writer, cPickle.HIGHEST_PROTOCOL)
+
+
+def write_npz(writer, entries, headers):
+    """Write zmw -> primer as arrays: movies, movie index and zmw id of each zmw, and int8 primers"""
+    store = entries.d
+    if not isinstance(store, ZmwPrimerStore):
+        store = ZmwPrimerStore.from_dict(entries.d)
+    movies = entries.zmw_table.movies if entries.zmw_table is not None else []
+    savez = np.savez_compressed if getattr(writer, 'compress_npz', False) else np.savez
+    savez(writer, movies=np.array(movies, dtype=str), movie_idxs=store.zmws >> ZMW_BITS,
+          zmw_ids=store.zmws & ZMW_MASK, primers=store.primers_arr)
+
+
+class Bz2Writer(object):
+    """Minimal bz2 compressing file object over an open raw file, as bz2.BZ2File does not take a file object."""
+    def __init__(self, raw):
+        self.raw = raw
+        self.compressor = bz2.BZ2Compressor()
+
+    def write(self, data):
+        self.raw.write(self.compressor.compress(data))
+
+    def close(self):
+        self.raw.write(self.compressor.flush())
+
+
+class NpzFile(object):
+    """Raw file for np.savez, which asks for np.savez_compressed instead of a compressed stream."""
+    def __init__(self, raw, compress_npz):
+        self.raw, self.compress_npz = raw, compress_npz
+
+    def __getattr__(self, name):
+        return getattr(self.raw, name)
+
+
+FORMAT_WRITERS = {'csv': write_csv, 'json': write_json, 'pickle': write_pickle, 'npz': write_npz}
+
+
+def is_zmw_primer_dict(d):
+    """Return True if d can be written as npz, i.e., is a ZmwPrimerStore or maps ints to primers or None.
+    ...doctest:
+        >>> is_zmw_primer_dict({1: 0, 2: None}), is_zmw_primer_dict({1: 'cid_no_cprimer'})
+        (True, False)
+    """
+    if isinstance(d, ZmwPrimerStore):
+        return True
+    return all([isinstance(k, (int, long)) and (v is None or isinstance(v, (int, long))) for k, v in d.iteritems()])
+
+
+class OutputWriter(object):
+    """Write dicts in formats, compressed by compression (None, 'gz' or 'bz2'), with threads
+    concurrent file writes (None for one per format), fsync-ing files before closing them if fsync.
+    ...doctest:
+        >>> import tempfile, shutil, pickle
+        >>> from .zmw_table import ZmwTable
+        >>> d = tempfile.mkdtemp()
+        >>> w = OutputWriter(['csv', 'json', 'pickle', 'npz'], compression='gz')
+        >>> fns = w.write_dict(ZmwPrimerStore.from_dict({4294967299: 1, 2: None}), op.join(d, 'z2p'), ['zmw', 'primer'], ZmwTable(['m0', 'm1']))
+        >>> [op.basename(fn) for fn in fns]
+        ['z2p.csv.gz', 'z2p.json.gz', 'z2p.pickle.gz', 'z2p.npz']
+        >>> gzip.open(fns[0]).read().splitlines()
+        ['zmw\\tprimer', 'm0/2\\tNone', 'm1/3\\t1']
+        >>> sorted(json.load(gzip.open(fns[1])).items()), sorted(pickle.load(gzip.open(fns[2])).items())
+        ([(u'm0/2', None), (u'm1/3', 1)], [('m0/2', None), ('m1/3', 1)])
+        >>> np.load(fns[3])['primers'].tolist()
+        [-1, 1]
+        >>> fns = OutputWriter(['csv', 'npz'], compression='bz2', threads=1).write_dict({'c1': None}, op.join(d, 'c2cp'), ['cid', 'cp'])
+        Warning: skipping npz of c2cp, it only holds zmw -> primer
+        >>> bz2.BZ2File(fns[0]).read()
+        'cid\\tcp\\nc1\\tNone\\n'
+        >>> OutputWriter(['json']).write_dict({'c1': object()}, op.join(d, 'bad'), ['cid', 'cp'])
+        Traceback (most recent call last):
+        ...
+        TypeError: <object object at ...> is not JSON serializable
+        >>> sorted(os.listdir(d))
+        ['c2cp.csv.bz2', 'z2p.csv.gz', 'z2p.json.gz', 'z2p.npz', 'z2p.pickle.gz']
+        >>> shutil.rmtree(d)
+    """
+    def __init__(self, formats=DEFAULT_OUTPUT_FORMATS, compression=None, threads=None, fsync=False):
+        self.formats = list(formats)
+        self.compression = compression
+        self.threads = threads
+        self.fsync = fsync
+        if compression is not None and compression not in COMPRESSIONS:
+            raise ValueError("Unknown compression %s, must be one of %s" % (compression, ','.join(COMPRESSIONS)))
+
+    def output_fn(self, o_prefix, fmt):
+        fn = o_prefix + '.' + fmt
+        return fn + '.' + self.compression if self.compression and fmt != 'npz' else fn
+
+    def _writer(self, raw, fmt):
+        if fmt == 'npz':
+            return NpzFile(raw, self.compression is not None)
+        if self.compression == 'gz':
+            return gzip.GzipFile(filename='', fileobj=raw, mode='wb')
+        if self.compression == 'bz2':
+            return Bz2Writer(raw)
+        return raw
+
+    def write_file(self, fn, fmt, entries, headers):
+        """Write entries to fn through a temporary file, which is renamed to fn once complete,
+        or removed if writing fails."""
+        tmp_fn = op.join(op.dirname(fn), '.' + op.basename(fn) + '.tmp')
+        try:
+            with open(tmp_fn, 'wb') as raw:
+                writer = self._writer(raw, fmt)
+                FORMAT_WRITERS[fmt](writer, entries, headers)
+                if writer is not raw and not isinstance(writer, NpzFile):
+                    writer.close() # flush compressed data, raw stays open
+                if self.fsync:
+                    raw.flush()
+                    os.fsync(raw.fileno())
+            os.rename(tmp_fn, fn)
+        except:
+            if op.exists(tmp_fn):
+                os.remove(tmp_fn)
+            raise
+        return fn
+
+    def write_dict(self, d, o_prefix, headers, zmw_table=None):
+        """Write d as o_prefix.<format> of all formats, return written files."""
+        entries = DictEntries(d, zmw_table)
+        formats = self.formats
+        if 'npz' in formats and not is_zmw_primer_dict(d):
+            print 'Warning: skipping npz of %s, it only holds zmw -> primer' % (op.basename(o_prefix))
+            formats = [f for f in formats if f != 'npz']
+        tasks = [(self.output_fn(o_prefix, fmt), fmt) for fmt in formats]
+        n_threads = len(tasks) if self.threads is None else self.threads
+        if n_threads <= 1 or len(tasks) <= 1:
+            return [self.write_file(fn, fmt, entries, headers) for fn, fmt in tasks]
+        pool = ThreadPool(min(n_threads, len(tasks)))
+        try:
+            return pool.map(lambda task: self.write_file(task[0], task[1], entries, headers), tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+
+def add_output_arguments(parser):
+    """Add --formats, --compression, --write_threads and --fsync to an argument parser."""
+    parser.add_argument("--formats", help="Comma separated output formats of %s, default: %s" % (','.join(OUTPUT_FORMATS), ','.join(DEFAULT_OUTPUT_FORMATS)),
+                        default=list(DEFAULT_OUTPUT_FORMATS), type=parse_formats)
+    parser.add_argument("--compression", help="Compress output files", default=None, choices=COMPRESSIONS)
+    parser.add_argument("--write_threads", help="Number of output files written at once, default: one per format", default=None, type=int)
+    parser.add_argument("--fsync", help="fsync output files before closing them", default=False, action='store_true')
+
+
+def output_writer_from_args(args):
+    return OutputWriter(args.formats, compression=args.compression, threads=args.write_threads, fsync=args.fsync)
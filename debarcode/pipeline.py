@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+"""
+Single-pass demultiplexing, i.e., cluster-to-consensus-primer followed by
+zmw-to-consensus-primer in one process.
+
+Instead of writing flnc_z2c.csv, nfl_z2c.csv and cluster_dict and parsing
+them back, zmw -> cluster links of flnc and nfl reads are kept as int64
+(zmw, cluster index) pairs in ZmwClusterRuns, which spill to sorted runs on
+disk under --memory_budget, and consensus primers of clusters as an int8
+array. Intermediate files are only written with --write_intermediates.
+
+`update` keeps primers of zmws in a DemuxProject, so that adding SMRT Cells
+only parses FASTA files of the new cells. Only FASTA parsing is incremental:
+the cluster report is read in full and consensus primers of all clusters are
+computed again every time, since adding cells may change membership of
+existing clusters.
+"""
+import sys
+import os.path as op
+from argparse import ArgumentParser
+import numpy as np
+from .utils import get_z2p_stores, write_dict
+from .zmw_table import ZmwTable
+from .primer_store import ZmwPrimerStore
+from .cluster_dict_store import ClusterDictWriter
+from .zmw_cluster_runs import ZmwClusterRuns
+from .project import DemuxProject
+from .consensus import PrimerCounts
+from .sweep import SweepTable, parse_sweep
+from .output import add_output_arguments, output_writer_from_args
+from .background import BackgroundWriter
+from .split import split_fastas, add_split_arguments, split_buffer_size_bytes
+from .instrument import RunReport, add_report_arguments, run_report_from_args, finish_run_report
+from .stage_cache import (add_cache_arguments, stage_cache_from_args, save_primer_stores, load_primer_stores,
+                          save_pickle, load_pickle)
+from .cluster_ids import ClusterIds, last_of_clusters
+from .cluster_to_consensus_primer import (yield_batch_consensus, write_disagree_cids, add_batch_to_z2c_runs,
+                                          write_z2c_dir, memory_budget_bytes, CLUSTER_REPORT_FN, FLNC_FA_FN, NFL_FA_FN)
+
+
+Z2CP_STAGE_VERSION = 2 # bumped when results of the cached z2cp stage change
+
+
+def _concatenate(arrays, dtype):
+    return np.concatenate(arrays).astype(dtype) if arrays else np.zeros(0, dtype=dtype)
+
+
+def last_cluster_of_cids(cids):
+    """Return index of the last cluster of the cid of every cluster, as c2cp[cid] keeps it.
+    ...doctest:
+        >>> last_cluster_of_cids(['a', 'b', 'a']).tolist()
+        [2, 1, 2]
+    """
+    idxs = ClusterIds().indices(cids)
+    return last_of_clusters(idxs, int(idxs.max()) + 1 if len(idxs) else 0)[idxs]
+
+
+def consensus_by_cid(cids, consensus):
+    """Return int8 consensus primer of every cluster as c2cp[cid] would give it,
+    i.e., when a cid occurs in more than one cluster, the last cluster wins.
+    ...doctest:
+        >>> consensus_by_cid(['a', 'b', 'a'], np.array([0, 1, -1])).tolist()
+        [-1, 1, -1]
+    """
+    return np.asarray(consensus, dtype=np.int8)[last_cluster_of_cids(cids)]
+
+
+def z2cp_from_last_clusters(last_clusters, consensus):
+    """Return ZmwPrimerStore{encoded_zmw: consensus primer}, given (zmws, last cluster indices)
+    of ZmwClusterRuns.last_clusters and int8 consensus primers of clusters.
+    ...doctest:
+        >>> runs = ZmwClusterRuns()
+        >>> runs.add([5, 3, 5], [0, 1, 1])
+        >>> sorted(z2cp_from_last_clusters(runs.last_clusters(), np.array([0, -1], dtype=np.int8)).iteritems())
+        [(3, None), (5, None)]
+    """
+    zmws, last_idxs = last_clusters
+    return ZmwPrimerStore(zmws, consensus[last_idxs])
+
+
+def demultiplex(flnc_fa_fn, nfl_fa_fn, cluster_report_fn, out_dir, zmw_table, min_fraction=0.6, threads=1,
+                write_intermediates=False, memory_budget=None, tmp_dir=None, cache=None, sweep=None, output=None, report=None):
+    """Return (flnc_z2cp, nfl_z2cp) as ZmwPrimerStore{encoded_zmw: consensus primer},
+    and write primer counts of clusters to out_dir/primer_counts.npz.
+    If write_intermediates, also write z2p files and the binary cluster_dict and z2c directories of
+    cluster-to-consensus-primer to out_dir. zmw -> cluster links are spilled to
+    sorted runs in tmp_dir once they take more than memory_budget bytes.
+    If cache is a StageCache, z2p of FASTA files and, unless write_intermediates,
+    z2cp are reused when their inputs and parameters are unchanged, so that
+    changing min_fraction does not parse FASTA files again.
+    If sweep is a list of min_fraction values, also write numbers of zmws per
+    category at each of them to out_dir/min_fraction_sweep.txt, see SweepTable.
+    Intermediate files are written by OutputWriter output, and stages are measured by RunReport report."""
+    report = RunReport() if report is None else report
+    with report.stage('z2p') as stage:
+        z2p_stores = get_z2p_stores(flnc_fa_fn, nfl_fa_fn, zmw_table, threads=threads, cache=cache)
+        stage.records = sum([len(store) for store in z2p_stores])
+    compute = lambda: _demultiplex(z2p_stores, cluster_report_fn, out_dir, zmw_table, min_fraction, threads,
+                                   write_intermediates, memory_budget, tmp_dir, sweep=sweep, output=output, report=report)
+    if cache is None or write_intermediates or sweep:
+        flnc_z2cp, nfl_z2cp, disagree_cids, counts, sweep_table = compute()
+    else:
+        flnc_z2cp, nfl_z2cp, disagree_cids, counts, sweep_table = cache.cached('z2cp', compute, save=lambda result, entry_dir: _save_z2cp(result, zmw_table, entry_dir),
+                                                          load=lambda entry_dir: _load_z2cp(entry_dir, zmw_table),
+                                                          input_fns=[cluster_report_fn], params={'min_fraction': min_fraction, 'version': Z2CP_STAGE_VERSION}, deps=[z2p_stores])
+    write_disagree_cids(disagree_cids, op.join(out_dir, 'consensus_disagree_cids.txt'))
+    counts.save(op.join(out_dir, 'primer_counts.npz'))
+    if sweep_table is not None:
+        write_sweep_table(sweep_table, op.join(out_dir, 'min_fraction_sweep.txt'))
+    return flnc_z2cp, nfl_z2cp
+
+
+def write_sweep_table(sweep_table, fn):
+    print 'Writing min_fraction sweep %s' % (fn)
+    sweep_table.write(fn)
+    print '\t'.join(sweep_table.header())
+    for row in sweep_table.rows:
+        print '\t'.join([str(x) for x in row])
+
+
+def _save_z2cp(result, zmw_table, entry_dir):
+    """Save (flnc_z2cp, nfl_z2cp, disagree_cids, PrimerCounts) of _demultiplex to a StageCache entry."""
+    flnc_z2cp, nfl_z2cp, disagree_cids, counts, sweep_table = result
+    save_primer_stores([flnc_z2cp, nfl_z2cp], zmw_table, entry_dir)
+    save_pickle(disagree_cids, entry_dir)
+    counts.save(op.join(entry_dir, 'primer_counts.npz'))
+
+
+def _load_z2cp(entry_dir, zmw_table):
+    """Load (flnc_z2cp, nfl_z2cp, disagree_cids, PrimerCounts, None) saved by _save_z2cp, re-encoding zmws by zmw_table."""
+    flnc_z2cp, nfl_z2cp = load_primer_stores(entry_dir, zmw_table)
+    return flnc_z2cp, nfl_z2cp, load_pickle(entry_dir), PrimerCounts.load(op.join(entry_dir, 'primer_counts.npz')), None
+
+
+def _demultiplex(z2p_stores, cluster_report_fn, out_dir, zmw_table, min_fraction, threads,
+                 write_intermediates, memory_budget, tmp_dir, sweep=None, output=None, report=None):
+    """Return (flnc_z2cp, nfl_z2cp, disagree_cids, PrimerCounts of clusters, SweepTable or None).
+    If sweep is a list of min_fraction values, zmws are also assigned at each of them into a SweepTable."""
+    report = RunReport() if report is None else report
+    flnc_z2p, nfl_z2p = z2p_stores
+    if write_intermediates:
+        write_dict(flnc_z2p, o_prefix=op.join(out_dir, 'flnc_z2p'), headers=['flnc_zmw', 'classify_primer'], zmw_table=zmw_table, output=output)
+        write_dict(nfl_z2p, o_prefix=op.join(out_dir, 'nfl_z2p'), headers=['nfl_zmw', 'classify_primer'], zmw_table=zmw_table, output=output)
+        cluster_dict_writer = ClusterDictWriter(op.join(out_dir, 'cluster_dict'))
+
+    # run files are removed on exit, also on errors
+    with ZmwClusterRuns(memory_budget=memory_budget, tmp_dir=tmp_dir) as flnc_runs, \
+            ZmwClusterRuns(memory_budget=memory_budget, tmp_dir=tmp_dir) as nfl_runs:
+        cids, consensus, disagree_cids, counts = [], [], [], []
+        with report.stage('consensus') as stage:
+            progress = report.progress('cluster report', total=op.getsize(cluster_report_fn))
+            with BackgroundWriter() as writer:
+                for batch, primers, batch_consensus in yield_batch_consensus(cluster_report_fn, flnc_z2p, nfl_z2p, zmw_table, min_fraction, threads, progress):
+                    add_batch_to_z2c_runs(flnc_runs, nfl_runs, batch, len(cids))
+                    cids.extend(batch.cids)
+                    consensus.append(batch_consensus.consensus)
+                    counts.append(batch_consensus.counts)
+                    disagree_cids.extend([batch.cids[i] for i in batch_consensus.disagree_clusters])
+                    if write_intermediates:
+                        writer.submit(cluster_dict_writer.write, batch.cids, batch.offsets, batch.zmws, batch.is_fl, primers, batch_consensus.consensus)
+            stage.records = progress.records
+
+        if write_intermediates:
+            with report.stage('z2c') as stage:
+                cluster_dict_writer.close(zmw_table)
+                write_z2c_dir(flnc_runs, op.join(out_dir, 'flnc_z2c'), cids, zmw_table)
+                write_z2c_dir(nfl_runs, op.join(out_dir, 'nfl_z2c'), cids, zmw_table)
+                stage.records = len(flnc_runs) + len(nfl_runs)
+
+        with report.stage('z2cp') as stage:
+            consensus = _concatenate(consensus, np.int8)
+            counts = PrimerCounts.concatenate(counts, cids=cids)
+            cluster_idx_of_cids = last_cluster_of_cids(cids)
+            consensus = consensus[cluster_idx_of_cids]
+            flnc_last, nfl_last = flnc_runs.last_clusters(), nfl_runs.last_clusters()
+            flnc_z2cp, nfl_z2cp = z2cp_from_last_clusters(flnc_last, consensus), z2cp_from_last_clusters(nfl_last, consensus)
+            stage.records = len(flnc_z2cp) + len(nfl_z2cp)
+    sweep_table = None
+    if sweep:
+        with report.stage('sweep') as stage:
+            sweep_table = SweepTable(counts, cluster_idx_of_cids, sweep, {'flnc': (flnc_last, flnc_z2p.zmws), 'nfl': (nfl_last, nfl_z2p.zmws)})
+            stage.records = len(sweep)
+    return flnc_z2cp, nfl_z2cp, disagree_cids, counts, sweep_table
+
+
+def update_project(project, flnc_fa_fn, nfl_fa_fn, cluster_report_fn, out_dir, zmw_table, min_fraction=0.6, threads=1,
+                   memory_budget=None, tmp_dir=None, report=None):
+    """Add FASTA files of new movies to DemuxProject project, parsing only FASTA files that
+    are new or changed, and return (flnc_z2cp, nfl_z2cp) of all movies in the project
+    given the updated cluster report. Stages are measured by RunReport report."""
+    report = RunReport() if report is None else report
+    with report.stage('z2p') as stage:
+        project.add_fasta('flnc', flnc_fa_fn, threads=threads)
+        project.add_fasta('nfl', nfl_fa_fn, threads=threads)
+        z2p_stores = project.z2p_stores(zmw_table)
+        stage.records = sum([len(store) for store in z2p_stores])
+    flnc_z2cp, nfl_z2cp, disagree_cids, counts, _ = _demultiplex(z2p_stores, cluster_report_fn, out_dir, zmw_table, min_fraction, threads,
+                                                                 False, memory_budget, tmp_dir, report=report)
+    write_disagree_cids(disagree_cids, op.join(out_dir, 'consensus_disagree_cids.txt'))
+    counts.save(op.join(out_dir, 'primer_counts.npz'))
+    return flnc_z2cp, nfl_z2cp
+
+
+def _add_common_arguments(parser):
+    parser.add_argument("--min_fraction", help="Minimum fraction of consensus primer among all known primers.", default=0.6, type=float)
+    parser.add_argument("--threads", help="Number of processes to parse FASTA files and the cluster report with.", default=1, type=int)
+    parser.add_argument("--memory_budget", help="Spill zmw to cluster links to sorted runs on disk once they take more than this many MB, default: keep in memory", default=None, type=float)
+    parser.add_argument("--tmp_dir", help="Directory of sorted runs spilled under --memory_budget, default: system temp directory", default=None)
+    parser.add_argument("--split", help="Also split FASTA reads into out_dir/flnc.<primer>.fasta, out_dir/nfl.<primer>.fasta, " +
+                        "and cid_no_cprimer and no_cid_no_cprimer files of both", default=False, action='store_true')
+    add_split_arguments(parser)
+    add_output_arguments(parser)
+    add_report_arguments(parser)
+
+
+def get_parser():
+    """return arg parser"""
+    desc = """Demultiplex zmws of a barcoded isoseq run to primers based on clustering."""
+    parser = ArgumentParser(description=desc)
+    subparsers = parser.add_subparsers(dest='subcommand')
+    run_parser = subparsers.add_parser('run', help="Link zmws to consensus primers of their clusters in one pass, " +
+                                       "i.e., cluster-to-consensus-primer followed by zmw-to-consensus-primer")
+    run_parser.add_argument("flnc_fa_fn", help="Input FLNC FASTA, e.g., %s" % FLNC_FA_FN)
+    run_parser.add_argument("nfl_fa_fn", help="Input NFL FASTA, e.g., %s" % NFL_FA_FN)
+    run_parser.add_argument("cluster_report_fn", help="Input consensus_report_fn, e.g., %s" % CLUSTER_REPORT_FN)
+    run_parser.add_argument("out_dir", help="Output directory")
+    _add_common_arguments(run_parser)
+    run_parser.add_argument("--sweep", help="Also count zmws assigned to each primer, cid_no_cprimer and no_cid_no_cprimer " +
+                            "at every min_fraction in start:stop:step, e.g., 0.5:0.95:0.05, and write them to out_dir/min_fraction_sweep.txt",
+                            default=None, type=parse_sweep)
+    run_parser.add_argument("--write_intermediates", help="Also write z2p files and binary z2c and cluster_dict directories of cluster-to-consensus-primer",
+                            default=False, action='store_true')
+    add_cache_arguments(run_parser)
+
+    update_parser = subparsers.add_parser('update', help="Add FASTA files of new SMRT Cells to an incremental project and " +
+                                          "link zmws of all cells to consensus primers of clusters in the updated cluster report; only FASTA parsing is incremental")
+    update_parser.add_argument("project_dir", help="Project directory of per-movie primers of FASTA files already parsed, created if it does not exist")
+    update_parser.add_argument("flnc_fa_fn", help="Input FLNC FASTA of new movies, FASTA files already in the project are not parsed again")
+    update_parser.add_argument("nfl_fa_fn", help="Input NFL FASTA of new movies")
+    update_parser.add_argument("cluster_report_fn", help="Input consensus_report_fn of all movies, e.g., %s" % CLUSTER_REPORT_FN)
+    update_parser.add_argument("out_dir", help="Output directory")
+    _add_common_arguments(update_parser)
+    return parser
+
+def run(args):
+    if not op.exists(args.out_dir):
+        raise ValueError("Must create output directory %s" % args.out_dir)
+    report = run_report_from_args(args, 'isoseq-demultiplex %s' % args.subcommand)
+    zmw_table = ZmwTable() # movies are added as they are seen in the FASTA files
+    output = output_writer_from_args(args)
+    if args.subcommand == 'update':
+        flnc_z2cp, nfl_z2cp = update_project(DemuxProject(args.project_dir), args.flnc_fa_fn, args.nfl_fa_fn, args.cluster_report_fn,
+                                             args.out_dir, zmw_table, min_fraction=args.min_fraction, threads=args.threads,
+                                             memory_budget=memory_budget_bytes(args.memory_budget), tmp_dir=args.tmp_dir, report=report)
+    else:
+        flnc_z2cp, nfl_z2cp = demultiplex(args.flnc_fa_fn, args.nfl_fa_fn, args.cluster_report_fn, args.out_dir, zmw_table,
+                                          min_fraction=args.min_fraction, threads=args.threads,
+                                          write_intermediates=args.write_intermediates,
+                                          memory_budget=memory_budget_bytes(args.memory_budget), tmp_dir=args.tmp_dir,
+                                          cache=stage_cache_from_args(args), sweep=args.sweep, output=output, report=report)
+    with report.stage('write_z2cp') as stage:
+        write_dict(flnc_z2cp, o_prefix=op.join(args.out_dir, 'flnc_z2cp'), headers=['flnc_zmw', 'consensus_primer'], zmw_table=zmw_table, output=output)
+        write_dict(nfl_z2cp, o_prefix=op.join(args.out_dir, 'nfl_z2cp'), headers=['nfl_zmw', 'consensus_primer'], zmw_table=zmw_table, output=output)
+        stage.records = len(flnc_z2cp) + len(nfl_z2cp)
+    if args.split:
+        split_fastas({'flnc': args.flnc_fa_fn, 'nfl': args.nfl_fa_fn}, {'flnc': flnc_z2cp, 'nfl': nfl_z2cp}, zmw_table, args.out_dir,
+                     buffer_size=split_buffer_size_bytes(args.split_buffer_size), max_open_files=args.max_open_files, report=report)
+    finish_run_report(report, args)
+
+
+def main():
+    """main"""
+    sys.exit(run(get_parser().parse_args(sys.argv[1:])))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+"""
+Columnar zmw -> primer store.
+
+Replaces dict{encoded_zmw: primer or None} with a sorted int64 array of
+encoded zmws next to an int8 array of primers, where NO_PRIMER stands for
+None. Primers of many zmws are looked up at once with searchsorted.
+"""
+import numpy as np
+
+NO_PRIMER = -1 # int8 sentinel for a zmw without primer, i.e., primer=NA
+MAX_PRIMER = 127 # largest primer index an int8 holds
+
+
+def primer_to_int8(primer):
+    """Return primer, or NO_PRIMER for None or -1, i.e., no primer is detected by isoseq classify,
+    raise ValueError if it does not fit in an int8.
+    ...doctest:
+        >>> primer_to_int8(None), primer_to_int8(-1), primer_to_int8(1)
+        (-1, -1, 1)
+        >>> primer_to_int8(383)
+        Traceback (most recent call last):
+        ...
+        ValueError: Primer 383 is not in [-1, 127]
+    """
+    if primer is None:
+        return NO_PRIMER
+    if not NO_PRIMER <= primer <= MAX_PRIMER:
+        raise ValueError("Primer %s is not in [%d, %d]" % (primer, NO_PRIMER, MAX_PRIMER))
+    return primer
+
+
+def as_int8_primers(primers):
+    """Return primers as an int8 array, raise ValueError if any is not NO_PRIMER or in [0, MAX_PRIMER].
+    ...doctest:
+        >>> as_int8_primers([0, -1, 2]).tolist()
+        [0, -1, 2]
+        >>> as_int8_primers([1, 255])
+        Traceback (most recent call last):
+        ...
+        ValueError: Primer 255 is not in [-1, 127]
+    """
+    primers = np.asarray(primers)
+    if primers.dtype == np.int8:
+        return primers
+    bad = (primers < NO_PRIMER) | (primers > MAX_PRIMER)
+    if bad.any():
+        raise ValueError("Primer %s is not in [%d, %d]" % (primers[bad][0], NO_PRIMER, MAX_PRIMER))
+    return primers.astype(np.int8)
+
+
+def int8_to_primer(primer):
+    """
+    ...doctest:
+        >>> int8_to_primer(-1) is None, int8_to_primer(np.int8(1))
+        (True, 1)
+    """
+    return None if primer == NO_PRIMER else int(primer)
+
+
+def searchsorted_keys(sorted_keys, queries):
+    """Same as np.searchsorted(sorted_keys, queries), but queries are sorted first unless they
+    already are. Binary searches of sorted queries reuse the previous position, which is far more
+    cache friendly than random probes into a large array, and pays for the sort many times over.
+    ...doctest:
+        >>> searchsorted_keys(np.array([1, 3, 5]), np.array([5, 0, 3, 6])).tolist()
+        [2, 0, 1, 3]
+    """
+    queries = np.asarray(queries, dtype=np.int64)
+    if len(queries) < 2 or (queries[1:] >= queries[:-1]).all():
+        return np.searchsorted(sorted_keys, queries)
+    order = np.argsort(queries)
+    idx = np.empty(len(queries), dtype=np.int64)
+    idx[order] = np.searchsorted(sorted_keys, queries[order])
+    return idx
+
+
+class ZmwPrimerStore(object):
+    """Sorted encoded zmws and their primers.
+    ...doctest:
+        >>> s = ZmwPrimerStore.from_dict({5: 1, 3: None, 9: 0})
+        >>> len(s), s[5], s[3] is None, 4 in s
+        (3, 1, True, False)
+        >>> s.lookup([9, 3, 5]).tolist()
+        [0, -1, 1]
+        >>> s.primers([9, 3, 5])
+        [0, None, 1]
+        >>> s.lookup([4])
+        Traceback (most recent call last):
+        ...
+        KeyError: 4
+        >>> sorted(s.iteritems())
+        [(3, None), (5, 1), (9, 0)]
+    """
+    def __init__(self, zmws, primers):
+        """zmws must be sorted and unique, see from_arrays"""
+        self.zmws = zmws
+        self.primers_arr = primers
+
+    @classmethod
+    def from_arrays(cls, zmws, primers):
+        """Build a store from unsorted arrays; like dict.update, the last
+        primer of a duplicated zmw wins.
+        ...doctest:
+            >>> s = ZmwPrimerStore.from_arrays([7, 2, 7], [0, 1, -1])
+            >>> s.zmws.tolist(), s.primers_arr.tolist()
+            ([2, 7], [1, -1])
+        """
+        zmws = np.asarray(zmws, dtype=np.int64)
+        primers = as_int8_primers(primers)
+        order = np.argsort(zmws, kind='mergesort')
+        zmws, primers = zmws[order], primers[order]
+        last = np.ones(len(zmws), dtype=bool)
+        last[:-1] = zmws[1:] != zmws[:-1]
+        return cls(zmws[last], primers[last])
+
+    @classmethod
+    def from_dict(cls, d):
+        """Build a store from dict{encoded_zmw: primer or None}."""
+        zmws = np.fromiter(d.iterkeys(), dtype=np.int64, count=len(d))
+        primers = np.fromiter((primer_to_int8(p) for p in d.itervalues()), dtype=np.int8, count=len(d))
+        return cls.from_arrays(zmws, primers)
+
+    @classmethod
+    def concatenate(cls, stores):
+        """Merge stores, primers of later stores win."""
+        return cls.from_arrays(np.concatenate([s.zmws for s in stores]),
+                               np.concatenate([s.primers_arr for s in stores]))
+
+    def __len__(self):
+        return len(self.zmws)
+
+    def __contains__(self, zmw):
+        i = np.searchsorted(self.zmws, zmw)
+        return i < len(self.zmws) and self.zmws[i] == zmw
+
+    def __getitem__(self, zmw):
+        return int8_to_primer(self.lookup([zmw])[0])
+
+    @property
+    def nbytes(self):
+        return self.zmws.nbytes + self.primers_arr.nbytes
+
+    def lookup(self, zmws):
+        """Return int8 primers of encoded zmws in one searchsorted call,
+        raise KeyError if any zmw is not in the store."""
+        zmws = np.asarray(zmws, dtype=np.int64)
+        idx = searchsorted_keys(self.zmws, zmws)
+        idx[idx == len(self.zmws)] = 0
+        missing = self.zmws[idx] != zmws if len(self.zmws) else np.ones(len(zmws), dtype=bool)
+        if missing.any():
+            raise KeyError(int(zmws[missing][0]))
+        return self.primers_arr[idx]
+
+    def primers(self, zmws):
+        """Same as lookup, but return a list where NO_PRIMER is None."""
+        return [None if p == NO_PRIMER else p for p in self.lookup(zmws).tolist()]
+
+    def keys(self):
+        return self.zmws.tolist()
+
+    def iteritems(self):
+        for zmw, p in zip(self.zmws.tolist(), self.primers_arr.tolist()):
+            yield (zmw, None if p == NO_PRIMER else p)
+
+    def to_dict(self):
+        return dict(self.iteritems())
+
+    def save(self, fn):
+        """Save to a .npz file"""
+        np.savez(fn, zmws=self.zmws, primers=self.primers_arr)
+
+    @classmethod
+    def load(cls, fn):
+        d = np.load(fn)
+        return cls(d['zmws'], d['primers'])
@@ -0,0 +1,132 @@
+"""
+Incremental demultiplexing project.
+
+A project directory keeps primers of zmws as one shard per FASTA file and
+movie, so that adding a SMRT Cell only parses its own FASTA files. Only FASTA
+parsing is incremental: the cluster report is read in full on every update,
+and primer counts and consensus primers of all clusters are computed again.
+Reads of a movie may be split across many FASTA files, e.g., of ICE size
+bins; a FASTA file that changed replaces its own shards only.
+
+    project_dir/
+        manifest.json                           identities, kinds and shards of FASTA files already parsed
+        z2p/<kind>.<movie>.<fasta_key>.npz      zmw ids and int8 primers of flnc or nfl reads of a movie in a FASTA file
+"""
+import os
+import os.path as op
+import json
+import hashlib
+import numpy as np
+from .zmw_table import ZmwTable, ZMW_BITS, ZMW_MASK
+from .primer_store import ZmwPrimerStore
+from .stage_cache import file_identity
+from .utils import zmw_to_primer_from_fastas
+
+Z2P_KINDS = ('flnc', 'nfl')
+PROJECT_FORMAT_VERSION = 2 # z2p shards of a FASTA file and movie, recorded in the manifest
+
+
+def fasta_key(path):
+    """Short key of a FASTA path in names of its z2p shards"""
+    return hashlib.sha1(op.abspath(path)).hexdigest()[:12]
+
+
+class DemuxProject(object):
+    """Per-FASTA file and per-movie z2p shards in project_dir.
+    ...doctest:
+        >>> import tempfile, shutil
+        >>> d = tempfile.mkdtemp()
+        >>> p = DemuxProject(op.join(d, 'project'))
+        >>> t = ZmwTable(['m0', 'm1'])
+        >>> [op.basename(fn).split('.')[:2] for fn in p.save_z2p_shards('flnc', 'a.fa', ZmwPrimerStore.from_dict({3: 0, 4294967300: 1}), t)]
+        [['flnc', 'm0'], ['flnc', 'm1']]
+        >>> shutil.rmtree(d)
+    """
+    def __init__(self, project_dir):
+        self.project_dir = project_dir
+        self.z2p_dir = op.join(project_dir, 'z2p')
+        self.manifest_fn = op.join(project_dir, 'manifest.json')
+        if not op.exists(self.z2p_dir):
+            os.makedirs(self.z2p_dir)
+        self.manifest = {'version': PROJECT_FORMAT_VERSION, 'fastas': {}}
+        if op.exists(self.manifest_fn):
+            with open(self.manifest_fn, 'r') as reader:
+                self.manifest = json.load(reader)
+            if self.manifest.get('version') != PROJECT_FORMAT_VERSION:
+                raise ValueError("Unsupported project version %s in %s, create a new project" %
+                                 (self.manifest.get('version'), project_dir))
+
+    def write_manifest(self):
+        with open(self.manifest_fn, 'w') as writer:
+            json.dump(self.manifest, writer, indent=2, sort_keys=True)
+
+    def shard_fn(self, kind, movie, fasta_fn):
+        return op.join(self.z2p_dir, '%s.%s.%s.npz' % (kind, movie, fasta_key(fasta_fn)))
+
+    def save_z2p_shards(self, kind, fasta_fn, z2p, zmw_table):
+        """Save ZmwPrimerStore z2p of kind parsed from fasta_fn as one shard per movie, return shard files."""
+        movie_idxs = z2p.zmws >> ZMW_BITS
+        shard_fns = []
+        for movie_idx in np.unique(movie_idxs).tolist():
+            in_movie = movie_idxs == movie_idx
+            shard_fn = self.shard_fn(kind, zmw_table.movies[movie_idx], fasta_fn)
+            np.savez(shard_fn, zmw_ids=z2p.zmws[in_movie] & ZMW_MASK, primers=z2p.primers_arr[in_movie])
+            shard_fns.append(shard_fn)
+        return shard_fns
+
+    def add_fasta(self, kind, fasta_fn, threads=1):
+        """Parse a FASTA file of kind into z2p shards, unless it was added before and has not changed since.
+        Shards of an earlier version of the same FASTA file are replaced, shards of other FASTA files are kept.
+        ...doctest:
+            >>> import tempfile, shutil
+            >>> d = tempfile.mkdtemp()
+            >>> for name, zmws in [('a.fa', [1, 2]), ('b.fa', [3])]:
+            ...     open(op.join(d, name), 'w').write(''.join(['>m/%d/0_9_CCS polyA=1;primer=0\\nA\\n' % z for z in zmws]))
+            >>> p = DemuxProject(op.join(d, 'project'))
+            >>> p.add_fasta('flnc', op.join(d, 'a.fa')); p.add_fasta('flnc', op.join(d, 'b.fa')) # doctest: +ELLIPSIS
+            Adding ...
+            >>> t = ZmwTable()
+            >>> sorted(t.decode_keys(p.z2p_stores(t)[0].to_dict()).keys())
+            ['m/1', 'm/2', 'm/3']
+            >>> open(op.join(d, 'a.fa'), 'w').write('>m/1/0_9_CCS polyA=1;primer=1\\nA\\n')
+            >>> p.add_fasta('flnc', op.join(d, 'a.fa')); p.add_fasta('flnc', op.join(d, 'b.fa')) # doctest: +ELLIPSIS
+            Adding ...
+            Skipping ...
+            >>> sorted(t.decode_keys(DemuxProject(op.join(d, 'project')).z2p_stores(t)[0].to_dict()).items())
+            [('m/1', 1), ('m/3', 0)]
+            >>> shutil.rmtree(d)
+        """
+        identity = file_identity(fasta_fn)
+        old = self.manifest['fastas'].get(identity['path'])
+        if old is not None and old['identity'] == identity and old['kind'] == kind:
+            print 'Skipping %s, already in project %s' % (fasta_fn, self.project_dir)
+            return
+        print 'Adding %s to project %s' % (fasta_fn, self.project_dir)
+        zmw_table = ZmwTable()
+        z2p = zmw_to_primer_from_fastas([fasta_fn], zmw_table, threads=threads)[0]
+        if old is not None: # reads of this FASTA file are replaced, reads of the same movies in other files are kept
+            for shard_fn in old['shards']:
+                if op.exists(op.join(self.z2p_dir, shard_fn)):
+                    os.remove(op.join(self.z2p_dir, shard_fn))
+        shard_fns = self.save_z2p_shards(kind, identity['path'], z2p, zmw_table)
+        print 'Saved %s z2p shards %s' % (kind, ', '.join([op.basename(fn) for fn in shard_fns]))
+        seq = 1 + max([entry['seq'] for entry in self.manifest['fastas'].values()] + [-1])
+        self.manifest['fastas'][identity['path']] = {'identity': identity, 'kind': kind, 'seq': seq,
+                                                     'shards': [op.basename(fn) for fn in shard_fns]}
+        self.write_manifest()
+
+    def z2p_stores(self, zmw_table):
+        """Return [flnc_z2p, nfl_z2p] ZmwPrimerStores of all shards, zmws encoded by zmw_table.
+        Primers of a zmw in several FASTA files are taken from the one added last."""
+        stores = []
+        entries = sorted(self.manifest['fastas'].values(), key=lambda entry: entry['seq'])
+        for kind in Z2P_KINDS:
+            zmws, primers = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int8)]
+            for entry in [entry for entry in entries if entry['kind'] == kind]:
+                for shard_fn in entry['shards']:
+                    movie = shard_fn[len(kind) + 1:].rsplit('.', 2)[0]
+                    shard = np.load(op.join(self.z2p_dir, shard_fn))
+                    zmws.append((np.int64(zmw_table.movie_index(movie)) << ZMW_BITS) | shard['zmw_ids'])
+                    primers.append(shard['primers'])
+            stores.append(ZmwPrimerStore.from_arrays(np.concatenate(zmws), np.concatenate(primers)))
+        return stores
@@ -0,0 +1,314 @@
+#!/usr/bin/env python
+"""
+Split FASTA reads into one file per consensus primer of their zmws.
+
+Reads of a FASTA file are streamed in blocks of split_buffer_size bytes, the
+records of a block are cut at '\\n>', and zmws of all records of a block are
+looked up in a zmw -> consensus primer ZmwPrimerStore at once. Records then go
+unchanged to the bucket of their zmw:
+
+    primer<p>            consensus primer p
+    cid_no_cprimer       zmw in clusters without a consensus primer (NO_PRIMER in the store)
+    no_cid_no_cprimer    zmw in no cluster (not in the store)
+
+Records of a bucket are joined in memory and written in large writes, and
+at most max_open_files bucket files are open at once; the least recently
+written one is closed, and re-opened for appending when needed.
+"""
+import sys
+import os
+import os.path as op
+import re
+import gzip
+import bz2
+from collections import OrderedDict
+from argparse import ArgumentParser
+import numpy as np
+from .zmw_table import ZmwTable, ZMW_BITS
+from .primer_store import ZmwPrimerStore, NO_PRIMER, primer_to_int8, searchsorted_keys
+from .instrument import RunReport, add_report_arguments, run_report_from_args, finish_run_report
+
+CID_NO_CPRIMER = 'cid_no_cprimer'
+NO_CID_NO_CPRIMER = 'no_cid_no_cprimer'
+NO_CID = -2 # bucket code of zmws not in z2cp, NO_PRIMER is the code of cid_no_cprimer
+SPLIT_BUFFER_SIZE = 16 * 1024 * 1024 # bytes of FASTA read at once, and bytes buffered per bucket before a write
+MAX_OPEN_FILES = 64
+SPLIT_COUNTS_FN = 'split_counts.txt'
+_READ_NAME = re.compile(r'[^\s]+')
+
+
+def bucket_name(code):
+    """
+    ...doctest:
+        >>> [bucket_name(c) for c in [1, -1, -2]]
+        ['primer1', 'cid_no_cprimer', 'no_cid_no_cprimer']
+    """
+    if code == NO_PRIMER:
+        return CID_NO_CPRIMER
+    if code == NO_CID:
+        return NO_CID_NO_CPRIMER
+    return 'primer%d' % code
+
+
+def bucket_codes(z2cp, zmws):
+    """Return int64 bucket codes of encoded zmws: consensus primer, NO_PRIMER or NO_CID if not in ZmwPrimerStore z2cp.
+    ...doctest:
+        >>> bucket_codes(ZmwPrimerStore.from_dict({3: 1, 5: None}), [5, 4, 3, 9]).tolist()
+        [-1, -2, 1, -2]
+    """
+    zmws = np.asarray(zmws, dtype=np.int64)
+    if len(z2cp) == 0:
+        return np.full(len(zmws), NO_CID, dtype=np.int64)
+    idx = np.minimum(searchsorted_keys(z2cp.zmws, zmws), len(z2cp) - 1)
+    return np.where(z2cp.zmws[idx] == zmws, z2cp.primers_arr[idx].astype(np.int64), NO_CID)
+
+
+def yield_fasta_record_blocks(fasta_fn, buffer_size=SPLIT_BUFFER_SIZE, progress=None):
+    """Yield lists of complete records of fasta_fn, each record without its leading '>' and trailing newline,
+    updating Progress progress with records and bytes read.
+    ...doctest:
+        >>> import tempfile
+        >>> fn = tempfile.mktemp(suffix='.fasta')
+        >>> open(fn, 'w').write('>m/1/ccs primer=0\\nACGT\\nAC\\n>m/2/ccs primer=NA\\nGG\\n>m/3/ccs primer=1\\nT')
+        >>> [records for records in yield_fasta_record_blocks(fn, buffer_size=8)]
+        [['m/1/ccs primer=0\\nACGT\\nAC'], ['m/2/ccs primer=NA\\nGG'], ['m/3/ccs primer=1\\nT']]
+        >>> os.remove(fn)
+    """
+    with open(fasta_fn, 'rb') as reader:
+        pending = ''
+        while True:
+            data = reader.read(buffer_size)
+            if not data:
+                break
+            data = pending + data
+            cut = data.rfind('\n>')
+            if cut < 0:
+                pending = data
+                continue
+            block, pending = data[:cut], data[cut+1:]
+            if block.startswith('>'):
+                records = block[1:].split('\n>')
+                if progress is not None:
+                    progress.update(len(records), position=reader.tell() - len(pending))
+                yield records
+        pending = pending.rstrip('\r\n')
+        if pending.startswith('>'):
+            records = pending[1:].split('\n>')
+            if progress is not None:
+                progress.update(len(records), position=reader.tell())
+            yield records
+
+
+class BucketWriter(object):
+    """Buffered writers of bucket files fn_of_bucket(bucket), flushing a bucket once it buffers
+    buffer_size bytes, with at most max_open_files files open at once.
+    ...doctest:
+        >>> import tempfile, shutil
+        >>> d = tempfile.mkdtemp()
+        >>> w = BucketWriter(lambda b: op.join(d, b + '.txt'), buffer_size=4, max_open_files=1)
+        >>> w.write('a', 'xx'); w.write('b', 'yyyyy'); w.write('a', 'zzz'); w.write('b', 'w')
+        >>> sorted(w.close().items())
+        [('a', 5), ('b', 6)]
+        >>> open(op.join(d, 'a.txt')).read(), open(op.join(d, 'b.txt')).read()
+        ('xxzzz', 'yyyyyw')
+        >>> shutil.rmtree(d)
+    """
+    def __init__(self, fn_of_bucket, buffer_size=SPLIT_BUFFER_SIZE, max_open_files=MAX_OPEN_FILES):
+        self.fn_of_bucket = fn_of_bucket
+        self.buffer_size, self.max_open_files = buffer_size, max(1, max_open_files)
+        self.buffers, self.buffered = {}, {}
+        self.handles = OrderedDict() # bucket -> open file, least recently written first
+        self.n_bytes = {} # bucket -> bytes written or buffered
+
+    def write(self, bucket, data):
+        self.buffers.setdefault(bucket, []).append(data)
+        self.buffered[bucket] = self.buffered.get(bucket, 0) + len(data)
+        self.n_bytes[bucket] = self.n_bytes.get(bucket, 0) + len(data)
+        if self.buffered[bucket] >= self.buffer_size:
+            self.flush(bucket)
+
+    def _handle(self, bucket):
+        handle = self.handles.pop(bucket, None)
+        if handle is None:
+            if len(self.handles) >= self.max_open_files:
+                self.handles.popitem(last=False)[1].close()
+            # truncate on the first write of a bucket, append after it was closed to bound open files
+            handle = open(self.fn_of_bucket(bucket), 'ab' if self.n_bytes[bucket] > self.buffered[bucket] else 'wb')
+        self.handles[bucket] = handle
+        return handle
+
+    def flush(self, bucket):
+        if self.buffered.get(bucket):
+            self._handle(bucket).write(''.join(self.buffers[bucket]))
+        self.buffers[bucket], self.buffered[bucket] = [], 0
+
+    def close(self):
+        """Flush and close all buckets, return {bucket: bytes written}"""
+        for bucket in list(self.buffers.keys()):
+            self.flush(bucket)
+        for handle in self.handles.itervalues():
+            handle.close()
+        self.handles.clear()
+        return dict(self.n_bytes)
+
+
+def split_fasta(fasta_fn, z2cp, zmw_table, o_prefix, buffer_size=SPLIT_BUFFER_SIZE, max_open_files=MAX_OPEN_FILES, progress=None):
+    """Split records of fasta_fn into o_prefix.<bucket>.fasta by consensus primers of their zmws
+    in ZmwPrimerStore z2cp, whose zmws are encoded by zmw_table. Return OrderedDict{bucket: number of reads}.
+    ...doctest:
+        >>> import tempfile, shutil
+        >>> d = tempfile.mkdtemp()
+        >>> fn = op.join(d, 'in.fasta')
+        >>> open(fn, 'w').write('>m/1/ccs primer=0\\nACGT\\n>m/2/ccs primer=NA\\nGG\\n>m/3/ccs primer=1\\nT\\n>m/4/ccs primer=1\\nA\\n')
+        >>> t = ZmwTable(['m'])
+        >>> split_fasta(fn, ZmwPrimerStore.from_dict({1: 1, 2: None, 4: 1}), t, op.join(d, 'flnc'))
+        OrderedDict([('primer1', 2), ('cid_no_cprimer', 1), ('no_cid_no_cprimer', 1)])
+        >>> open(op.join(d, 'flnc.primer1.fasta')).read()
+        '>m/1/ccs primer=0\\nACGT\\n>m/4/ccs primer=1\\nA\\n'
+        >>> sorted(os.listdir(d))
+        ['flnc.cid_no_cprimer.fasta', 'flnc.no_cid_no_cprimer.fasta', 'flnc.primer1.fasta', 'in.fasta']
+        >>> shutil.rmtree(d)
+    """
+    writer = BucketWriter(lambda bucket: '%s.%s.fasta' % (o_prefix, bucket), buffer_size=buffer_size, max_open_files=max_open_files)
+    n_reads = {}
+    try:
+        for records in yield_fasta_record_blocks(fasta_fn, buffer_size, progress=progress):
+            zmws = [zmw_table.encode(_READ_NAME.match(record).group()) for record in records]
+            codes = bucket_codes(z2cp, zmws)
+            order = np.argsort(codes, kind='mergesort') # records of a bucket stay in file order
+            sorted_codes = codes[order]
+            bounds = np.flatnonzero(np.diff(sorted_codes)) + 1
+            order = order.tolist()
+            for start, end in zip([0] + bounds.tolist(), bounds.tolist() + [len(order)]):
+                bucket = bucket_name(int(sorted_codes[start]))
+                writer.write(bucket, '>' + '\n>'.join([records[i] for i in order[start:end]]) + '\n')
+                n_reads[bucket] = n_reads.get(bucket, 0) + end - start
+    finally:
+        writer.close()
+    return OrderedDict(sorted(n_reads.items(), key=lambda item: _bucket_order(item[0])))
+
+
+def _bucket_order(bucket):
+    """primer buckets by primer, then cid_no_cprimer and no_cid_no_cprimer"""
+    if bucket.startswith('primer'):
+        return (0, int(bucket[len('primer'):]))
+    return (1, [CID_NO_CPRIMER, NO_CID_NO_CPRIMER].index(bucket))
+
+
+def _open_text(fn):
+    if fn.endswith('.gz'):
+        return gzip.open(fn, 'rb')
+    if fn.endswith('.bz2'):
+        return bz2.BZ2File(fn, 'r')
+    return open(fn, 'r')
+
+
+def load_z2cp(fn, zmw_table):
+    """Load zmw -> consensus primer written by write_dict, as csv (optionally .gz or .bz2) or npz,
+    into a ZmwPrimerStore with zmws encoded by zmw_table.
+    ...doctest:
+        >>> import tempfile
+        >>> fn = tempfile.mktemp(suffix='.csv')
+        >>> open(fn, 'w').write('flnc_zmw\\tconsensus_primer\\nm1/3\\t1\\nm0/2\\tNone\\n')
+        >>> t = ZmwTable(['m0'])
+        >>> sorted(t.decode_keys(load_z2cp(fn, t).to_dict()).items())
+        [('m0/2', None), ('m1/3', 1)]
+        >>> os.remove(fn)
+    """
+    if fn.endswith('.npz'):
+        arrays = np.load(fn)
+        movie_idx_map = np.asarray(zmw_table.merge([str(m) for m in arrays['movies'].tolist()]), dtype=np.int64)
+        zmws = (movie_idx_map[arrays['movie_idxs']] << ZMW_BITS) | arrays['zmw_ids']
+        return ZmwPrimerStore.from_arrays(zmws, arrays['primers'])
+    zmws, primers = [], []
+    with _open_text(fn) as reader:
+        reader.readline() # header
+        for line in reader:
+            zmw, primer = line.rstrip('\r\n').split('\t')
+            zmws.append(zmw_table.encode(zmw))
+            primers.append(primer_to_int8(None if primer == 'None' else int(primer)))
+    return ZmwPrimerStore.from_arrays(zmws, primers)
+
+
+def split_fastas(fasta_fns_by_reads, z2cp_by_reads, zmw_table, out_dir, buffer_size=SPLIT_BUFFER_SIZE, max_open_files=MAX_OPEN_FILES,
+                 report=None):
+    """Split FASTA files {reads: fasta_fn} by ZmwPrimerStores {reads: z2cp} into out_dir/<reads>.<bucket>.fasta,
+    write numbers of reads per bucket to out_dir/split_counts.txt and return them as [(reads, bucket, n_reads)]."""
+    report = report if report is not None else RunReport()
+    rows = []
+    for reads in sorted(fasta_fns_by_reads.keys()):
+        fasta_fn = fasta_fns_by_reads[reads]
+        with report.stage('split_%s' % reads) as stage:
+            n_reads = split_fasta(fasta_fn, z2cp_by_reads[reads], zmw_table, op.join(out_dir, reads),
+                                  buffer_size=buffer_size, max_open_files=max_open_files,
+                                  progress=report.progress('split %s' % fasta_fn, total=op.getsize(fasta_fn)))
+            stage.records = sum(n_reads.values())
+        rows.extend([(reads, bucket, n) for bucket, n in n_reads.iteritems()])
+    with open(op.join(out_dir, SPLIT_COUNTS_FN), 'w') as writer:
+        writer.write('reads\tbucket\tn_reads\n')
+        for row in rows:
+            writer.write('%s\t%s\t%d\n' % row)
+    return rows
+
+
+def add_split_arguments(parser):
+    """Add --split_buffer_size and --max_open_files to an argument parser."""
+    parser.add_argument("--split_buffer_size", help="MB of FASTA read at once, and buffered per output file before a write, default: %s" %
+                        (SPLIT_BUFFER_SIZE / 1024 / 1024), default=SPLIT_BUFFER_SIZE / 1024 / 1024, type=float)
+    parser.add_argument("--max_open_files", help="Maximum number of split FASTA files open at once, default: %s" % MAX_OPEN_FILES,
+                        default=MAX_OPEN_FILES, type=int)
+
+
+def split_buffer_size_bytes(mb):
+    return max(1, int(mb * 1024 * 1024))
+
+
+def parse_reads_fn(s):
+    """
+    ...doctest:
+        >>> parse_reads_fn('flnc=out_dir/flnc_z2cp.npz')
+        ('flnc', 'out_dir/flnc_z2cp.npz')
+    """
+    if '=' not in s:
+        raise ValueError("Must be reads=filename, e.g., flnc=flnc.fasta, not %s" % s)
+    reads, fn = s.split('=', 1)
+    return reads, fn
+
+
+def get_parser():
+    """return arg parser"""
+    desc = """Split reads of FASTA files into one FASTA file per consensus primer of their zmws, plus cid_no_cprimer and no_cid_no_cprimer."""
+    parser = ArgumentParser(description=desc)
+    parser.add_argument("out_dir", help="Output directory of <reads>.<bucket>.fasta and %s" % SPLIT_COUNTS_FN)
+    parser.add_argument("--z2cp", help="zmw -> consensus primer of reads, e.g., flnc=out_dir/flnc_z2cp.csv, as written by isoseq-demultiplex",
+                        required=True, action='append', type=parse_reads_fn)
+    parser.add_argument("--fasta", help="FASTA file of reads, e.g., flnc=flnc.fasta", required=True, action='append', type=parse_reads_fn)
+    add_split_arguments(parser)
+    add_report_arguments(parser)
+    return parser
+
+
+def run(args):
+    if not op.exists(args.out_dir):
+        raise ValueError("Must create output directory %s" % args.out_dir)
+    z2cp_fns, fasta_fns = dict(args.z2cp), dict(args.fasta)
+    if sorted(z2cp_fns.keys()) != sorted(fasta_fns.keys()):
+        raise ValueError("Must give --z2cp and --fasta of the same reads, not %s and %s" % (sorted(z2cp_fns.keys()), sorted(fasta_fns.keys())))
+    report = run_report_from_args(args, 'split-by-primer')
+    zmw_table = ZmwTable()
+    z2cp_by_reads = {}
+    with report.stage('load_z2cp') as stage:
+        for reads, fn in z2cp_fns.iteritems():
+            z2cp_by_reads[reads] = load_z2cp(fn, zmw_table)
+        stage.records = sum([len(z2cp) for z2cp in z2cp_by_reads.values()])
+    split_fastas(fasta_fns, z2cp_by_reads, zmw_table, args.out_dir, buffer_size=split_buffer_size_bytes(args.split_buffer_size),
+                 max_open_files=args.max_open_files, report=report)
+    finish_run_report(report, args)
+
+
+def main():
+    """main"""
+    sys.exit(run(get_parser().parse_args(sys.argv[1:])))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""
+Content-addressed cache of pipeline stages.
+
+A stage result is stored in <cache_dir>/<stage>.<key>, where key is a hash of
+the stage name, identities of its input files (path, size, mtime and,
+optionally, a digest of their content), its parameters and keys of upstream
+stage results it was computed from. A result is reused when the key is
+unchanged, and recomputed when any input or parameter changed. Least recently
+used entries are evicted once the cache grows over max_bytes.
+"""
+import os
+import os.path as op
+import json
+import pickle
+import shutil
+import hashlib
+import tempfile
+from .zmw_table import ZmwTable, remap_codes
+from .primer_store import ZmwPrimerStore
+
+STAGE_META_FN = 'stage.json' # written last, marks a complete entry
+DEFAULT_CACHE_SIZE_MB = 10 * 1024
+DIGEST_BUFFER_SIZE = 16 * 1024 * 1024
+
+
+def file_digest(fn):
+    """sha1 of content of fn"""
+    h = hashlib.sha1()
+    with open(fn, 'rb') as reader:
+        while True:
+            block = reader.read(DIGEST_BUFFER_SIZE)
+            if not block:
+                break
+            h.update(block)
+    return h.hexdigest()
+
+
+def file_identity(fn, digest=False):
+    """Return dict identifying the state of input file fn.
+    ...doctest:
+        >>> fn = tempfile.mktemp()
+        >>> open(fn, 'w').write('abc')
+        >>> d = file_identity(fn, digest=True)
+        >>> d['size'], d['sha1']
+        (3, 'a9993e364706816aba3e25717850c26c9cd0d89d')
+        >>> os.remove(fn)
+    """
+    st = os.stat(fn)
+    d = {'path': op.abspath(fn), 'size': st.st_size, 'mtime': st.st_mtime}
+    if digest:
+        d['sha1'] = file_digest(fn)
+    return d
+
+
+def dir_size(d):
+    return sum([op.getsize(op.join(root, fn)) for root, dirs, fns in os.walk(d) for fn in fns])
+
+
+class StageCache(object):
+    """Cache of stage results in cache_dir.
+    ...doctest:
+        >>> d = tempfile.mkdtemp()
+        >>> fn = op.join(d, 'input.txt')
+        >>> open(fn, 'w').write('abc')
+        >>> cache = StageCache(op.join(d, 'cache'), verbose=False)
+        >>> def compute():
+        ...     print 'computing'
+        ...     return {'a': 1}
+        >>> cache.cached('s1', compute, save_pickle, load_pickle, input_fns=[fn], params={'min_fraction': 0.6})
+        computing
+        {'a': 1}
+        >>> r = cache.cached('s1', compute, save_pickle, load_pickle, input_fns=[fn], params={'min_fraction': 0.6})
+        >>> r
+        {'a': 1}
+        >>> cache.cached('s1', compute, save_pickle, load_pickle, input_fns=[fn], params={'min_fraction': 0.8})
+        computing
+        {'a': 1}
+        >>> x = cache.cached('s2', compute, save_pickle, load_pickle, deps=[r])
+        computing
+        >>> x = cache.cached('s2', compute, save_pickle, load_pickle, deps=[r])
+        >>> x = cache.cached('s2', compute, save_pickle, load_pickle, deps=[{'a': 1}])
+        computing
+        >>> len(cache.entries())
+        3
+        >>> shutil.rmtree(d)
+    """
+    def __init__(self, cache_dir, max_bytes=DEFAULT_CACHE_SIZE_MB * 1024 * 1024, digest=False, verbose=True):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.digest = digest
+        self.verbose = verbose
+        self._results = [] # (result, key) of stages computed or loaded, keys of upstream results
+        if not op.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def log(self, msg):
+        if self.verbose:
+            print msg
+
+    def key_of(self, result):
+        """Return key of a result returned by cached, or None if it did not come from this cache."""
+        for obj, key in self._results:
+            if obj is result:
+                return key
+        return None
+
+    def stage_meta(self, stage, input_fns=(), params=None, deps=()):
+        """Return dict of everything the result of stage depends on, None if a dep did not come from this cache."""
+        dep_keys = [self.key_of(dep) for dep in deps]
+        if None in dep_keys:
+            return None
+        return {'stage': stage, 'inputs': [file_identity(fn, self.digest) for fn in input_fns],
+                'params': params or {}, 'deps': dep_keys}
+
+    def entry_dir(self, stage, key):
+        return op.join(self.cache_dir, '%s.%s' % (stage, key))
+
+    def cached(self, stage, compute, save, load, input_fns=(), params=None, deps=()):
+        """Return load(entry_dir) if stage was cached with the same inputs, params and deps,
+        otherwise return compute() after save(result, entry_dir).
+        deps are results of upstream stages returned by cached; if any was not, the
+        stage is computed without caching."""
+        meta = self.stage_meta(stage, input_fns, params, deps)
+        if meta is None:
+            self.log('Not caching %s, its inputs are not cached' % (stage))
+            return compute()
+        key = hashlib.sha1(json.dumps(meta, sort_keys=True)).hexdigest()
+        entry = self.entry_dir(stage, key)
+        if op.exists(op.join(entry, STAGE_META_FN)):
+            self.log('Reusing cached %s from %s' % (stage, entry))
+            os.utime(op.join(entry, STAGE_META_FN), None) # mark as recently used
+            result = load(entry)
+        else:
+            result = compute()
+            tmp_dir = tempfile.mkdtemp(prefix='.%s.' % stage, dir=self.cache_dir)
+            save(result, tmp_dir)
+            with open(op.join(tmp_dir, STAGE_META_FN), 'w') as writer:
+                json.dump(meta, writer, indent=2, sort_keys=True)
+            if op.exists(entry): # incomplete entry
+                shutil.rmtree(entry)
+            os.rename(tmp_dir, entry)
+            self.log('Cached %s in %s' % (stage, entry))
+            self.evict(keep=entry)
+        self._results.append((result, key))
+        if isinstance(result, (tuple, list)): # results unpacked by the caller are deps too
+            self._results.extend([(r, '%s.%d' % (key, i)) for i, r in enumerate(result)])
+        return result
+
+    def entries(self):
+        """Return complete entry dirs, least recently used first."""
+        entries = [op.join(self.cache_dir, fn) for fn in os.listdir(self.cache_dir)
+                   if op.exists(op.join(self.cache_dir, fn, STAGE_META_FN))]
+        return sorted(entries, key=lambda entry: op.getmtime(op.join(entry, STAGE_META_FN)))
+
+    def evict(self, keep=None):
+        """Remove least recently used entries other than keep until the cache fits in max_bytes."""
+        if self.max_bytes is None:
+            return
+        sizes = [(entry, dir_size(entry)) for entry in self.entries()]
+        total = sum([size for entry, size in sizes])
+        for entry, size in sizes:
+            if total <= self.max_bytes:
+                break
+            if entry != keep:
+                self.log('Evicting cached %s' % (entry))
+                shutil.rmtree(entry)
+                total -= size
+
+
+def save_pickle(obj, entry_dir):
+    with open(op.join(entry_dir, 'result.pickle'), 'wb') as writer:
+        pickle.dump(obj, writer, pickle.HIGHEST_PROTOCOL)
+
+
+def load_pickle(entry_dir):
+    with open(op.join(entry_dir, 'result.pickle'), 'rb') as reader:
+        return pickle.load(reader)
+
+
+def save_primer_stores(stores, zmw_table, entry_dir):
+    """Save a list of ZmwPrimerStore and the movie table of their encoded zmws."""
+    zmw_table.write(op.join(entry_dir, 'movies.txt'))
+    for i, store in enumerate(stores):
+        store.save(op.join(entry_dir, 'store.%d.npz' % i))
+
+
+def load_primer_stores(entry_dir, zmw_table):
+    """Load a list of ZmwPrimerStore saved by save_primer_stores, re-encoding zmws by zmw_table.
+    ...doctest:
+        >>> d = tempfile.mkdtemp()
+        >>> save_primer_stores([ZmwPrimerStore.from_dict({4294967299: 1, 2: None})], ZmwTable(['m0', 'm1']), d)
+        >>> t = ZmwTable(['m1'])
+        >>> [sorted(t.decode_keys(s.to_dict()).items()) for s in load_primer_stores(d, t)]
+        [[('m0/2', None), ('m1/3', 1)]]
+        >>> shutil.rmtree(d)
+    """
+    movie_idx_map = zmw_table.merge(ZmwTable.read(op.join(entry_dir, 'movies.txt')).movies)
+    n_stores = len([fn for fn in os.listdir(entry_dir) if fn.startswith('store.')])
+    stores = [ZmwPrimerStore.load(op.join(entry_dir, 'store.%d.npz' % i)) for i in range(n_stores)]
+    if movie_idx_map == range(len(movie_idx_map)):
+        return stores
+    return [ZmwPrimerStore.from_arrays(remap_codes(s.zmws, movie_idx_map), s.primers_arr) for s in stores]
+
+
+def add_cache_arguments(parser):
+    """Add --cache_dir, --cache_size and --cache_digest to an argument parser."""
+    parser.add_argument("--cache_dir", "--cache-dir", dest="cache_dir", default=None,
+                        help="Reuse stage results cached in this directory when inputs and parameters are unchanged, default: no cache")
+    parser.add_argument("--cache_size", help="Evict least recently used cached stages beyond this many MB", default=DEFAULT_CACHE_SIZE_MB, type=float)
+    parser.add_argument("--cache_digest", help="Identify cached input files by a digest of their content, besides path, size and mtime",
+                        default=False, action='store_true')
+
+
+def stage_cache_from_args(args):
+    """Return StageCache of --cache_dir, or None"""
+    if args.cache_dir is None:
+        return None
+    return StageCache(args.cache_dir, max_bytes=int(args.cache_size * 1024 * 1024), digest=args.cache_digest)
@@ -0,0 +1,87 @@
+"""
+min_fraction parameter sweep.
+
+Consensus primers of clusters at every min_fraction are computed at once from
+PrimerCounts, and every zmw takes the consensus primer of its last cluster,
+as in zmw-to-consensus-primer, so assignments of zmws at all thresholds only cost one
+array lookup per threshold on top of a single run. The result is a table of
+numbers of zmws per category per threshold.
+"""
+import numpy as np
+from .primer_store import NO_PRIMER
+
+CID_NO_CPRIMER = 'cid_no_cprimer' # zmw in clusters, none of which has a consensus primer
+NO_CID_NO_CPRIMER = 'no_cid_no_cprimer' # zmw in no cluster
+
+
+def parse_sweep(s):
+    """Parse start:stop:step into a list of min_fraction values, stop included.
+    ...doctest:
+        >>> parse_sweep('0.5:0.7:0.05')
+        [0.5, 0.55, 0.6, 0.65, 0.7]
+        >>> parse_sweep('0.6:0.6:0.1')
+        [0.6]
+    """
+    try:
+        start, stop, step = [float(x) for x in s.split(':')]
+    except ValueError:
+        raise ValueError("Sweep %s must be start:stop:step, e.g., 0.5:0.95:0.05" % s)
+    if step <= 0 or stop < start:
+        raise ValueError("Sweep %s must have step > 0 and stop >= start" % s)
+    n_steps = int(np.floor((stop - start) / step + 1e-9))
+    return [round(start + i * step, 10) for i in range(n_steps + 1)]
+
+
+def assignment_counts(cluster_consensus, last_clusters, zmws, n_primers):
+    """Return numbers of zmws assigned to each primer, then to cid_no_cprimer and no_cid_no_cprimer,
+    given int8 consensus primers of clusters, (sorted clustered zmws, index of the last cluster of each)
+    as ZmwClusterRuns.last_clusters, and sorted zmws of the FASTA file. Only zmws of the FASTA file are
+    counted, so clustered zmws missing from it do not hide zmws in no cluster.
+    ...doctest:
+        >>> last_clusters = (np.array([1, 2, 3, 4, 9]), np.array([0, 0, 1, 2, 0]))
+        >>> assignment_counts(np.array([0, -1, 1], dtype=np.int8), last_clusters, np.array([1, 2, 3, 4, 5, 6]), 2)
+        [2, 1, 1, 2]
+    """
+    clustered_zmws, last_cluster_idxs = last_clusters
+    in_fasta = np.in1d(clustered_zmws, zmws, assume_unique=True)
+    primers = np.asarray(cluster_consensus, dtype=np.int64)[np.asarray(last_cluster_idxs)[in_fasta]]
+    n_no_cprimer = int((primers == NO_PRIMER).sum())
+    per_primer = np.bincount(primers[primers != NO_PRIMER], minlength=n_primers).tolist()
+    return per_primer + [n_no_cprimer, len(zmws) - int(in_fasta.sum())]
+
+
+class SweepTable(object):
+    """Numbers of flnc and nfl zmws per category at every min_fraction.
+    ...doctest:
+        >>> from .consensus import PrimerCounts
+        >>> counts = PrimerCounts.from_reads([0, 0, 0, 1, 1], [0, 0, 1, 1, 0], [1, 1, 1, 1, 1], 2)
+        >>> last_clusters = (np.array([0, 1, 2]), np.array([0, 1, 1]))
+        >>> t = SweepTable(counts, np.arange(2), [0.6, 0.8], {'flnc': (last_clusters, np.arange(4))})
+        >>> t.header()
+        ['min_fraction', 'reads', 'primer0', 'primer1', 'cid_no_cprimer', 'no_cid_no_cprimer']
+        >>> t.rows
+        [[0.6, 'flnc', 1, 0, 2, 1], [0.8, 'flnc', 0, 0, 3, 1]]
+    """
+    def __init__(self, counts, cluster_idx_of_cids, min_fractions, last_clusters):
+        """counts: PrimerCounts of clusters
+        cluster_idx_of_cids: index of the cluster whose consensus primer every cluster takes, see consensus_by_cid
+        last_clusters: {reads: (ZmwClusterRuns.last_clusters, sorted zmws of the FASTA file)}
+        """
+        self.n_primers = counts.n_primers
+        self.min_fractions = list(min_fractions)
+        consensus = counts.sweep(self.min_fractions)[:, cluster_idx_of_cids]
+        self.rows = []
+        for i, min_fraction in enumerate(self.min_fractions):
+            for reads in sorted(last_clusters.keys()):
+                reads_last_clusters, zmws = last_clusters[reads]
+                self.rows.append([min_fraction, reads] + assignment_counts(consensus[i], reads_last_clusters, zmws, self.n_primers))
+
+    def header(self):
+        return ['min_fraction', 'reads'] + ['primer%d' % p for p in range(self.n_primers)] + [CID_NO_CPRIMER, NO_CID_NO_CPRIMER]
+
+    def write(self, fn):
+        """Write the table as tab-separated values."""
+        with open(fn, 'w') as writer:
+            writer.write('\t'.join(self.header()) + '\n')
+            for row in self.rows:
+                writer.write('\t'.join([str(x) for x in row]) + '\n')
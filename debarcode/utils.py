@@ -3,7 +3,18 @@ import os
 import os.path as op
 import json
 import pickle
+import multiprocessing
 from collections import defaultdict, Counter
+import numpy as np
+from .zmw_table import ZmwTable, remap_codes
+from .primer_store import ZmwPrimerStore, primer_to_int8, as_int8_primers, NO_PRIMER
+from .assign import (ClusterCodes, ZmwClusterLinks, assign_first_cluster, assign_most_common, assign_weighted, assign_by_func,
+                     decode_assignments, zmw_to_consensus_primer_dict)
+from .consensus import WeightedConsensus
+from .output import OutputWriter
+from .stage_cache import save_pickle, load_pickle, save_primer_stores, load_primer_stores
+from .ice_edges import get_ice_edges, ice_input_fns, ice_params
+from .instrument import RunReport
 
 
 class Obj(object):
@@ -36,14 +47,157 @@ def readname2primer(name):
     else:
         return int(primer)
 
-def zmw_to_primer_from_fasta(fasta_fn):
+FASTA_SCAN_BUFFER_SIZE = 16 * 1024 * 1024
+FASTA_CHUNKS_PER_THREAD = 4
+
+
+def yield_fasta_headers(fasta_fn, start=0, end=None, buffer_size=FASTA_SCAN_BUFFER_SIZE):
+    """Yield header lines (without the leading '>') of a FASTA file.
+    Reads raw buffers of buffer_size bytes and only looks for '\\n>', so
+    sequence bytes are skipped without being split into lines or records.
+    If start and end are given, only yield headers of records whose '>' is
+    within [start, end), where start must be a record boundary (see fasta_chunk_ranges).
+    ...doctest:
+        >>> import tempfile
+        >>> fn = tempfile.mktemp(suffix='.fasta')
+        >>> open(fn, 'w').write('>m/1/ccs strand=+;primer=0\\nACGT\\nAC\\n>m/2/ccs strand=-;primer=NA\\nGG\\n>m/3/ccs strand=+;primer=1')
+        >>> list(yield_fasta_headers(fn, buffer_size=3))
+        ['m/1/ccs strand=+;primer=0', 'm/2/ccs strand=-;primer=NA', 'm/3/ccs strand=+;primer=1']
+        >>> list(yield_fasta_headers(fn, start=0, end=36, buffer_size=3))
+        ['m/1/ccs strand=+;primer=0', 'm/2/ccs strand=-;primer=NA']
+        >>> list(yield_fasta_headers(fn, start=66, end=None))
+        ['m/3/ccs strand=+;primer=1']
+        >>> os.remove(fn)
+    """
+    with open(fasta_fn, 'rb') as reader:
+        reader.seek(start)
+        tail = '\n' # pretend the range starts after a newline, so that the first '>' is found
+        offset = start - 1 # file offset of buf[0]
+        while True:
+            block = reader.read(buffer_size)
+            if not block:
+                break
+            buf = tail + block
+            pos = 0
+            while True:
+                i = buf.find('\n>', pos)
+                if i < 0:
+                    tail = buf[-1:] # may be a '\n' followed by '>' in the next block
+                    break
+                if end is not None and offset + i + 1 >= end:
+                    return
+                stop = buf.find('\n', i + 2)
+                if stop < 0: # header continues in the next block
+                    tail = buf[i:]
+                    break
+                yield buf[i+2:stop].rstrip('\r')
+                pos = stop
+            offset += len(buf) - len(tail)
+        if tail.startswith('\n>') and (end is None or offset + 1 < end): # last header without a trailing newline
+            yield tail[2:].rstrip('\r\n')
+
+
+def fasta_chunk_ranges(fasta_fn, n_chunks):
+    """Split a FASTA file into at most n_chunks byte ranges [(start, end)],
+    where every start is the offset of a record's '>'.
+    ...doctest:
+        >>> import tempfile
+        >>> fn = tempfile.mktemp(suffix='.fasta')
+        >>> open(fn, 'w').write('>m/1/ccs strand=+;primer=0\\nACGT\\nAC\\n>m/2/ccs strand=-;primer=NA\\nGG\\n>m/3/ccs strand=+;primer=1')
+        >>> fasta_chunk_ranges(fn, 2)
+        [(0, 66), (66, 92)]
+        >>> fasta_chunk_ranges(fn, 10)
+        [(0, 35), (35, 66), (66, 92)]
+        >>> os.remove(fn)
+    """
+    size = op.getsize(fasta_fn)
+    bounds = [0]
+    with open(fasta_fn, 'rb') as reader:
+        for k in range(1, n_chunks):
+            pos = max(size * k // n_chunks, bounds[-1] + 1) - 1
+            found = None
+            while pos < size:
+                reader.seek(pos)
+                block = reader.read(1 << 16)
+                i = block.find('\n>')
+                if i >= 0:
+                    found = pos + i + 1
+                    break
+                if len(block) < 2:
+                    break
+                pos += len(block) - 1 # keep the last byte, it may be a '\n' followed by '>'
+            if found is None:
+                break
+            bounds.append(found)
+    bounds.append(size)
+    return zip(bounds[:-1], bounds[1:])
+
+
+def _zmw_to_primer_from_fasta_range(args):
+    """Process pool worker, return (movies, int64 encoded zmws, int8 primers) of records in a byte range,
+    where zmws are encoded by a ZmwTable local to this range.
+    """
+    fasta_fn, start, end = args
+    zmw_table = ZmwTable()
+    zmws, primers = [], []
+    for name in yield_fasta_headers(fasta_fn, start=start, end=end):
+        zmws.append(zmw_table.encode(name))
+        primers.append(primer_to_int8(readname2primer(name)))
+    return zmw_table.movies, np.array(zmws, dtype=np.int64), np.array(primers, dtype=np.int8)
+
+
+def zmw_to_primer_from_fastas(fasta_fns, zmw_table, threads=1):
+    """Return a list of ZmwPrimerStore {encoded_zmw: primer index}, one for each FASTA in fasta_fns,
+    where zmws are encoded by zmw_table.
+    If threads > 1, split each FASTA into byte ranges aligned on records and
+    parse them in a pool of threads processes. Partial results are merged in
+    file order, so the result is the same as parsing each file serially.
+    """
+    tasks = []
+    for fasta_fn in fasta_fns:
+        n_chunks = 1 if threads <= 1 else threads * FASTA_CHUNKS_PER_THREAD
+        tasks.extend([(fasta_fn, start, end) for start, end in fasta_chunk_ranges(fasta_fn, n_chunks)])
+    if threads <= 1:
+        partials = [_zmw_to_primer_from_fasta_range(task) for task in tasks]
+    else:
+        pool = multiprocessing.Pool(processes=threads)
+        try:
+            partials = pool.map(_zmw_to_primer_from_fasta_range, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    zmws, primers = defaultdict(lambda: []), defaultdict(lambda: [])
+    for (fasta_fn, start, end), (movies, partial_zmws, partial_primers) in zip(tasks, partials):
+        zmws[fasta_fn].append(remap_codes(partial_zmws, zmw_table.merge(movies)))
+        primers[fasta_fn].append(partial_primers)
+    return [ZmwPrimerStore.from_arrays(np.concatenate(zmws[fasta_fn]), np.concatenate(primers[fasta_fn]))
+            for fasta_fn in fasta_fns]
+
+
+def zmw_to_primer_from_fasta(fasta_fn, zmw_table, threads=1):
     """Input isoseq_flnc or isoseq_nfl or isoseq_draft fasta file, return
-    dict {'movie/zmw': primer index}
+    ZmwPrimerStore {encoded_zmw: primer index}, where zmws are encoded by zmw_table.
+    Only FASTA headers are scanned, see yield_fasta_headers. primer=-1, i.e., no primer is detected,
+    is kept as None like primer=NA.
+    ...doctest:
+        >>> import tempfile
+        >>> fn = tempfile.mktemp(suffix='.fasta')
+        >>> open(fn, 'w').write('>m/1/0_9_CCS polyA=1;primer=-1\\nACGT\\n>m/2/0_9_CCS polyA=1;primer=0\\nACGT\\n')
+        >>> sorted(zmw_to_primer_from_fasta(fn, ZmwTable()).iteritems())
+        [(1, None), (2, 0)]
+        >>> os.remove(fn)
+    """
+    return zmw_to_primer_from_fastas([fasta_fn], zmw_table, threads=threads)[0]
+
+
+def zmw_to_primer_from_fasta_pbcore(fasta_fn, zmw_table):
+    """Same as zmw_to_primer_from_fasta, but parse every record with pbcore
+    FastaReader. Slow, kept as reference for benchmarks.
     """
     zmw2primer = {}
     for r in FastaReader(fasta_fn):
-        zmw2primer[readname2moviezmw(r.name)] = readname2primer(r.name)
-    return zmw2primer
+        zmw2primer[zmw_table.encode(r.name)] = readname2primer(r.name)
+    return ZmwPrimerStore.from_dict(zmw2primer)
 
 
 class Pcid(object):
@@ -81,116 +235,110 @@ class Pcid(object):
         return self.__cmp__(other) > 0
 
 
-def zmw_to_cids_from_partial_pickle_fns(c_prefix_to_pickle_fn_dict):
-    ret = defaultdict(lambda: [])
-    for c_prefix, pickle_fn in c_prefix_to_pickle_fn_dict.iteritems():
-         d = zmw_to_cids_from_partial_pickle_fn(c_prefix, pickle_fn)
-         for zmw, cids in d.iteritems():
-             ret[zmw].extend(cids)
-    return ret
+def zmw_to_cids_from_partial_pickle_fns(c_prefix_to_pickle_fn_dict, zmw_table, threads=1):
+    """Return defaultdict{encoded_zmw: [(c_prefix, cid)]} of dict{c_prefix: partial_uc pickle file},
+    or of an nfl edges directory written by ice_edges, loading every pickle once in a pool of threads processes."""
+    return get_ice_edges('nfl', c_prefix_to_pickle_fn_dict, zmw_table, threads=threads).z2c()
 
 
-def zmw_to_cids_from_partial_pickle_fn(c_prefix, pickle_fn):
+def zmw_to_cids_from_partial_pickle_fn(c_prefix, pickle_fn, zmw_table):
     pickle_d = pickle.load(open(pickle_fn, 'r'))['partial_uc']
-    return zmw_to_cids_from_partial_pickle_d(c_prefix, pickle_d)
+    return zmw_to_cids_from_partial_pickle_d(c_prefix, pickle_d, zmw_table)
 
 
-def zmw_to_cids_from_partial_pickle_d(c_prefix, pickle_d):
+def zmw_to_cids_from_partial_pickle_d(c_prefix, pickle_d, zmw_table):
     """
     pickle_d: {
     ...doctest:
         >>> d = {1855: ['m54006_170729_232022/10486538/0_3405_CCS', 'm54200_170721_210832/45154853/0_5425_CCS'], 1900:['m54006_170729_232022/10486538/0_3405_CCS']}
-        >>> dict(zmw_to_cids_from_partial_pickle_d('my_c_prefix', d))
+        >>> t = ZmwTable()
+        >>> t.decode_keys(zmw_to_cids_from_partial_pickle_d('my_c_prefix', d, t))
         {'m54200_170721_210832/45154853': [('my_c_prefix', 1855)], 'm54006_170729_232022/10486538': [('my_c_prefix', 1900), ('my_c_prefix', 1855)]}
     """
     zmw2cids = defaultdict(lambda: [])
     for c_id, reads_in_c in pickle_d.iteritems():
         for read in reads_in_c:
-            zmw = readname2moviezmw(read)
+            zmw = zmw_table.encode(read)
             zmw2cids[zmw].append((c_prefix, c_id))
     return zmw2cids
 
 
-def zmw_to_cid_from_flnc_pickle_fns(c_prefix_to_pickle_fn_dict):
+def zmw_to_cid_from_flnc_pickle_fns(c_prefix_to_pickle_fn_dict, zmw_table, threads=1):
     """
-    c_prefix_to_pickle_fn_dict: {c_prefix: flnc_pickle_fn}
+    c_prefix_to_pickle_fn_dict: {c_prefix: flnc_pickle_fn}, or a flnc edges directory written by ice_edges
+    threads: number of processes to load pickles with
     """
-    ret = {}
-    for c_prefix, pickle_fn in c_prefix_to_pickle_fn_dict.iteritems():
-        d = dict(zmw_to_cid_from_flnc_pickle_fn(c_prefix, pickle_fn))
-        ret.update(d)
-    return ret
+    return get_ice_edges('flnc', c_prefix_to_pickle_fn_dict, zmw_table, threads=threads).z2c()
 
 
-def zmw_to_cid_from_flnc_pickle_fn(c_prefix, pickle_fn):
+def zmw_to_cid_from_flnc_pickle_fn(c_prefix, pickle_fn, zmw_table):
     pickle_d = pickle.load(open(pickle_fn, 'r'))['d'] # dict{readname: {cid: weight}}
-    return zmw_to_cid_from_flnc_pickle_d(c_prefix, pickle_d)
+    return zmw_to_cid_from_flnc_pickle_d(c_prefix, pickle_d, zmw_table)
 
-def zmw_to_cid_from_flnc_pickle_d(c_prefix, pickle_d):
+def zmw_to_cid_from_flnc_pickle_d(c_prefix, pickle_d, zmw_table):
     """
     ...doctest:
         >>> d = {'m54200_170722_173443/71500425/13572_72_CCS': {38: -135.67953402228963}}
-        >>> dict(zmw_to_cid_from_flnc_pickle_d('my_c_prefix', d))
+        >>> t = ZmwTable()
+        >>> t.decode_keys(zmw_to_cid_from_flnc_pickle_d('my_c_prefix', d, t))
         {'m54200_170722_173443/71500425': ('my_c_prefix', 38)}
     """
     zmw2cid = defaultdict(lambda: -1)
     for read, cid2w in pickle_d.iteritems():
-        zmw = readname2moviezmw(read)
+        zmw = zmw_table.encode(read)
         for c_id, weight in cid2w.iteritems():
             if zmw2cid[zmw] != -1:
-                raise ValueError("FLNC zmw %s maps to multiple cids %s, (%s, %s)" % (zmw, zmw2cid[zmw], c_prefix, c_id))
+                raise ValueError("FLNC zmw %s maps to multiple cids %s, (%s, %s)" % (zmw_table.decode(zmw), zmw2cid[zmw], c_prefix, c_id))
             zmw2cid[zmw] = (c_prefix, c_id)
     return zmw2cid
 
 
-def cid_to_zmws_from_flnc_pickle_fns(c_prefix_to_pickle_fn_dict):
-    ret = defaultdict(lambda: [])
-    for c_prefix, pickle_fn in c_prefix_to_pickle_fn_dict.iteritems():
-        d = cid_to_zmws_from_flnc_pickle_fn(c_prefix, pickle_fn)
-        for cid, zmws in d.iteritems():
-            ret[cid].extend(zmws)
-    return ret
+def cid_to_zmws_from_flnc_pickle_fns(c_prefix_to_pickle_fn_dict, zmw_table, threads=1):
+    """Return defaultdict{(c_prefix, cid): [encoded zmws]} of dict{c_prefix: flnc_pickle_fn},
+    or of a flnc edges directory written by ice_edges, loading pickles in a pool of threads processes."""
+    return get_ice_edges('flnc', c_prefix_to_pickle_fn_dict, zmw_table, threads=threads).c2z()
 
 
-def cid_to_zmws_from_flnc_pickle_fn(c_prefix, flnc_pickle_fn):
-    """return {(c_prefix, cid): [zmws]}
+def cid_to_zmws_from_flnc_pickle_fn(c_prefix, flnc_pickle_fn, zmw_table):
+    """return {(c_prefix, cid): [encoded zmws]}
     """
     pickle_d = pickle.load(open(flnc_pickle_fn, 'r'))['d'] # dict{readname: {cid: weight}}
-    return cid_to_zmws_from_flnc_pickle_d(c_prefix, pickle_d)
+    return cid_to_zmws_from_flnc_pickle_d(c_prefix, pickle_d, zmw_table)
 
 
-def cid_to_zmws_from_flnc_pickle_d(c_prefix, pickle_d):
+def cid_to_zmws_from_flnc_pickle_d(c_prefix, pickle_d, zmw_table):
     """
     ...doctest:
         >>> d = {'m54200_170722_173443/71500425/13572_72_CCS': {38: -135.67953402228963}}
-        >>> dict(cid_to_zmws_from_flnc_pickle_d('my_c_prefix', d))
+        >>> t = ZmwTable()
+        >>> t.decode_values(cid_to_zmws_from_flnc_pickle_d('my_c_prefix', d, t))
         {('my_c_prefix', 38): ['m54200_170722_173443/71500425']}
 
     """
     cid2zmws = defaultdict(lambda: [])
     for read, cid2w in pickle_d.iteritems():
         for c_id, w in cid2w.iteritems():
-            cid2zmws[(c_prefix,c_id)].append(readname2moviezmw(read))
-        break
+            cid2zmws[(c_prefix,c_id)].append(zmw_table.encode(read))
     return cid2zmws
 
 
-def cid_to_zmws_from_partial_pickle_fn(c_prefix, partial_pickle_fn):
+def cid_to_zmws_from_partial_pickle_fn(c_prefix, partial_pickle_fn, zmw_table):
     pickle_d = pickle.load(open(partial_pickle_fn, 'r'))['partial_uc']
-    return cid_to_zmws_from_partial_pickle_d(c_prefix, pickle_d)
+    return cid_to_zmws_from_partial_pickle_d(c_prefix, pickle_d, zmw_table)
 
 
-def cid_to_zmws_from_partial_pickle_d(c_prefix, pickle_d):
+def cid_to_zmws_from_partial_pickle_d(c_prefix, pickle_d, zmw_table):
     """
     ...doctest:
         >>> d = {1855: ['m54006_170729_232022/10486538/0_3405_CCS', 'm54200_170721_210832/45154853/0_5425_CCS'], 1900:['m54006_170729_232022/10486538/0_3405_CCS']}
-        >>> dict(cid_to_zmws_from_partial_pickle_d('my_c_prefix', d))
+        >>> t = ZmwTable()
+        >>> t.decode_values(cid_to_zmws_from_partial_pickle_d('my_c_prefix', d, t))
         {('my_c_prefix', 1855): ['m54006_170729_232022/10486538', 'm54200_170721_210832/45154853'], ('my_c_prefix', 1900): ['m54006_170729_232022/10486538']}
     """
     cid2zmws = defaultdict(lambda: [])
     for c_id, reads_in_c in pickle_d.iteritems():
         for read in reads_in_c:
-            cid2zmws[(c_prefix, c_id)].append(readname2moviezmw(read))
+            cid2zmws[(c_prefix, c_id)].append(zmw_table.encode(read))
     return cid2zmws
 
 
@@ -224,7 +372,9 @@ def cid_to_primer_count(cid2zmws, zmw2primer, default_primers):
             cid2primer_count[c_id][zmw_primer] += 1
     return cid2primer_count
 
-def get_most_common_item(items, min_fraction=0.9):
+MOST_COMMON_MIN_FRACTION = 0.9
+
+def get_most_common_item(items, min_fraction=MOST_COMMON_MIN_FRACTION):
     """Return the most common item, which >= min_fraction among all items
     ...doctest:
         >>> get_most_common_item([1] * 10 + [2], 0.9)
@@ -242,7 +392,7 @@ def get_most_common_item(items, min_fraction=0.9):
 def cid_to_consensus_primer(flnc_c2z, z2p, get_consensus_func):
     """
     flnc_c2z: dict{(c_prefix, cid): zmw}
-    z2p: dict{zmw: int(primer)}, where primer -1 meaning no primer is detected by isoseq classify
+    z2p: dict{zmw: int(primer)} or ZmwPrimerStore, where primer -1 meaning no primer is detected by isoseq classify
     return {(c_prefix, cid): consensus_primer_of_cid}
     ...doctest:
         >>> def f(items): return items[0]
@@ -255,16 +405,47 @@ def cid_to_consensus_primer(flnc_c2z, z2p, get_consensus_func):
     """
     c2cp = defaultdict(lambda: None) # default is not processed
     for cprefix_cid_tuple, zmws in flnc_c2z.iteritems():
-        zmw_primers = [z2p[zmw] for zmw in zmws]
+        if isinstance(z2p, ZmwPrimerStore):
+            zmw_primers = z2p.primers(zmws)
+        else:
+            zmw_primers = [z2p[zmw] for zmw in zmws]
         c2cp[cprefix_cid_tuple] = get_consensus_func(zmw_primers)
     return c2cp
 
+
+def cid_to_weighted_consensus_primer(flnc_edges, z2p, min_fraction=MOST_COMMON_MIN_FRACTION):
+    """
+    flnc_edges: IceEdges of flnc ICE pickles, whose weights are ICE log-likelihoods of reads in their clusters
+    z2p: dict{zmw: int(primer)} or ZmwPrimerStore, where primer -1 meaning no primer is detected by isoseq classify
+    return ({(c_prefix, cid): consensus_primer_of_cid}, {(c_prefix, cid): read support of consensus_primer_of_cid}),
+    where reads vote with their posteriors in their clusters, and the support of a consensus primer is the
+    number of reads of its cluster times its share of posteriors, see consensus.WeightedConsensus
+    ...doctest:
+        >>> from .ice_edges import IceEdges
+        >>> t = ZmwTable()
+        >>> d = {'m/1/0_9_CCS': {7: 0.0}, 'm/2/0_9_CCS': {7: -3.0}, 'm/3/0_9_CCS': {7: -3.0}, 'm/4/0_9_CCS': {8: -1.0}}
+        >>> edges = IceEdges.from_pickle_ds('flnc', {'p': d}, t)
+        >>> z2p = dict(zip([t.encode('m/%d' % i) for i in range(1, 5)], [0, 1, 1, -1]))
+        >>> c2cp, c2w = cid_to_weighted_consensus_primer(edges, z2p, 0.9)
+        >>> sorted(c2cp.items()), [(cid, round(w, 2)) for cid, w in sorted(c2w.items())]
+        ([(('p', 7), 0), (('p', 8), None)], [(('p', 7), 2.73), (('p', 8), 0.0)])
+    """
+    if isinstance(z2p, ZmwPrimerStore):
+        primers = z2p.lookup(flnc_edges.zmws)
+    else:
+        primers = as_int8_primers([NO_PRIMER if z2p[zmw] is None else z2p[zmw] for zmw in flnc_edges.zmws.tolist()])
+    weighted = WeightedConsensus(flnc_edges.cluster_offsets, primers, flnc_edges.weights, min_fraction)
+    cids = flnc_edges.cids()
+    c2cp = dict(zip(cids, [None if cp == NO_PRIMER else cp for cp in weighted.consensus.tolist()]))
+    c2w = dict(zip(cids, weighted.support.tolist()))
+    return c2cp, c2w
+
 def flnc_zmw_to_consensus_primer(flnc_zmws, flnc_z2c, c2cp):
     """
     flnc_zmws: a list of flnc zmws
     flnc_z2c: defaultdict({flnc_zmw: (c_prefix, cid)})
     c2cp: {(c_prefix, cid): consensus_primer}, if consensus_primer is None, meaning could not get consensus primer.
-    return # dict{'moive/zmw': consensus_primer}
+    return # dict{encoded_zmw: consensus_primer}
     ...doctest:
         >>> zmws = [101, 102, 103]
         >>> z2c = {101: 'c1', 102: 'c2', 103: None}
@@ -273,156 +454,230 @@ def flnc_zmw_to_consensus_primer(flnc_zmws, flnc_z2c, c2cp):
         >>> dict(flnc_zmw_to_consensus_primer(zmws, z2c, c2cp))
         {101: 'cp0', 102: 'cid_no_cprimer', 103: 'no_cid_no_primer'}
     """
-    flnc_zmw2cp = defaultdict(lambda: None) # {flnc_zmw: consensus_primer}
-    for zmw in flnc_zmws:
-        if zmw in flnc_z2c.keys() and flnc_z2c[zmw] is not None and len(flnc_z2c[zmw]) != 0: # this flnc zmw has associated clusters
-            if c2cp[flnc_z2c[zmw]] is None:
-                flnc_zmw2cp[zmw] = 'cid_no_cprimer'
-            else:
-                flnc_zmw2cp[zmw] = c2cp[flnc_z2c[zmw]]
-        else:
-            flnc_zmw2cp[zmw] = 'no_cid_no_primer'
-    return flnc_zmw2cp
+    flnc_zmws = list(flnc_zmws)
+    codes = ClusterCodes(c2cp)
+    assigned = assign_first_cluster(flnc_zmws, ZmwClusterLinks.from_dict(flnc_z2c, codes), codes.cprimers)
+    return zmw_to_consensus_primer_dict(flnc_zmws, assigned, codes.values, no_cid_label='no_cid_no_primer') # {flnc_zmw: consensus_primer}
 
 
-def nfl_zmw_to_consensus_primer(nfl_zmws, nfl_z2c, c2cp, get_consensus_func):
+def nfl_zmw_to_consensus_primer(nfl_zmws, nfl_z2c, c2cp, get_consensus_func=None, c2w=None, consensus=None):
     """
     nfl_zmws: a list of nfl zmws
     nfl_z2c: {nfl_zmw: [(c_prefix, cid),...]}
     c2cp: {(c_prefix, cid): consensus_primer}
-    get_consensus_func: function to return a consensus item out of multiple items
+    get_consensus_func: function to return a consensus item out of multiple items, called per zmw
+    c2w: {(c_prefix, cid): read support}, e.g., of cid_to_weighted_consensus_primer; if given, clusters vote
+         with the reads behind their consensus primers instead of get_consensus_func, see assign.assign_weighted
+    consensus: 'majority' to assign get_most_common_item with its default min_fraction to all zmws at once
+         instead of calling get_consensus_func, see assign.assign_most_common
     ...doctest:
         >>> zmws = [101, 102, 103, 104, 105]
         >>> z2c = {101: ['c0', 'c1', 'c2'], 102: ['c0', 'c3'], 103: [], 104: ['c4']}
         >>> c2cp = {'c0': 0, 'c1': 0, 'c2': 0, 'c3': 1, 'c4': None}
-        >>> d = nfl_zmw_to_consensus_primer(zmws, z2c, c2cp, get_most_common_item)
+        >>> d = nfl_zmw_to_consensus_primer(zmws, z2c, c2cp, consensus='majority')
         >>> [(k, d[k]) for k in sorted(d.keys())]
         [(101, 0), (102, None), (103, 'no_cid_no_cprimer'), (104, 'cid_no_cprimer'), (105, 'no_cid_no_cprimer')]
+        >>> nfl_zmw_to_consensus_primer(zmws, z2c, c2cp, get_most_common_item) == d
+        True
+        >>> nfl_zmw_to_consensus_primer([101, 102], z2c, c2cp, lambda items: 'mixed')[102]
+        'mixed'
+        >>> c2w = {'c0': 38.6, 'c1': 4.7, 'c2': 1.0, 'c3': 1.9, 'c4': 0.0} # c0 of 40 reads outvotes c3 of 2
+        >>> nfl_zmw_to_consensus_primer(zmws, z2c, c2cp, c2w=c2w)[102]
+        0
+        >>> nfl_zmw_to_consensus_primer(zmws, z2c, c2cp, c2w=dict(c2w, c0=1.9))[102] is None
+        True
     """
-    nfl_zmw2cp = defaultdict(lambda: None) # {nfl_zmw: consensus_primer}
-    for nfl_zmw in nfl_zmws:
-        if nfl_zmw in nfl_z2c.keys() and nfl_z2c[nfl_zmw] is not None and len(nfl_z2c[nfl_zmw]) != 0: # this nfl zmw has associated clusters
-            cps = [c2cp[cid] for cid in nfl_z2c[nfl_zmw] if c2cp[cid] is not None]
-            if cps:
-                nfl_zmw2cp[nfl_zmw] = get_consensus_func(cps)
-            else:
-                nfl_zmw2cp[nfl_zmw] = 'cid_no_cprimer'
-        else:
-            nfl_zmw2cp[nfl_zmw] = 'no_cid_no_cprimer'
-    return nfl_zmw2cp
+    nfl_zmws = list(nfl_zmws)
+    codes, assigned = _assign_nfl_zmws(nfl_zmws, nfl_z2c, c2cp, get_consensus_func, c2w, consensus)
+    return zmw_to_consensus_primer_dict(nfl_zmws, assigned, codes.values) # {nfl_zmw: consensus_primer}
 
-def yield_nfl_zmw_to_consensus_primer(nfl_zmws, nfl_z2c, c2cp, get_consensus_func):
+def yield_nfl_zmw_to_consensus_primer(nfl_zmws, nfl_z2c, c2cp, get_consensus_func=None, c2w=None, consensus=None):
     """
     nfl_zmws: a list of nfl zmws
     nfl_z2c: {nfl_zmw: [(c_prefix, cid),...]}
     c2cp: {(c_prefix, cid): consensus_primer}
-    get_consensus_func: function to return a consensus item out of multiple items
+    get_consensus_func: function to return a consensus item out of multiple items, called per zmw
+    c2w: {(c_prefix, cid): read support}, see nfl_zmw_to_consensus_primer
+    consensus: 'majority' or None, see nfl_zmw_to_consensus_primer
     ...doctest:
         >>> zmws = [101, 102, 103, 104, 105]
         >>> z2c = {101: ['c0', 'c1', 'c2'], 102: ['c0', 'c3'], 103: [], 104: ['c4']}
         >>> c2cp = {'c0': 0, 'c1': 0, 'c2': 0, 'c3': 1, 'c4': None}
-        >>> [r for r in yield_nfl_zmw_to_consensus_primer(zmws, z2c, c2cp, get_most_common_item)]
+        >>> [r for r in yield_nfl_zmw_to_consensus_primer(zmws, z2c, c2cp, consensus='majority')]
         [(101, 0), (102, None), (103, 'no_cid_no_cprimer'), (104, 'cid_no_cprimer'), (105, 'no_cid_no_cprimer')]
     """
-    for nfl_zmw in nfl_zmws:
-        if nfl_zmw in nfl_z2c.keys() and nfl_z2c[nfl_zmw] is not None and len(nfl_z2c[nfl_zmw]) != 0: # this nfl zmw has associated clusters
-            cps = [c2cp[cid] for cid in nfl_z2c[nfl_zmw] if c2cp[cid] is not None]
-            if cps:
-                yield (nfl_zmw, get_consensus_func(cps))
-            else:
-                yield (nfl_zmw, 'cid_no_cprimer')
-        else:
-            yield (nfl_zmw, 'no_cid_no_cprimer')
-
-
-def dump_d_to_json(d, o_prefix):
-    json_fn = o_prefix + '.json'
-    json.dump(d, open(json_fn, 'w'))
-
-
-def dump_d_to_pickle(d, o_prefix):
-    pickle_fn = o_prefix + '.pickle'
-    pickle.dump(d, open(pickle_fn, 'w'))
-
-def write_dict(d, o_prefix, headers):
-    """write dict to both json and csv files
+    nfl_zmws = list(nfl_zmws)
+    codes, assigned = _assign_nfl_zmws(nfl_zmws, nfl_z2c, c2cp, get_consensus_func, c2w, consensus)
+    for nfl_zmw, cp in zip(nfl_zmws, decode_assignments(assigned, codes.values)):
+        yield (nfl_zmw, cp)
+
+
+def _assign_nfl_zmws(nfl_zmws, nfl_z2c, c2cp, get_consensus_func=None, c2w=None, consensus=None):
+    """Return (ClusterCodes of c2cp, assignment codes of nfl_zmws), see assign.py.
+    Votes weighted by c2w, or the 'majority' consensus, are computed for all zmws at once,
+    otherwise get_consensus_func is called per zmw."""
+    if consensus not in (None, 'majority'):
+        raise ValueError("Consensus %s must be None or 'majority'" % consensus)
+    if c2w is None and consensus is None and get_consensus_func is None:
+        raise ValueError("Either get_consensus_func, c2w or consensus='majority' must be given")
+    codes = ClusterCodes(c2cp)
+    links = ZmwClusterLinks.from_dict(nfl_z2c, codes)
+    if c2w is not None:
+        return codes, assign_weighted(nfl_zmws, links, codes.cprimers, codes.weights(c2w), len(codes.values), MOST_COMMON_MIN_FRACTION)
+    if consensus == 'majority':
+        return codes, assign_most_common(nfl_zmws, links, codes.cprimers, len(codes.values), MOST_COMMON_MIN_FRACTION)
+    return codes, assign_by_func(nfl_zmws, links, codes.cprimers, codes.values, get_consensus_func)
+
+
+def write_dict(d, o_prefix, headers, zmw_table=None, output=None):
+    """write dict to json, pickle and csv files, or to formats of OutputWriter output
+    If zmw_table is not None, keys of d are encoded zmws and are written as 'movie/zmw'.
     ...doctest:
+        >>> import tempfile, shutil
         >>> d = {1: 'a', 2: 'b'}
-        >>> p = '/home/UNIXHOME/yli/tmp/test_write_dict'
+        >>> tmp_dir = tempfile.mkdtemp()
+        >>> p = op.join(tmp_dir, 'test_write_dict')
         >>> write_dict(d, p, ['key', 'val'])
         >>> f1, f2, f3 = p + '.csv', p + '.json', p + '.pickle'
         >>> open(f1, 'r').readlines() == ['key\\tval\\n', '1\\ta\\n', '2\\tb\\n']
         True
         >>> json.load(open(f2, 'r'))
         {u'1': u'a', u'2': u'b'}
-        >>> pickle.load(open(f3, 'r'))
+        >>> pickle.load(open(f3, 'rb'))
         {1: 'a', 2: 'b'}
-        >>> os.remove(f1)
-        >>> os.remove(f2)
-    """
-    dump_d_to_json(d, o_prefix)
-    dump_d_to_pickle(d, o_prefix)
-    csv_fn = o_prefix + '.csv'
-    with open(csv_fn, 'w') as writer:
-        writer.write("\t".join(headers) + "\n")
-        for k, v in d.iteritems():
-            writer.write("%s\t%s\n" % (k, v))
-
-
-def get_all_z2c(c_prefix_to_flnc_pickle_fn_dict, c_prefix_to_partial_pickle_fn_dict, lazy=False):
-    if lazy:
-        print 'Step 2: lazy zmw_to_cid_from_flnc_pickle_fn'
-        flnc_z2c = pickle.load(open('flnc_z2c.json', 'r'))
-        print 'Step 3: lazy zmw_to_cids_from_partial_pickle_fn'
-        nfl_z2c = pickle.load(open('nfl_z2c.json', 'r'))
-        return flnc_z2c, nfl_z2c
-
-    print 'Step 2: zmw_to_cid_from_flnc_pickle_fn'
-    flnc_z2c = zmw_to_cid_from_flnc_pickle_fns(c_prefix_to_flnc_pickle_fn_dict)
-    print 'Step 3: zmw_to_cids_from_partial_pickle_fn'
-    nfl_z2c = zmw_to_cids_from_partial_pickle_fns(c_prefix_to_partial_pickle_fn_dict) # dict{'movie/zmw': [cid]}, from ice_partial pickle file
-    write_dict(flnc_z2c, o_prefix='flnc_z2c', headers=['flnc_zmw', 'cid'])
-    write_dict(nfl_z2c, o_prefix='nfl_z2c', headers=['nfl_zmw', 'cids'])
+        >>> shutil.rmtree(tmp_dir)
+    """
+    if output is None:
+        output = OutputWriter()
+    output.write_dict(d, o_prefix, headers, zmw_table)
+
+
+def encode_keys(d, zmw_table):
+    """Return a dict with 'movie/zmw' keys of d encoded by zmw_table, e.g., of a cached pickle."""
+    return dict([(zmw_table.encode(zmw), v) for zmw, v in d.iteritems()])
+
+
+def _cached_zmw_dicts(cache, stage, compute, zmw_table, decode, encode, **kwargs):
+    """Return compute(), a list of dicts with encoded zmws, reused from cache if it is not None.
+    Cached dicts are pickled with zmws decoded by decode(d), and encoded back by encode(d)."""
+    if cache is None:
+        return compute()
+    return cache.cached(stage, compute,
+                        save=lambda ds, entry_dir: save_pickle([decode(d) for d in ds], entry_dir),
+                        load=lambda entry_dir: [encode(d) for d in load_pickle(entry_dir)], **kwargs)
+
+
+def get_all_z2c(c_prefix_to_flnc_pickle_fn_dict, c_prefix_to_partial_pickle_fn_dict, zmw_table, cache=None, threads=1, report=None):
+    """Return (flnc_z2c, nfl_z2c) of ICE pickle files, loaded with threads processes, or edges directories
+    written by ice_edges, reused from StageCache cache if it is not None. Stages are measured by RunReport report."""
+    report = RunReport() if report is None else report
+    def compute():
+        with report.stage('flnc_z2c') as stage:
+            flnc_z2c = zmw_to_cid_from_flnc_pickle_fns(c_prefix_to_flnc_pickle_fn_dict, zmw_table, threads=threads)
+            stage.records = len(flnc_z2c)
+        with report.stage('nfl_z2c') as stage:
+            nfl_z2c = zmw_to_cids_from_partial_pickle_fns(c_prefix_to_partial_pickle_fn_dict, zmw_table, threads=threads) # dict{encoded_zmw: [cid]}, from ice_partial pickle file
+            stage.records = len(nfl_z2c)
+        return [flnc_z2c, nfl_z2c]
+    flnc_z2c, nfl_z2c = _cached_zmw_dicts(cache, 'z2c', compute, zmw_table, zmw_table.decode_keys, lambda d: encode_keys(d, zmw_table),
+                                          input_fns=sorted(ice_input_fns(c_prefix_to_flnc_pickle_fn_dict) + ice_input_fns(c_prefix_to_partial_pickle_fn_dict)),
+                                          params={'flnc': ice_params(c_prefix_to_flnc_pickle_fn_dict),
+                                                  'partial': ice_params(c_prefix_to_partial_pickle_fn_dict)})
+    # written whether computed or reused from cache
+    write_dict(flnc_z2c, o_prefix='flnc_z2c', headers=['flnc_zmw', 'cid'], zmw_table=zmw_table)
+    write_dict(nfl_z2c, o_prefix='nfl_z2c', headers=['nfl_zmw', 'cids'], zmw_table=zmw_table)
     return flnc_z2c, nfl_z2c
 
 
-def get_all_z2p(flnc_fa_fn, nfl_fa_fn, o_dir, lazy=False):
-    """Get all z2p zmw_to_primer dict"""
-    if lazy:
-        print 'lazy get_all_z2p'
-        flnc_z2p = pickle.load(open(op.join(o_dir, 'flnc_z2p.pickle'), 'r'))
-        nfl_z2p = pickle.load(open(op.join(o_dir, 'nfl_z2p.pickle'), 'r'))
-        return flnc_z2p, nfl_z2p
-
-    flnc_z2p = zmw_to_primer_from_fasta(flnc_fa_fn) # dict{'movie/zmw': int(primer)}, where primer=0, 1 or -1(None)
-    nfl_z2p = zmw_to_primer_from_fasta(nfl_fa_fn) # dict{'movie/zmw': int(primer)}, where primer=0, 1 or -1(None)
-    write_dict(flnc_z2p, o_prefix=op.join(o_dir, 'flnc_z2p'), headers=['flnc_zmw', 'classify_primer'])
-    write_dict(nfl_z2p, o_prefix=op.join(o_dir, 'nfl_z2p'), headers=['nfl_zmw', 'classify_primer'])
+def get_z2p_stores(flnc_fa_fn, nfl_fa_fn, zmw_table, threads=1, cache=None):
+    """Return [flnc_z2p, nfl_z2p] ZmwPrimerStores of both FASTA files, parsed with threads processes,
+    or reused from StageCache cache if it is not None."""
+    compute = lambda: zmw_to_primer_from_fastas([flnc_fa_fn, nfl_fa_fn], zmw_table, threads=threads)
+    if cache is None:
+        return compute()
+    return cache.cached('z2p', compute,
+                        save=lambda stores, entry_dir: save_primer_stores(stores, zmw_table, entry_dir),
+                        load=lambda entry_dir: load_primer_stores(entry_dir, zmw_table),
+                        input_fns=[flnc_fa_fn, nfl_fa_fn])
+
+
+def get_all_z2p(flnc_fa_fn, nfl_fa_fn, o_dir, zmw_table, threads=1, cache=None, output=None):
+    """Get all z2p zmw_to_primer dict, parsing both FASTA files with threads processes,
+    or reusing them from StageCache cache if it is not None, and write them by OutputWriter output."""
+    # ZmwPrimerStore{encoded_zmw: int(primer)}, where primer=0, 1 or -1(None)
+    flnc_z2p, nfl_z2p = get_z2p_stores(flnc_fa_fn, nfl_fa_fn, zmw_table, threads=threads, cache=cache)
+    write_dict(flnc_z2p, o_prefix=op.join(o_dir, 'flnc_z2p'), headers=['flnc_zmw', 'classify_primer'], zmw_table=zmw_table, output=output)
+    write_dict(nfl_z2p, o_prefix=op.join(o_dir, 'nfl_z2p'), headers=['nfl_zmw', 'classify_primer'], zmw_table=zmw_table, output=output)
     return flnc_z2p, nfl_z2p
 
 
-def get_c2cp(flnc_c2z, z2p, lazy):
-    if lazy:
-        c2cp = pickle.load(open('c2cp.pickle', 'r'))
-        return c2cp
-    c2cp = cid_to_consensus_primer(flnc_c2z, z2p, get_most_common_item) #{(c_prefix, cid): consensus_primer}
+def get_c2cp(flnc_c2z, z2p, cache=None):
+    """Return c2cp, reused from StageCache cache if flnc_c2z and z2p also came from it."""
+    compute = lambda: cid_to_consensus_primer(flnc_c2z, z2p, get_most_common_item) #{(c_prefix, cid): consensus_primer}
+    if cache is None:
+        c2cp = compute()
+    else: # a defaultdict of a lambda can not be pickled, it is cached as a dict
+        c2cp = cache.cached('c2cp', compute, lambda c2cp, entry_dir: save_pickle(dict(c2cp), entry_dir),
+                            lambda entry_dir: defaultdict(lambda: None, load_pickle(entry_dir)), deps=[flnc_c2z, z2p])
     write_dict(c2cp, o_prefix='c2cp', headers=['cid', 'consensus_primer'])
     return c2cp
 
 
-def get_flnc_c2z(c_prefix_to_flnc_pickle_fn_dict, lazy):
-    if lazy:
-        return pickle.load(open('flnc_c2z.pickle', 'r'))
-    flnc_c2z = cid_to_zmws_from_flnc_pickle_fns(c_prefix_to_flnc_pickle_fn_dict) # dict{(c_prefix, cid): [zmws]} , from flnc pickle
-    write_dict(flnc_c2z, o_prefix='flnc_c2z', headers=['cid', 'flnc_zmws'])
+WEIGHTED_C2CP_STAGE_VERSION = 2 # c2w holds read support of consensus primers, not their share of posteriors
+
+
+def get_weighted_c2cp(c_prefix_to_flnc_pickle_fn_dict, z2p, zmw_table, min_fraction=MOST_COMMON_MIN_FRACTION, cache=None, threads=1):
+    """Return [c2cp, c2w] of cid_to_weighted_consensus_primer of ICE flnc pickle files, loaded with threads processes,
+    or of a flnc edges directory, reused from StageCache cache if z2p also came from it.
+    This is the weighted counterpart of get_c2cp, whose c2w is passed on to get_nfl_z2cp."""
+    def compute():
+        flnc_edges = get_ice_edges('flnc', c_prefix_to_flnc_pickle_fn_dict, zmw_table, threads=threads)
+        return list(cid_to_weighted_consensus_primer(flnc_edges, z2p, min_fraction))
+    if cache is None:
+        c2cp, c2w = compute()
+    else:
+        c2cp, c2w = cache.cached('weighted_c2cp', compute, save_pickle, load_pickle,
+                                 input_fns=ice_input_fns(c_prefix_to_flnc_pickle_fn_dict),
+                                 params={'flnc': ice_params(c_prefix_to_flnc_pickle_fn_dict), 'min_fraction': min_fraction,
+                                         'version': WEIGHTED_C2CP_STAGE_VERSION}, deps=[z2p])
+    write_dict(c2cp, o_prefix='c2cp', headers=['cid', 'consensus_primer'])
+    write_dict(c2w, o_prefix='c2w', headers=['cid', 'support'])
+    return [c2cp, c2w]
+
+
+FLNC_C2Z_STAGE_VERSION = 2 # flnc_c2z holds all zmws of every cluster, not only those of the first read of a pickle
+
+
+def get_flnc_c2z(c_prefix_to_flnc_pickle_fn_dict, zmw_table, cache=None, threads=1):
+    """Return flnc_c2z of ICE pickle files, loaded with threads processes, reused from StageCache cache if it is not None."""
+    def compute():
+        return [cid_to_zmws_from_flnc_pickle_fns(c_prefix_to_flnc_pickle_fn_dict, zmw_table, threads=threads)] # dict{(c_prefix, cid): [encoded zmws]} , from flnc pickle
+    encode_values = lambda d: dict([(cid, [zmw_table.encode(zmw) for zmw in zmws]) for cid, zmws in d.iteritems()])
+    flnc_c2z = _cached_zmw_dicts(cache, 'flnc_c2z', compute, zmw_table, zmw_table.decode_values, encode_values,
+                                 input_fns=ice_input_fns(c_prefix_to_flnc_pickle_fn_dict),
+                                 params={'flnc': ice_params(c_prefix_to_flnc_pickle_fn_dict), 'version': FLNC_C2Z_STAGE_VERSION})[0]
+    write_dict(zmw_table.decode_values(flnc_c2z), o_prefix='flnc_c2z', headers=['cid', 'flnc_zmws'])
     return flnc_c2z
 
 
-def get_flnc_z2cp(flnc_z2p, flnc_z2c, c2cp, lazy):
-    if lazy:
-        return pickle.load(open('flnc_z2cp.pickle', 'r'))
-    flnc_z2cp = flnc_zmw_to_consensus_primer(flnc_z2p.keys(), flnc_z2c, c2cp) # dict{'moive/zmw': consensus_primer}
-    write_dict(flnc_z2cp, o_prefix='flnc_z2cp', headers=['flnc_zmw', 'consensus_primer'])
+def get_flnc_z2cp(flnc_z2p, flnc_z2c, c2cp, zmw_table, cache=None):
+    """Return flnc_z2cp, reused from StageCache cache if flnc_z2p, flnc_z2c and c2cp also came from it."""
+    def compute():
+        return [flnc_zmw_to_consensus_primer(flnc_z2p.keys(), flnc_z2c, c2cp)] # dict{encoded_zmw: consensus_primer}
+    flnc_z2cp = _cached_zmw_dicts(cache, 'flnc_z2cp', compute, zmw_table, zmw_table.decode_keys, lambda d: encode_keys(d, zmw_table),
+                                  deps=[flnc_z2p, flnc_z2c, c2cp])[0]
+    write_dict(flnc_z2cp, o_prefix='flnc_z2cp', headers=['flnc_zmw', 'consensus_primer'], zmw_table=zmw_table)
     return flnc_z2cp
 
 
+def get_nfl_z2cp(nfl_z2p, nfl_z2c, c2cp, zmw_table, c2w=None, cache=None):
+    """Return nfl_z2cp, by majority of consensus primers of clusters of every nfl zmw, or by votes weighted
+    by c2w of get_weighted_c2cp if it is not None, reused from StageCache cache if nfl_z2p, nfl_z2c, c2cp
+    and c2w also came from it."""
+    def compute():
+        return [nfl_zmw_to_consensus_primer(nfl_z2p.keys(), nfl_z2c, c2cp, c2w=c2w, consensus='majority')] # dict{encoded_zmw: consensus_primer}
+    nfl_z2cp = _cached_zmw_dicts(cache, 'nfl_z2cp', compute, zmw_table, zmw_table.decode_keys, lambda d: encode_keys(d, zmw_table),
+                                 deps=[nfl_z2p, nfl_z2c, c2cp] + ([] if c2w is None else [c2w]),
+                                 params={'weighted': c2w is not None})[0]
+    write_dict(nfl_z2cp, o_prefix='nfl_z2cp', headers=['nfl_zmw', 'consensus_primer'], zmw_table=zmw_table)
+    return nfl_z2cp
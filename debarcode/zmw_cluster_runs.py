@@ -0,0 +1,196 @@
+"""
+Out-of-core zmw -> cluster links.
+
+(encoded zmw, cluster index) pairs are buffered in memory and, once the
+buffer exceeds a memory budget, sorted and spilled to a run file on disk.
+Sorted runs are then k-way merged to stream zmws in sorted order with the
+indices of all their clusters, so z2c lists of all zmws never need to be held
+in memory at once. Cluster indices are in report order, so the clusters of a
+zmw come out in the same order as they were appended to z2c lists.
+"""
+import os.path as op
+import heapq
+import shutil
+import tempfile
+from itertools import groupby
+import numpy as np
+
+PAIR_NBYTES = 16 # int64 zmw + int64 cluster index
+MERGE_READ_PAIRS = 64 * 1024 # pairs read from each run at a time while merging
+
+
+def sort_pairs(zmws, cluster_idxs):
+    """Sort (zmw, cluster_idx) pairs by zmw, then cluster_idx.
+    ...doctest:
+        >>> zmws, idxs = sort_pairs([5, 3, 5], [2, 0, 1])
+        >>> zmws.tolist(), idxs.tolist()
+        ([3, 5, 5], [0, 1, 2])
+    """
+    zmws = np.asarray(zmws, dtype=np.int64)
+    cluster_idxs = np.asarray(cluster_idxs, dtype=np.int64)
+    order = np.lexsort((cluster_idxs, zmws))
+    return zmws[order], cluster_idxs[order]
+
+
+def last_cluster_of_zmws(zmws, cluster_idxs):
+    """Return (sorted unique zmws, index of the last cluster of each zmw in report order).
+    A zmw is assigned the consensus primer of the last cid in its z2c list, which is
+    the cluster of that zmw with the largest index.
+    ...doctest:
+        >>> zmws, idxs = last_cluster_of_zmws([5, 3, 5, 7, 5], [0, 0, 2, 2, 1])
+        >>> zmws.tolist(), idxs.tolist()
+        ([3, 5, 7], [0, 2, 2])
+    """
+    zmws, cluster_idxs = sort_pairs(zmws, cluster_idxs)
+    last = np.ones(len(zmws), dtype=bool)
+    last[:-1] = zmws[1:] != zmws[:-1]
+    return zmws[last], cluster_idxs[last]
+
+
+def yield_run_pairs(run_fn, n_pairs=MERGE_READ_PAIRS):
+    """Yield (zmw, cluster_idx) pairs of a sorted run file, reading n_pairs at a time."""
+    with open(run_fn, 'rb') as reader:
+        while True:
+            pairs = np.fromfile(reader, dtype=np.int64, count=2 * n_pairs)
+            if len(pairs) == 0:
+                break
+            pairs = pairs.reshape(-1, 2)
+            for pair in zip(pairs[:, 0].tolist(), pairs[:, 1].tolist()):
+                yield pair
+
+
+class ZmwClusterRuns(object):
+    """(zmw, cluster_idx) pairs, spilled to sorted runs in tmp_dir whenever more than
+    memory_budget bytes of pairs are buffered. memory_budget=None never spills.
+    ...doctest:
+        >>> runs = ZmwClusterRuns(memory_budget=32)
+        >>> runs.add([5, 3], [0, 0])
+        >>> runs.add([5, 7, 3], [1, 1, 2])
+        >>> runs.add([5], [3])
+        >>> runs.n_runs, len(runs)
+        (2, 6)
+        >>> [(zmw, idxs) for zmw, idxs in runs.yield_z2c()]
+        [(3, [0, 2]), (5, [0, 1, 3]), (7, [1])]
+        >>> zmws, idxs = runs.last_clusters()
+        >>> zmws.tolist(), idxs.tolist()
+        ([3, 5, 7], [2, 3, 1])
+        >>> run_dir = op.dirname(runs.run_fns[0])
+        >>> runs.close()
+        >>> op.exists(run_dir)
+        False
+        >>> with ZmwClusterRuns(memory_budget=16) as runs:
+        ...     runs.add([5, 3], [0, 0])
+        ...     run_dir = runs.run_dir
+        ...     raise KeyError(1)
+        Traceback (most recent call last):
+        ...
+        KeyError: 1
+        >>> op.exists(run_dir)
+        False
+    """
+    def __init__(self, memory_budget=None, tmp_dir=None):
+        self.memory_budget = memory_budget
+        self.tmp_dir = tmp_dir
+        self.run_dir = None # created on first spill
+        self.run_fns = []
+        self.n_pairs = 0
+        self._zmws, self._cluster_idxs, self._n_buffered = [], [], 0
+
+    def __len__(self):
+        return self.n_pairs
+
+    @property
+    def n_runs(self):
+        return len(self.run_fns)
+
+    def add(self, zmws, cluster_idxs):
+        """Append pairs, spilling buffered pairs to a sorted run if over memory budget."""
+        self._zmws.append(np.asarray(zmws, dtype=np.int64))
+        self._cluster_idxs.append(np.asarray(cluster_idxs, dtype=np.int64))
+        self._n_buffered += len(zmws)
+        self.n_pairs += len(zmws)
+        if self.memory_budget is not None and self._n_buffered * PAIR_NBYTES >= self.memory_budget:
+            self.spill()
+
+    def _sorted_buffer(self):
+        if not self._zmws:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        return sort_pairs(np.concatenate(self._zmws), np.concatenate(self._cluster_idxs))
+
+    def spill(self):
+        """Sort buffered pairs and write them to a new run file."""
+        if self._n_buffered == 0:
+            return
+        zmws, cluster_idxs = self._sorted_buffer()
+        self._zmws, self._cluster_idxs, self._n_buffered = [], [], 0
+        if self.run_dir is None:
+            self.run_dir = tempfile.mkdtemp(prefix='zmw_cluster_runs.', dir=self.tmp_dir)
+        run_fn = op.join(self.run_dir, 'run.%d.bin' % len(self.run_fns))
+        np.column_stack((zmws, cluster_idxs)).tofile(run_fn)
+        self.run_fns.append(run_fn)
+
+    def yield_pairs(self):
+        """Yield all (zmw, cluster_idx) pairs sorted by zmw, then cluster_idx."""
+        if not self.run_fns:
+            zmws, cluster_idxs = self._sorted_buffer()
+            return iter(zip(zmws.tolist(), cluster_idxs.tolist()))
+        self.spill()
+        return heapq.merge(*[yield_run_pairs(run_fn) for run_fn in self.run_fns])
+
+    def yield_pair_chunks(self, n_pairs=MERGE_READ_PAIRS):
+        """Yield (zmws, cluster_idxs) int64 arrays of about n_pairs pairs at a time, in the order of yield_pairs.
+        ...doctest:
+            >>> runs = ZmwClusterRuns(memory_budget=16)
+            >>> runs.add([5, 3], [0, 0]); runs.add([4], [1])
+            >>> [(zmws.tolist(), idxs.tolist()) for zmws, idxs in runs.yield_pair_chunks(2)]
+            [([3, 4], [0, 1]), ([5], [0])]
+            >>> runs.close()
+        """
+        if not self.run_fns:
+            zmws, cluster_idxs = self._sorted_buffer()
+            for start in xrange(0, len(zmws), n_pairs):
+                yield zmws[start:start+n_pairs], cluster_idxs[start:start+n_pairs]
+            return
+        pairs = []
+        for pair in self.yield_pairs():
+            pairs.append(pair)
+            if len(pairs) == n_pairs:
+                chunk = np.array(pairs, dtype=np.int64)
+                yield chunk[:, 0], chunk[:, 1]
+                pairs = []
+        if pairs:
+            chunk = np.array(pairs, dtype=np.int64)
+            yield chunk[:, 0], chunk[:, 1]
+
+    def yield_z2c(self):
+        """Yield (zmw, [cluster indices in report order]) in sorted zmw order."""
+        for zmw, pairs in groupby(self.yield_pairs(), key=lambda pair: pair[0]):
+            yield (zmw, [cluster_idx for _zmw, cluster_idx in pairs])
+
+    def last_clusters(self):
+        """Return (sorted unique zmws, index of the last cluster of each zmw) as int64 arrays."""
+        if not self.run_fns:
+            return last_cluster_of_zmws(*self._sorted_buffer())
+        zmw_chunks, last_idx_chunks, zmws, last_idxs = [], [], [], []
+        for zmw, cluster_idxs in self.yield_z2c():
+            zmws.append(zmw)
+            last_idxs.append(cluster_idxs[-1])
+            if len(zmws) == MERGE_READ_PAIRS: # keep merged zmws as arrays rather than python ints
+                zmw_chunks.append(np.array(zmws, dtype=np.int64))
+                last_idx_chunks.append(np.array(last_idxs, dtype=np.int64))
+                zmws, last_idxs = [], []
+        zmw_chunks.append(np.array(zmws, dtype=np.int64))
+        last_idx_chunks.append(np.array(last_idxs, dtype=np.int64))
+        return np.concatenate(zmw_chunks), np.concatenate(last_idx_chunks)
+
+    def close(self):
+        """Remove run files."""
+        if self.run_dir is not None:
+            shutil.rmtree(self.run_dir, ignore_errors=True)
+            self.run_dir, self.run_fns = None, []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
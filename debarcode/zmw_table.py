@@ -0,0 +1,139 @@
+"""
+Intern zmw names ('movie/zmw') as 64-bit integers.
+
+A zmw is encoded as (movie_idx << ZMW_BITS) | zmw_id, where movie_idx is the
+index of the movie in a ZmwTable. The movie table is built from the inputs as
+names are encoded, so no movie list needs to be known in advance.
+"""
+import numpy as np
+
+ZMW_BITS = 32
+ZMW_MASK = (1 << ZMW_BITS) - 1
+
+
+def encode_movie_zmw(movie_idx, zmw_id):
+    """
+    ...doctest:
+        >>> encode_movie_zmw(1, 100)
+        4294967396
+    """
+    return (movie_idx << ZMW_BITS) | zmw_id
+
+
+def movie_idx_of(code):
+    """
+    ...doctest:
+        >>> movie_idx_of(4294967396)
+        1
+    """
+    return code >> ZMW_BITS
+
+
+def zmw_id_of(code):
+    """
+    ...doctest:
+        >>> zmw_id_of(4294967396)
+        100
+    """
+    return code & ZMW_MASK
+
+
+class ZmwTable(object):
+    """Movie table shared by all stages, mapping 'movie/zmw' <-> int.
+    ...doctest:
+        >>> t = ZmwTable()
+        >>> t.encode('movie1/100/0_1000_CCS')
+        100
+        >>> t.encode('movie2/3')
+        4294967299
+        >>> t.decode(4294967299)
+        'movie2/3'
+        >>> t.movies
+        ['movie1', 'movie2']
+    """
+    def __init__(self, movies=None):
+        self.movies = []
+        self.movie2idx = {}
+        for movie in (movies or []):
+            self.movie_index(movie)
+
+    def __len__(self):
+        return len(self.movies)
+
+    def __repr__(self):
+        return 'ZmwTable(%r)' % (self.movies)
+
+    def movie_index(self, movie):
+        """Return index of movie, adding it to the table if it is new."""
+        try:
+            return self.movie2idx[movie]
+        except KeyError:
+            self.movie2idx[movie] = len(self.movies)
+            self.movies.append(movie)
+            return self.movie2idx[movie]
+
+    def encode(self, name):
+        """Encode a zmw or read name, e.g., 'movie/zmw' or 'movie/zmw/0_100_CCS'."""
+        movie, zmw_id = name.split('/', 2)[0:2]
+        return encode_movie_zmw(self.movie_index(movie), int(zmw_id))
+
+    def decode(self, code):
+        """Decode an encoded zmw back to 'movie/zmw'."""
+        return '%s/%d' % (self.movies[code >> ZMW_BITS], code & ZMW_MASK)
+
+    def decode_keys(self, d):
+        """Return a dict with encoded zmw keys of d decoded to 'movie/zmw'.
+        ...doctest:
+            >>> ZmwTable(['m0', 'm1']).decode_keys({4294967299: 'cid'})
+            {'m1/3': 'cid'}
+        """
+        return dict([(self.decode(code), v) for code, v in d.iteritems()])
+
+    def decode_values(self, d):
+        """Return a dict with lists of encoded zmws in values of d decoded to 'movie/zmw'.
+        ...doctest:
+            >>> ZmwTable(['m0', 'm1']).decode_values({'cid': [1, 4294967299]})
+            {'cid': ['m0/1', 'm1/3']}
+        """
+        return dict([(k, [self.decode(code) for code in codes]) for k, codes in d.iteritems()])
+
+    def merge(self, movies):
+        """Add movies of another table, return list mapping their indices to indices in this table.
+        ...doctest:
+            >>> t = ZmwTable(['m0', 'm1'])
+            >>> t.merge(['m1', 'm2'])
+            [1, 2]
+            >>> t.movies
+            ['m0', 'm1', 'm2']
+        """
+        return [self.movie_index(movie) for movie in movies]
+
+    def write(self, fn):
+        """Write movie table, one movie per line in index order."""
+        with open(fn, 'w') as writer:
+            for movie in self.movies:
+                writer.write(movie + '\n')
+
+    @classmethod
+    def read(cls, fn):
+        with open(fn, 'r') as reader:
+            return ZmwTable([line.strip() for line in reader if line.strip()])
+
+
+def remap_code(code, movie_idx_map):
+    """Re-encode a zmw from one table to another, given movie_idx_map returned by ZmwTable.merge.
+    ...doctest:
+        >>> remap_code(encode_movie_zmw(1, 7), [0, 2])
+        8589934599
+    """
+    return encode_movie_zmw(movie_idx_map[code >> ZMW_BITS], code & ZMW_MASK)
+
+
+def remap_codes(codes, movie_idx_map):
+    """Vectorized remap_code for a numpy int64 array of encoded zmws.
+    ...doctest:
+        >>> remap_codes(np.array([encode_movie_zmw(1, 7), 3], dtype=np.int64), [0, 2]).tolist()
+        [8589934599, 3]
+    """
+    movie_idx_map = np.asarray(movie_idx_map, dtype=np.int64)
+    return (movie_idx_map[codes >> ZMW_BITS] << ZMW_BITS) | (codes & ZMW_MASK)
@@ -2,59 +2,130 @@
 import sys
 import os
 import os.path as op
+import multiprocessing
+import numpy as np
 from argparse import ArgumentParser
 from .utils import *
-from .cluster_to_consensus_primer import ClusterDict, get_most_common_or_none
-
-
-def parse_z2c_line(line):
-    fs = line.strip().split('\t')
-    zmw = fs[0]
-    cids = fs[1][1:-1].split(',')
-    return (zmw, cids)
-
-def yield_zmw_cids_from_z2c_fn(z2c_fn):
-    with open(z2c_fn, 'r') as reader:
-        for line in reader:
-            zmw, cids = parse_z2c_line(line=line)
-            yield (zmw, cids)
-
-
-def get_z2cp(z2c_iterator, c2cp, min_fraction):
-    """
+from .cluster_to_consensus_primer import ClusterDict
+from .zmw_table import ZmwTable
+from .cluster_dict_store import ClusterDictStore, is_cluster_dict_dir
+from .cluster_ids import ClusterIds, Z2cStore, is_z2c_dir, cluster_consensus, NO_CLUSTER, CLUSTER_IDX_DTYPE
+from .primer_store import ZmwPrimerStore, primer_to_int8
+from .output import add_output_arguments, output_writer_from_args
+from .background import yield_prefetched_lines
+from .instrument import RunReport, add_report_arguments, run_report_from_args, finish_run_report
+
+
+def z2cp_of_reads(reads, z2c_fn, c2cp, out_dir, output, report):
+    """Compute zmw -> consensus primer of z2c_fn of reads (flnc or nfl), given c2cp as
+    (ClusterIds, int8 consensus primers of their indices), and write it to out_dir/<reads>_z2cp.*"""
+    zmw_table = ZmwTable() # of this half only, so that flnc and nfl halves can run concurrently
+    with report.stage('%s_z2cp' % reads) as stage:
+        progress = report.progress('%s z2c' % reads, total=None if is_z2c_dir(z2c_fn) else op.getsize(z2c_fn))
+        z2cp = get_z2cp_store(z2c_fn, c2cp[0], c2cp[1], zmw_table, progress)
+        stage.records = progress.records
+    with report.stage('write_%s_z2cp' % reads) as stage:
+        write_dict(z2cp, o_prefix=op.join(out_dir, '%s_z2cp' % reads), headers=['%s_zmw' % reads, 'consensus_primer'],
+                   zmw_table=zmw_table, output=output)
+        stage.records = len(z2cp)
+
+
+# (c2cp, output, report stream and progress interval) of the parent process, set before
+# flnc and nfl workers are forked, so that they share c2cp read-only instead of pickling it
+_WORKER_C2CP = {}
+
+def _z2cp_of_reads_worker(args):
+    """Process pool worker of z2cp_of_reads, return StageStats of its stages"""
+    reads, z2c_fn, out_dir = args
+    report = RunReport(stream=_WORKER_C2CP['stream'], progress_interval=_WORKER_C2CP['progress_interval'])
+    z2cp_of_reads(reads, z2c_fn, _WORKER_C2CP['c2cp'], out_dir, _WORKER_C2CP['output'], report)
+    return report.stages
+
+
+def get_cluster_consensus_from_cluster_dict_fn(cluster_dict_fn, min_fraction, zmw_table):
+    """Return (ClusterIds of cids, int8 consensus primers of their indices) of a binary cluster_dict
+    directory or a cluster_dict.csv, where the last cluster of a cid wins as in c2cp.
     ...doctest:
-        >>> z2c = {'movie/0': ['cid1', 'cid2'], 'movie/1': ['cid2', 'cid3'], 'movie/3': ['cid3', 'cid4'], 'movie/4': ['cid4']}
-        >>> c2cp = {'cid1': 0, 'cid2': 0, 'cid3': 1, 'cid4':  None}
-        >>> dict(get_z2cp(z2c.iteritems(), c2cp, 0.6))
-        {'movie/4': None, 'movie/3': None, 'movie/0': 0, 'movie/1': 1}
+        >>> import tempfile
+        >>> fn = tempfile.mktemp()
+        >>> open(fn, 'w').write('c1\\t[m/1]\\t[]\\t[0]\\t[]\\t0\\nc2\\t[m/2]\\t[]\\t[None]\\t[]\\tNone\\n')
+        >>> cluster_ids, consensus = get_cluster_consensus_from_cluster_dict_fn(fn, 0.6, ZmwTable())
+        >>> cluster_ids.names, consensus.tolist()
+        (['c1', 'c2'], [0, -1])
+        >>> os.remove(fn)
     """
-    z2cp = defaultdict(lambda: None)
-    for zmw, cids in z2c_iterator:
-        cprimers = [c2cp[cid] for cid in cids]
-        cprimers_wo_none = [cp for cp in cprimers if cp is not None]
-        ccprimer = get_most_common_or_none(cprimers_wo_none, min_fraction=min_fraction)
-        if len(cids) > 0:
-            z2cp[zmw] = c2cp[cid]
-        else:
-            z2cp[zmw] = None
-    return z2cp
-
-def get_c2cp_from_cluster_dict_reader(cluster_dict_reader, min_fraction):
+    if is_cluster_dict_dir(cluster_dict_fn):
+        store = ClusterDictStore(cluster_dict_fn)
+        cluster_ids = ClusterIds()
+        idxs = cluster_ids.indices(store.cids)
+        return cluster_ids, cluster_consensus(idxs, store.consensus, len(cluster_ids))
+    cluster_ids, idxs, consensus = ClusterIds(), [], []
+    with open(cluster_dict_fn, 'r') as reader:
+        for s in reader:
+            obj = ClusterDict.fromString(s, zmw_table, min_fraction)
+            idxs.append(cluster_ids.index(obj.cid))
+            consensus.append(primer_to_int8(obj.consensus_primer))
+    return cluster_ids, cluster_consensus(idxs, consensus, len(cluster_ids))
+
+
+def yield_zmw_last_cids_from_z2c_fn(z2c_fn, zmw_table, progress=None):
+    """Yield (encoded_zmw, its last cid) of lines of z2c_fn, whose consensus primer the zmw is assigned.
+    ...doctest:
+        >>> import tempfile
+        >>> fn = tempfile.mktemp()
+        >>> open(fn, 'w').write('m/3\\t[c1,c2]\\nm/4\\t[]\\n')
+        >>> list(yield_zmw_last_cids_from_z2c_fn(fn, ZmwTable()))
+        [(3, 'c2'), (4, '')]
+        >>> os.remove(fn)
     """
+    position = 0
+    for line in yield_prefetched_lines(z2c_fn):
+        name, cids = line.rstrip('\r\n').split('\t')
+        if progress is not None:
+            position += len(line)
+            progress.update(1, position)
+        yield zmw_table.encode(name), cids[1:-1].rsplit(',', 1)[-1]
+
+
+def get_z2cp_store(z2c_fn, cluster_ids, consensus, zmw_table, progress=None):
+    """Return ZmwPrimerStore{encoded_zmw: consensus primer of its last cluster} of a z2c csv or binary z2c directory,
+    given ClusterIds and int8 consensus primers of their indices. Raise ValueError if the last cid of a zmw is
+    missing or not in cluster_ids, i.e., z2c_fn and the cluster_dict do not come from the same cluster report.
     ...doctest:
-        >>> s = 'cid\\t[movie1/1,movie1/2]\\t[movie2/3,movie3/4]\\t[0,0]\\t[1,None]\\t0'
-        >>> dict(get_c2cp_from_cluster_dict_reader([s], 0.6))
-        {'cid': 0}
+        >>> import tempfile
+        >>> fn = tempfile.mktemp()
+        >>> open(fn, 'w').write('m/3\\t[c1,c2]\\nm/4\\t[c1]\\n')
+        >>> sorted(get_z2cp_store(fn, ClusterIds(['c1', 'c2']), np.array([0, -1], dtype=np.int8), ZmwTable()).iteritems())
+        [(3, None), (4, 0)]
+        >>> open(fn, 'w').write('m/3\\t[c1,c2]\\nm/4\\t[]\\nm/5\\t[cx]\\n')
+        >>> get_z2cp_store(fn, ClusterIds(['c1', 'c2']), np.array([0, -1], dtype=np.int8), ZmwTable())
+        Traceback (most recent call last):
+        ...
+        ValueError: 2 zmws of ... have cids not in the cluster_dict, e.g., m/4 with cid ''
+        >>> os.remove(fn)
     """
-    c2cp = defaultdict(lambda: None)
-    for s in cluster_dict_reader:
-        obj = ClusterDict.fromString(s, min_fraction)
-        c2cp[obj.cid] = obj.consensus_primer
-    return c2cp
-
-
-def get_c2cp_from_cluster_dict_fn(cluster_dict_fn, min_fraction):
-    return get_c2cp_from_cluster_dict_reader(open(cluster_dict_fn, 'r'), min_fraction)
+    if is_z2c_dir(z2c_fn):
+        store = Z2cStore(z2c_fn, zmw_table)
+        zmws, last_idxs = store.last_clusters()
+        if progress is not None:
+            progress.update(len(zmws))
+        names = store.cluster_ids.names
+        idxs = cluster_ids.lookup(names)[last_idxs]
+    else:
+        get = cluster_ids.name2idx.get
+        zmws, idxs, names = [], [], []
+        for zmw, cid in yield_zmw_last_cids_from_z2c_fn(z2c_fn, zmw_table, progress):
+            zmws.append(zmw)
+            idxs.append(get(cid, NO_CLUSTER))
+            names.append(cid)
+        idxs = np.array(idxs, dtype=CLUSTER_IDX_DTYPE)
+        last_idxs = np.arange(len(names))
+    unknown = np.flatnonzero(idxs == NO_CLUSTER)
+    if len(unknown):
+        i = unknown[0]
+        raise ValueError("%d zmws of %s have cids not in the cluster_dict, e.g., %s with cid %r" %
+                         (len(unknown), z2c_fn, zmw_table.decode(zmws[i]), names[last_idxs[i]]))
+    return ZmwPrimerStore.from_arrays(zmws, np.asarray(consensus, dtype=np.int8)[idxs])
 
 
 def get_parser():
@@ -62,28 +133,39 @@ def get_parser():
     desc = """Link zmw to consensus primers of its associated clusters."""
     parser = ArgumentParser(description=desc)
     #parser.add_argument("flnc_fa_fn", help="Input FLNC FASTA, e.g., %s" % FLNC_FA_FN)
-    parser.add_argument("flnc_z2c_fn", help="Input FLNC zmws to cluster csv, i.e., flnc_z2c.csv generated by cluster-to-consensus-primer")
-    parser.add_argument("nfl_z2c_fn", help="Input NFL zmws to cluster csv, i.e., nfl_z2c.csv generated by cluster-to-consensus-primer")
-    parser.add_argument("cluster_dict_fn", help="Input cluster to consensus primer csv, i.e., cluster_dict.csv generated by cluster-to-consensus-primer")
+    parser.add_argument("flnc_z2c_fn", help="Input FLNC zmws to clusters, i.e., flnc_z2c.csv or the binary flnc_z2c directory generated by cluster-to-consensus-primer")
+    parser.add_argument("nfl_z2c_fn", help="Input NFL zmws to clusters, i.e., nfl_z2c.csv or the binary nfl_z2c directory generated by cluster-to-consensus-primer")
+    parser.add_argument("cluster_dict_fn", help="Input cluster to consensus primer, i.e., binary cluster_dict directory or cluster_dict.csv generated by cluster-to-consensus-primer")
     parser.add_argument("out_dir", help="Output directory")
     parser.add_argument("--min_fraction", help="Minimum fraction of consensus primer among all known primers.", default=0.6, type=float)
+    parser.add_argument("--threads", help="Number of processes, 2 or more computes flnc and nfl z2cp concurrently.", default=1, type=int)
+    add_output_arguments(parser)
+    add_report_arguments(parser)
     return parser
 
 def run(args):
-    print 'get_c2cp_from_cluster_dict_fn'
-    c2cp = get_c2cp_from_cluster_dict_fn(args.cluster_dict_fn, args.min_fraction)
-
-    print 'get_z2cp(flnc_z2c, c2cp...)'
-    flnc_z2c_iterator = yield_zmw_cids_from_z2c_fn(args.flnc_z2c_fn)
-    flnc_z2cp = get_z2cp(flnc_z2c_iterator, c2cp, args.min_fraction)
-    print 'write_dict(flnc_z2cp)'
-    write_dict(dict(flnc_z2cp), o_prefix=op.join(args.out_dir, 'flnc_z2cp'), headers=['flnc_zmw', 'consensus_primer'])
-
-    print 'get_z2cp(nfl_z2c, c2cp...)'
-    nfl_z2c_iterator = yield_zmw_cids_from_z2c_fn(args.nfl_z2c_fn)
-    nfl_z2cp = get_z2cp(nfl_z2c_iterator, c2cp, args.min_fraction)
-    print 'write_dict(nfl_z2cp)'
-    write_dict(dict(nfl_z2cp), o_prefix=op.join(args.out_dir, 'nfl_z2cp'), headers=['nfl_zmw', 'consensus_primer'])
+    report = run_report_from_args(args, 'zmw-to-consensus-primer')
+    zmw_table = ZmwTable() # of zmws of a cluster_dict.csv, flnc and nfl z2cp have their own
+    output = output_writer_from_args(args)
+    with report.stage('c2cp') as stage:
+        c2cp = get_cluster_consensus_from_cluster_dict_fn(args.cluster_dict_fn, args.min_fraction, zmw_table)
+        stage.records = len(c2cp[0])
+
+    tasks = [('flnc', args.flnc_z2c_fn, args.out_dir), ('nfl', args.nfl_z2c_fn, args.out_dir)]
+    if args.threads <= 1:
+        for reads, z2c_fn, out_dir in tasks:
+            z2cp_of_reads(reads, z2c_fn, c2cp, out_dir, output, report)
+    else:
+        _WORKER_C2CP.update({'c2cp': c2cp, 'output': output, 'stream': report.stream, 'progress_interval': report.progress_interval})
+        pool = multiprocessing.Pool(processes=len(tasks))
+        try:
+            for stages in pool.map(_z2cp_of_reads_worker, tasks, chunksize=1):
+                report.stages.extend(stages)
+        finally:
+            pool.close()
+            pool.join()
+            _WORKER_C2CP.clear()
+    finish_run_report(report, args)
 
 
 def main():
@@ -46,7 +46,11 @@ setup(
     # Maybe the pbtools-* should really be done in a subparser style
     entry_points={'console_scripts': [
         'zmw-to-consensus-primer = debarcode.zmw_to_consensus_primer:main',
-        'cluster-to-consensus-primer = debarcode.cluster_to_consensus_primer:main'
+        'cluster-to-consensus-primer = debarcode.cluster_to_consensus_primer:main',
+        'isoseq-demultiplex = debarcode.pipeline:main',
+        'ice-to-edges = debarcode.ice_edges:main',
+        'split-by-primer = debarcode.split:main',
+        'demultiplex-lookup = debarcode.lookup:main'
     ]},
     install_requires=_get_requirements(_get_local_file(_REQUIREMENTS_FILE)),
     tests_require=['nose'],